@@ -4,20 +4,96 @@ import os
 import sys
 import time
 import json
+import hashlib
 import scipy.io as scio
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import array_codec
+import cache_stats
+import hash_store
 from mmdps.proc import atlas, netattr
 
 
 dbname = ['static_attr', 'static_net', 'dynamic_attr',
           'dynamic_net', 'EEG', 'Temp-database']
 
+# codec tag of documents whose values are encoded with hash_store.encode_value:
+# EEG features (older EEG documents hold pickles of the raw loadmat values),
+# dynamic summaries and temp values
+VALUE_CODEC = 'tagged'
+
+# reductions over the time axis of dynamic features, stored in the
+# <collection>-summary sibling collection, one document per scan
+SUMMARIES = ('mean', 'std', 'cv', 'min', 'max')
+SUMMARY_SUFFIX = '-summary'
+
+
+def mat_fields(datadict, fields, path=''):
+    """ Return a dict of field -> value of a loadmat dict """
+    """ fields empty: every variable of the file under its own name """
+    """ otherwise the configured fields of the struct variables, unwrapped from their 1x1 struct """
+    variables = dict((k, v) for k, v in datadict.items() if not k.startswith('__'))
+    ret = {}
+    if fields == []:
+        return variables
+    for k, v in variables.items():
+        names = v.dtype.names if isinstance(v, np.ndarray) else None
+        for field in fields:
+            if names is not None and field in names:
+                if field in ret:
+                    raise Exception('%s found in several variables of %s' % (field, path))
+                ret[field] = v[field][0, 0]
+    missing = [field for field in fields if field not in ret]
+    if missing:
+        raise Exception('%s missing in %s' % (', '.join(missing), path))
+    return ret
+
+
+def dynamic_summaries(data):
+    """ Return a dict of summary -> reduction over the last (time) axis of data """
+    mean = data.mean(axis=-1)
+    std = data.std(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cv = std / mean
+    return dict(mean=mean, std=std, cv=cv, min=data.min(axis=-1), max=data.max(axis=-1))
+
+
+def dynamic_summary(data, summary, axis=-1):
+    """ Return one of SUMMARIES of data over its time axis, as dynamic_summaries does """
+    if summary not in SUMMARIES:
+        raise Exception('summary must be one of %s' % (SUMMARIES,))
+    if summary == 'cv':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return data.std(axis=axis) / data.mean(axis=axis)
+    return getattr(data, summary)(axis=axis)
+
+
+def parse_mat(path, fields):
+    """ Load a .mat and encode its fields, return (dict of field -> bytes, seconds) """
+    """ module level so that it runs in a process pool """
+    start = time.time()
+    values = mat_fields(scio.loadmat(path), fields, path)
+    doc = dict((field, hash_store.encode_value(value)) for field, value in values.items())
+    return doc, time.time() - start
+
+
+def decode_mat_field(record, field, fields):
+    """ Decode a field of an EEG document, fields being its EEG_conf fields """
+    if record.get('codec') == VALUE_CODEC:
+        return hash_store.decode_value(record[field])
+    value = pickle.loads(record[field])
+    if fields != []:
+        value = value[0, 0]
+    return value
+
 
 class MongoDBDatabase:
 
-    def __init__(self, data_source, host='101.6.70.6', user='mmdpdb', pwd='123.abc', dbname=None, port=27017):
+    def __init__(self, data_source, host='101.6.70.6', user='mmdpdb', pwd='123.abc', dbname=None, port=27017, stats=None):
         """ Connect to mongo server """
+        """ stats: cache_stats.Stats recording hits, bytes, round trips and latencies """
+        self.stats = stats if stats is not None else cache_stats.Stats()
         if user == None and pwd == None:
             self.client = pymongo.MongoClient(host, port)
         else:
@@ -34,6 +110,7 @@ class MongoDBDatabase:
         self.dadb = self.client[self.data_source + '_DA']
         self.dndb = self.client[self.data_source + '_DN']
         self.EEG_db = self.client[self.data_source + '_EEG']
+        self.EEG_raw_db = self.client[self.data_source + '_EEGRAW']
         self.temp_db = self.client[self.data_source + '_TEMP']
         self.temp_collection = self.temp_db['Temp-collection']
 
@@ -65,6 +142,53 @@ class MongoDBDatabase:
         col = self.getcol(atlas_name, feature, window_length, step_size)
         return db[col].find(query)
 
+    def find_feature(self, dbname, scan, atlas_name, feature, comment={}, window_length=None, step_size=None):
+        """ dbname could be SA SN DA DN """
+        """ return the list of matching records, recorded in self.stats """
+        labels = (self.data_source, atlas_name, feature)
+        with self.stats.timer('mongo_find', labels):
+            docs = list(self.total_query(dbname, scan, atlas_name, feature, comment, window_length, step_size))
+        self.stats.incr('round_trips', 'mongo', labels)
+        if len(docs) != 0:
+            self.stats.hit('mongo', labels, sum(len(doc['value']) for doc in docs))
+        else:
+            self.stats.miss('mongo', labels)
+        return docs
+
+    def scans_with_feature(self, dbname, atlas_name, feature, comment={}, window_length=None, step_size=None):
+        """ dbname could be SA SN DA DN """
+        """ return the scan names having the feature, in one query projected on the scan field """
+        query = dict(comment=comment)
+        if dbname in ('DA', 'DN'):
+            # every slice of a dynamic feature is a document, count each scan once
+            query['slice'] = 0
+        col = self.getcol(atlas_name, feature, window_length, step_size)
+        labels = (self.data_source, atlas_name, feature)
+        with self.stats.timer('mongo_find', labels):
+            scans = [doc['scan'] for doc in self.getdb(dbname)[col].find(query, {'scan': 1, '_id': 0})]
+        self.stats.incr('round_trips', 'mongo', labels)
+        return scans
+
+    def feature_versions(self, dbname, atlas_name, feature, scans, comment={}, window_length=None, step_size=None):
+        """ dbname could be SA SN DA DN """
+        """ return a dict of scan -> version of the feature for scans having it, in one projected query """
+        """ the version is the ObjectId of the document (a hash of the slice ids for dynamic features), """
+        """ which changes whenever the feature is saved again """
+        col = self.getcol(atlas_name, feature, window_length, step_size)
+        labels = (self.data_source, atlas_name, feature)
+        ids = {}
+        with self.stats.timer('mongo_find', labels):
+            for doc in self.getdb(dbname)[col].find({'scan': {'$in': list(scans)}, 'comment': comment}, {'scan': 1}):
+                ids.setdefault(doc['scan'], []).append(str(doc['_id']))
+        self.stats.incr('round_trips', 'mongo', labels)
+        ret = {}
+        for scan, docs in ids.items():
+            if len(docs) == 1:
+                ret[scan] = docs[0]
+            else:
+                ret[scan] = hashlib.sha1(','.join(sorted(docs)).encode('utf-8')).hexdigest()
+        return ret
+
     def getcol(self, atlas_name, attrname, window_length=None, step_size=None):
         if (window_length, step_size) != (None, None):
             return '%s-%s-(%d,%d)' % (atlas_name, attrname, window_length, step_size)
@@ -121,11 +245,13 @@ class MongoDBDatabase:
             doc = dict(scan=attr.scan, value=value, slice=idx, comment=comment)
             docs.append(doc)
         self.dadb[col].insert_many(docs)
+        self.save_dynamic_summary('DA', col, attr.scan, attr.data, comment)
 
     def remove_dynamic_attr(self, scan, atlas_name, feature, window_length, step_size, comment={}):
         col = self.getcol(atlas_name, feature, window_length, step_size)
         query = dict(scan=scan, comment=comment)
         self.dadb[col].delete_many(query)
+        self.dadb[col + SUMMARY_SUFFIX].delete_many(query)
 
     def save_dynamic_net(self, net, comment={}):
         atlas_name = net.atlasobj.name
@@ -140,11 +266,76 @@ class MongoDBDatabase:
             doc = dict(scan=net.scan, value=value, slice=idx, comment=comment)
             docs.append(doc)
         self.dndb[col].insert_many(docs)
+        self.save_dynamic_summary('DN', col, net.scan, net.data, comment)
 
     def remove_dynamic_net(self, scan, atlas_name, feature, window_length, step_size, comment={}):
         col = self.getcol(atlas_name, feature, window_length, step_size)
         query = dict(scan=scan, comment=comment)
         self.dndb[col].delete_many(query)
+        self.dndb[col + SUMMARY_SUFFIX].delete_many(query)
+
+    def save_dynamic_summary(self, dbname, col, scan, data, comment={}):
+        """ Store the SUMMARIES of a dynamic feature, data with time as last axis, """
+        """ as one document of the sibling collection of col """
+        doc = dict(scan=scan, comment=comment, slices=data.shape[-1], codec=VALUE_CODEC)
+        for summary, value in dynamic_summaries(np.asarray(data)).items():
+            doc[summary] = hash_store.encode_value(value)
+        self.getdb(dbname)[col + SUMMARY_SUFFIX].replace_one(dict(scan=scan, comment=comment), doc, upsert=True)
+
+    def get_dynamic_summary(self, dbname, scans, atlas_name, feature, window_length, step_size, summary, comment={}):
+        """ dbname could be DA DN """
+        """ Return a dict of scan -> summary of the dynamic feature for scans having it, """
+        """ in one query projected on the summary, the slices are not read """
+        if summary not in SUMMARIES:
+            raise Exception('summary must be one of %s' % (SUMMARIES,))
+        col = self.getcol(atlas_name, feature, window_length, step_size) + SUMMARY_SUFFIX
+        labels = (self.data_source, atlas_name, feature)
+        with self.stats.timer('mongo_find', labels):
+            records = list(self.getdb(dbname)[col].find({'scan': {'$in': list(scans)}, 'comment': comment}, {'scan': 1, summary: 1, '_id': 0}))
+        self.stats.incr('round_trips', 'mongo', labels)
+        ret = {}
+        for record in records:
+            self.stats.hit('mongo', labels, len(record[summary]))
+            ret[record['scan']] = hash_store.decode_value(record[summary])
+        return ret
+
+    def backfill_dynamic_summaries(self, dbnames=('DA', 'DN'), cols=None, overwrite=False):
+        """ Compute the summaries of dynamic features saved before they were stored at write time """
+        """ cols: optional collection names, default every dynamic collection of dbnames """
+        """ Slices are read one scan at a time, scans having a summary are skipped unless overwrite """
+        """ A (scan, comment, slice) index is created first, so that the ordered scan streams from it """
+        """ Return a dict of collection -> number of scans summarized """
+        report = {}
+        for dbname in dbnames:
+            db = self.getdb(dbname)
+            names = cols if cols is not None else [name for name in db.list_collection_names() if not name.endswith(SUMMARY_SUFFIX)]
+            for col in names:
+                start = time.time()
+                done = set() if overwrite else set((doc['scan'], json.dumps(doc['comment'], sort_keys=True))
+                                                   for doc in db[col + SUMMARY_SUFFIX].find({}, {'scan': 1, 'comment': 1, '_id': 0}))
+                self.createIndex(dbname, col, ['scan', 'comment', 'slice'])
+                count = 0
+                slices = []
+                # allow_disk_use in case the server does not pick the index
+                cursor = db[col].find({}, {'_id': 0}, allow_disk_use=True)
+                for doc in cursor.sort([('scan', pymongo.ASCENDING), ('comment', pymongo.ASCENDING), ('slice', pymongo.ASCENDING)]):
+                    if slices and (slices[0]['scan'], slices[0]['comment']) != (doc['scan'], doc['comment']):
+                        count += self.backfill_summary(dbname, col, slices, done)
+                        slices = []
+                    slices.append(doc)
+                if slices:
+                    count += self.backfill_summary(dbname, col, slices, done)
+                report[col] = count
+                print('%s %s: %d scans summarized in %1.2fs' % (dbname, col, count, time.time() - start))
+        return report
+
+    def backfill_summary(self, dbname, col, slices, done):
+        scan, comment = slices[0]['scan'], slices[0]['comment']
+        if (scan, json.dumps(comment, sort_keys=True)) in done:
+            return 0
+        data = np.stack([hash_store.decode_value(doc['value']) for doc in slices], axis=-1)
+        self.save_dynamic_summary(dbname, col, scan, data, comment)
+        return 1
 
     def loadmat(self, path):
         """ load mat, return data dict"""
@@ -161,46 +352,111 @@ class MongoDBDatabase:
         dic = dict(scan=scan)
         if self.EEG_db[feature].find_one(dic) != None:
             raise MultipleRecordException(dic, 'Please check again.')
-        if self.EEG_conf[mat]['fields'] == []:
-            for k in datadict.keys():
-                dic[feature] = pickle.dumps(datadict[k])
-        else:
-            for k in datadict.keys():
-                DataArray = datadict[k]
-                for field in self.EEG_conf[mat]['fields']:
-                    dic[field] = pickle.dumps(DataArray[field])
+        values = mat_fields(datadict, self.EEG_conf[mat]['fields'], mat)
+        dic.update((field, hash_store.encode_value(value)) for field, value in values.items())
+        dic['codec'] = VALUE_CODEC
         self.EEG_db[feature].insert_one(dic)
 
+    def import_eeg_features(self, rootfolder, workers=None, batch_size=100):
+        """ Store every .mat of rootfolder/<scan>/ listed in EEG_conf.json """
+        """ Files are parsed in a process pool and written with insert_many in batches """
+        """ of batch_size documents per collection. (scan, feature) pairs already in mongo """
+        """ are skipped, so an interrupted run is resumed by running it again. """
+        """ Return a dict with 'inserted' and 'skipped' (scan, mat) pairs, 'failed' """
+        """ (path, error) pairs and 'timing', scan -> seconds spent parsing its files """
+        report = dict(inserted=[], skipped=[], failed=[], timing={})
+        done = {}
+        tasks = []
+        for scan in sorted(os.listdir(rootfolder)):
+            folder = os.path.join(rootfolder, scan)
+            if not os.path.isdir(folder):
+                continue
+            for mat in sorted(os.listdir(folder)):
+                if mat not in self.EEG_conf:
+                    continue
+                feature = self.EEG_conf[mat]['feature']
+                if feature not in done:
+                    done[feature] = set(doc['scan'] for doc in self.EEG_db[feature].find({}, {'scan': 1, '_id': 0}))
+                if scan in done[feature]:
+                    report['skipped'].append((scan, mat))
+                else:
+                    tasks.append((scan, mat, os.path.join(folder, mat)))
+        remaining = {}
+        for scan, mat, path in tasks:
+            remaining[scan] = remaining.get(scan, 0) + 1
+        batches = {}
+
+        def flush(feature):
+            docs = batches.pop(feature, [])
+            if docs:
+                self.EEG_db[feature].insert_many([doc for mat, doc in docs], ordered=False)
+                report['inserted'] += [(doc['scan'], mat) for mat, doc in docs]
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = dict((pool.submit(parse_mat, path, self.EEG_conf[mat]['fields']), (scan, mat, path))
+                           for scan, mat, path in tasks)
+            for future in as_completed(futures):
+                scan, mat, path = futures[future]
+                try:
+                    doc, seconds = future.result()
+                except Exception as e:
+                    report['failed'].append((path, str(e)))
+                    seconds = 0
+                else:
+                    feature = self.EEG_conf[mat]['feature']
+                    doc.update(scan=scan, codec=VALUE_CODEC)
+                    batches.setdefault(feature, []).append((mat, doc))
+                    if len(batches[feature]) >= batch_size:
+                        flush(feature)
+                report['timing'][scan] = report['timing'].get(scan, 0) + seconds
+                remaining[scan] -= 1
+                if remaining[scan] == 0:
+                    print('%s: %1.2fs' % (scan, report['timing'][scan]))
+        for feature in list(batches):
+            flush(feature)
+        print('%d mats inserted, %d skipped, %d failed' % (len(report['inserted']), len(report['skipped']), len(report['failed'])))
+        return report
+
     def remove_mat_dict(self, scan, feature):
         """remove mat record"""
         query = dict(scan=scan)
         self.EEG_db[feature].delete_many(query)
 
-    def get_mat(self, scan, mat, field):
-        """ Get mat and its field from mongo """
-        """ it doesn't work well """
-        query = dict(scan=scan)
-        feature = mat
-        count = self.EEG_db[feature].count_documents(query)
-        currentMat = mat+'.mat'
-        dic = {}
-        if count == 0:
+    def get_mat_fields(self, scans, mat, field):
+        """ Return a dict of scan -> decoded field of mat for scans having it """
+        """ mat: .mat file name with or without extension, all scans are fetched in one query """
+        """ projected on the field """
+        currentMat = mat if mat.endswith('.mat') else mat + '.mat'
+        fields = self.EEG_conf[currentMat]['fields']
+        feature = self.EEG_conf[currentMat]['feature']
+        labels = (self.data_source, 'EEG', feature)
+        with self.stats.timer('mongo_find', labels):
+            records = list(self.EEG_db[feature].find({'scan': {'$in': list(scans)}}, {'scan': 1, 'codec': 1, field: 1, '_id': 0}))
+        self.stats.incr('round_trips', 'mongo', labels)
+        ret = {}
+        for record in records:
+            if record['scan'] in ret:
+                raise MultipleRecordException((record['scan'], mat))
+            if field not in record:
+                raise NoRecordFoundException((record['scan'], mat), '%s not in %s' % (field, mat))
+            self.stats.hit('mongo', labels, len(record[field]))
+            ret[record['scan']] = decode_mat_field(record, field, fields)
+        return ret
+
+    def get_mat(self, scan, mat, field, export=None):
+        """ Get the field of mat of a scan from mongo, as {field: value} """
+        """ export: optional path of a .mat file the dict is also saved to """
+        try:
+            value = self.get_mat_fields([scan], mat, field).get(scan)
+        except NoRecordFoundException:
+            print('%s not in %s' % (field, mat))
+            return None
+        if value is None:
             raise NoRecordFoundException((scan, mat))
-        elif count > 1:
-            raise MultipleRecordException((scan, mat))
-        else:
-            record = self.EEG_db[feature].find_one(query)
-            if field in record.keys():
-                matname = '%s_%s.mat' % (mat, field)
-                if self.EEG_conf[currentMat]['fields'] != []:
-                    dic[field] = pickle.loads(record[field])[0, 0]
-                else:
-                    dic[field] = pickle.loads(record[field])
-                scio.savemat(matname, dic)
-                return dic
-            else:
-                print('%s not in %s' % (field, mat))
-                return None
+        dic = {field: value}
+        if export is not None:
+            scio.savemat(export, dic)
+        return dic
 
     def get_static_attr(self, scan, atlas_name, feature, comment={}):
         """  Return to an attr object  directly """
@@ -221,18 +477,17 @@ class MongoDBDatabase:
         """ Return to dynamic attr object directly """
         query = dict(scan=scan, comment=comment)
         col = self.getcol(atlas_name, feature, window_length, step_size)
-        count = self.dadb[col].find(query)
+        count = self.dadb[col].count_documents(query)
         if count == 0:
             raise NoRecordFoundException(scan + atlas_name + feature)
         else:
             records = self.dadb[col].find(
-                query).sort([('slice', pymongo.ASCENDING)])
+                query, {'value': 1, '_id': 0}).sort([('slice', pymongo.ASCENDING)])
+            # slices are decoded into the final array, time becomes the last axis by a view
+            value = hash_store.assemble_slices((record['value'] for record in records), count)
             atlasobj = atlas.get(atlas_name)
-            attr = netattr.DynamicAttr(
-                None, atlasobj, window_length, step_size, scan, feature)
-            for record in records:
-                attr.append_one_slice(pickle.loads(record['value']))
-            return attr
+            return netattr.DynamicAttr(
+                np.moveaxis(value, 0, -1), atlasobj, window_length, step_size, scan, feature)
 
     def get_static_net(self, scan, atlas_name, comment={}):
         """  Return to an static net object directly  """
@@ -253,17 +508,16 @@ class MongoDBDatabase:
         """ Return to dynamic attr object directly """
         query = dict(scan=scan, comment=comment)
         col = self.getcol(atlas_name, 'BOLD.net', window_length, step_size)
-        if self.dndb[col].find_one(query) == None:
+        count = self.dndb[col].count_documents(query)
+        if count == 0:
             raise NoRecordFoundException((scan, atlas, 'BOLD.net'))
         else:
-            records = self.dndb[col].find(query).sort(
+            records = self.dndb[col].find(query, {'value': 1, '_id': 0}).sort(
                 [('slice', pymongo.ASCENDING)])
+            value = hash_store.assemble_slices((record['value'] for record in records), count)
             atlasobj = atlas.get(atlas_name)
-            net = netattr.DynamicNet(
-                None, atlasobj, window_length, step_size, scan, 'BOLD.net')
-            for record in records:
-                net.append_one_slice(pickle.loads(record['value']))
-            return net
+            return netattr.DynamicNet(
+                np.moveaxis(value, 0, -1), atlasobj, window_length, step_size, scan, 'BOLD.net')
 
     def put_temp_data(self, temp_data, description_dict, overwrite=False):
         """
@@ -281,6 +535,47 @@ class MongoDBDatabase:
         description_dict.update(dict(value=pickle.dumps(temp_data)))
         self.temp_collection.insert_one(description_dict)
 
+    def put_temp_buffer(self, buf, description_dict, overwrite=False):
+        """
+        Insert an already packed binary buffer (see array_codec) into MongoDB as is.
+        The description_dict should be a dict whose keys do not contain 'value'.
+        """
+        count = self.temp_collection.count_documents(description_dict)
+        if count > 0 and not overwrite:
+            raise MultipleRecordException(
+                description_dict, 'Please consider a new name')
+        elif count > 0 and overwrite:
+            self.temp_collection.delete_many(description_dict)
+        doc = dict(description_dict, value=buf, codec='series')
+        self.temp_collection.insert_one(doc)
+
+    def get_temp_buffer(self, description_dict):
+        """
+        Return the ndarray of a packed buffer stored by put_temp_buffer.
+        """
+        record = self.temp_collection.find_one(dict(description_dict, codec='series'))
+        if record is None:
+            raise NoRecordFoundException(description_dict)
+        return array_codec.unpack_series(record['value'])
+
+    def put_temp_value(self, value, description_dict, sources=None):
+        """
+        Insert or replace a temp record holding value encoded by hash_store.
+        sources: optional list of [source, version] pairs the value was derived from
+        """
+        self.temp_collection.delete_many(description_dict)
+        doc = dict(description_dict, value=hash_store.encode_value(value), codec=VALUE_CODEC, sources=sources)
+        self.temp_collection.insert_one(doc)
+
+    def get_temp_value(self, description_dict):
+        """
+        Return (value, sources) of a temp record stored by put_temp_value.
+        """
+        record = self.temp_collection.find_one(dict(description_dict, codec=VALUE_CODEC))
+        if record is None:
+            raise NoRecordFoundException(description_dict)
+        return hash_store.decode_value(record['value']), record['sources']
+
     def remove_temp_data(self, description_dict={}):
         """
         Delete all temp records according to description_dict
@@ -333,7 +628,7 @@ class NoRecordFoundException(Exception):
     def __init__(self, name, suggestion=''):
         super(NoRecordFoundException, self).__init__()
         self.name = name
-        self.suggestion = ''
+        self.suggestion = suggestion
 
     def __str__(self):
         return 'No record found for %s. %s' % (self.name, self.suggestion)
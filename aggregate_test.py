@@ -0,0 +1,84 @@
+"""
+Check of MMDPDatabase.aggregate against numpy, with a fake MongoDB and the disk cache:
+incremental folding, feature versions and groups of dynamic features of different lengths.
+Runs without Redis or MongoDB.
+"""
+import types
+import tempfile
+import numpy as np
+import mmdpdb
+import disk_cache
+
+class FakeMongo:
+	def __init__(self, versions):
+		self.versions = versions
+
+	def feature_versions(self, dbname, atlas_name, feature, scans, comment = {}, window_length = None, step_size = None):
+		return dict((scan, self.versions[scan]) for scan in scans if scan in self.versions)
+
+def make_db(values, groups):
+	"""
+	An MMDPDatabase reading values (scan -> ndarray) of the scans of groups (name -> scans).
+	Return the database and the list of scans read.
+	"""
+	db = mmdpdb.MMDPDatabase.__new__(mmdpdb.MMDPDatabase)
+	db.data_source = 'Changgung'
+	db.mdb = FakeMongo(dict((scan, 'v1') for scan in values))
+	db.rdb = disk_cache.DiskCacheDatabase(tempfile.mkdtemp())
+	db.group_scans = lambda group: (groups[group], group)
+	reads = []
+	def get_values(scans, *args, **kwargs):
+		reads.extend(scans)
+		return [types.SimpleNamespace(data = values[scan]) for scan in scans]
+	db.get_feature = get_values
+	db.get_dynamic_feature = get_values
+	return db, reads
+
+def check(result, values):
+	assert result['count'] == len(values)
+	assert np.allclose(result['mean'], values.mean(axis = 0))
+	assert np.allclose(result['std'], values.std(axis = 0, ddof = 1))
+
+def IncrementalTest():
+	rand = np.random.RandomState(0)
+	values = dict(('scan%d' % i, rand.rand(5)) for i in range(10))
+	groups = dict(g = sorted(values)[:6])
+	db, reads = make_db(values, groups)
+	check(db.aggregate('g', 'aal', 'BOLD.BC', batch_size = 4), np.array([values[scan] for scan in groups['g']]))
+	assert len(reads) == 6
+	del reads[:]
+	db.aggregate('g', 'aal', 'BOLD.BC')
+	assert reads == []
+	groups['g'] = sorted(values)[:8]
+	check(db.aggregate('g', 'aal', 'BOLD.BC'), np.array([values[scan] for scan in groups['g']]))
+	assert reads == ['scan6', 'scan7'], reads
+	# a feature saved again is read again
+	values['scan1'] = values['scan1'] + 1
+	db.mdb.versions['scan1'] = 'v2'
+	del reads[:]
+	check(db.aggregate('g', 'aal', 'BOLD.BC'), np.array([values[scan] for scan in groups['g']]))
+	assert len(reads) == 8
+
+def MixedLengthTest():
+	"""
+	Dynamic features of 20 and 30 slices cannot be aggregated, the error names the scan and nothing is saved
+	"""
+	rand = np.random.RandomState(1)
+	values = dict(('scan%d' % i, rand.rand(5, 30 if i == 5 else 20)) for i in range(8))
+	groups = dict(g = sorted(values))
+	db, reads = make_db(values, groups)
+	try:
+		db.aggregate('g', 'aal', 'BOLD.BC', window_length = 22, step_size = 1, batch_size = 3)
+	except Exception as e:
+		assert 'scan5' in str(e) and '(5, 30)' in str(e), e
+	else:
+		raise AssertionError('a group of mixed lengths was aggregated')
+	assert db.rdb.conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0] == 0
+	groups['g'] = [scan for scan in sorted(values) if scan != 'scan5']
+	check(db.aggregate('g', 'aal', 'BOLD.BC', window_length = 22, step_size = 1, batch_size = 3),
+		np.array([values[scan] for scan in groups['g']]))
+
+if __name__ == '__main__':
+	IncrementalTest()
+	MixedLengthTest()
+	print('aggregate: OK')
@@ -0,0 +1,67 @@
+"""lookup indexes
+
+Revision ID: 43f9ffaabd55
+Revises: 38611286ecd3
+Create Date: 2026-10-19 10:12:40.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '43f9ffaabd55'
+down_revision = '38611286ecd3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # scan and exam lookups
+    op.create_index('ix_mriscans_filename', 'mriscans', ['filename'], unique=True)
+    op.create_index('ix_mriscans_person_id', 'mriscans', ['person_id'])
+    op.create_index('ix_mriscans_mrimachine_id', 'mriscans', ['mrimachine_id'])
+    op.create_index('ix_eegscans_examid', 'eegscans', ['examid'], unique=True)
+    op.create_index('ix_eegscans_person_id', 'eegscans', ['person_id'])
+    op.create_index('ix_eegscans_eegmachine_id', 'eegscans', ['eegmachine_id'])
+    # person lookups, pinyin names may collide so name is not unique
+    op.create_index('ix_people_name', 'people', ['name'])
+    op.create_index('ix_people_name_chinese_eegid', 'people', ['name_chinese', 'eegid'], unique=True)
+    # machines, MRI machines were historically inserted once per scan
+    op.create_index('ix_eegmachines_devicename', 'eegmachines', ['devicename'], unique=True)
+    op.create_index('ix_mrimachines_model', 'mrimachines', ['institution', 'manufacturer', 'modelname'])
+    # groups and studies
+    op.create_index('ix_groups_name', 'groups', ['name'], unique=True)
+    op.create_index('ix_researchstudy_alias', 'researchstudy', ['alias'], unique=True)
+    # association tables, both directions
+    op.create_index('ix_association_group_mriscan_group_id', 'association_group_mriscan', ['group_id', 'scan_id'])
+    op.create_index('ix_association_group_mriscan_scan_id', 'association_group_mriscan', ['scan_id'])
+    op.create_index('ix_association_group_eegscan_group_id', 'association_group_eegscan', ['group_id', 'scan_id'])
+    op.create_index('ix_association_group_eegscan_scan_id', 'association_group_eegscan', ['scan_id'])
+    op.create_index('ix_association_group_person_group_id', 'association_group_person', ['group_id', 'person_id'])
+    op.create_index('ix_association_group_person_person_id', 'association_group_person', ['person_id'])
+    op.create_index('ix_association_group_study_study_id', 'association_group_study', ['study_id', 'group_id'])
+    op.create_index('ix_association_group_study_group_id', 'association_group_study', ['group_id'])
+
+
+def downgrade():
+    op.drop_index('ix_association_group_study_group_id', table_name='association_group_study')
+    op.drop_index('ix_association_group_study_study_id', table_name='association_group_study')
+    op.drop_index('ix_association_group_person_person_id', table_name='association_group_person')
+    op.drop_index('ix_association_group_person_group_id', table_name='association_group_person')
+    op.drop_index('ix_association_group_eegscan_scan_id', table_name='association_group_eegscan')
+    op.drop_index('ix_association_group_eegscan_group_id', table_name='association_group_eegscan')
+    op.drop_index('ix_association_group_mriscan_scan_id', table_name='association_group_mriscan')
+    op.drop_index('ix_association_group_mriscan_group_id', table_name='association_group_mriscan')
+    op.drop_index('ix_researchstudy_alias', table_name='researchstudy')
+    op.drop_index('ix_groups_name', table_name='groups')
+    op.drop_index('ix_mrimachines_model', table_name='mrimachines')
+    op.drop_index('ix_eegmachines_devicename', table_name='eegmachines')
+    op.drop_index('ix_people_name_chinese_eegid', table_name='people')
+    op.drop_index('ix_people_name', table_name='people')
+    op.drop_index('ix_eegscans_eegmachine_id', table_name='eegscans')
+    op.drop_index('ix_eegscans_person_id', table_name='eegscans')
+    op.drop_index('ix_eegscans_examid', table_name='eegscans')
+    op.drop_index('ix_mriscans_mrimachine_id', table_name='mriscans')
+    op.drop_index('ix_mriscans_person_id', table_name='mriscans')
+    op.drop_index('ix_mriscans_filename', table_name='mriscans')
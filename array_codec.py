@@ -0,0 +1,124 @@
+# coding=utf-8
+"""
+Binary array codec shared by the Redis and MongoDB stores.
+
+Numeric series are stored as a fixed-size dtype tag followed by the
+raw little-endian elements, so that appending is a plain byte append
+and a slice of elements maps directly to a byte range.
+
+Whole ndarrays are stored with a small header recording dtype and
+shape, and decode as zero-copy views on the stored buffer.
+"""
+import struct
+
+import numpy as np
+
+SERIES_MAGIC = b'#'
+SERIES_HEADER_SIZE = 8
+
+def series_dtype(value):
+	"""
+	Return the dtype a numeric series should be stored with.
+	Integers are kept as int64, everything else numeric as float64.
+	"""
+	arr = np.asarray(value)
+	if arr.dtype.kind in 'iu':
+		return np.dtype('<i8')
+	elif arr.dtype.kind == 'f':
+		return np.dtype('<f8')
+	else:
+		raise Exception('Series items must be int or float, got dtype %s' % arr.dtype)
+
+def series_header(dtype):
+	"""
+	Return the fixed-size header tagging a packed series with its dtype.
+	"""
+	tag = np.dtype(dtype).str.encode('ascii')
+	return SERIES_MAGIC + tag.ljust(SERIES_HEADER_SIZE - len(SERIES_MAGIC), b' ')
+
+def parse_series_header(header):
+	"""
+	Return the dtype recorded in a packed series header.
+	"""
+	if len(header) < SERIES_HEADER_SIZE or header[:len(SERIES_MAGIC)] != SERIES_MAGIC:
+		raise Exception('Not a packed series: %r' % header[:SERIES_HEADER_SIZE])
+	return np.dtype(header[len(SERIES_MAGIC):SERIES_HEADER_SIZE].strip().decode('ascii'))
+
+def pack_series_items(value, dtype):
+	"""
+	Return the raw bytes of value cast to dtype, without a header.
+	"""
+	arr = np.asarray(value)
+	dtype = np.dtype(dtype)
+	if arr.dtype.kind == 'f' and dtype.kind in 'iu':
+		raise Exception('Cannot store float items in an integer series')
+	return np.ascontiguousarray(arr, dtype=dtype).reshape(-1).tobytes()
+
+def pack_series(value, dtype=None):
+	"""
+	Return a packed series (header and items) for a 1-D list or ndarray.
+	"""
+	if dtype is None:
+		dtype = series_dtype(value)
+	return series_header(dtype) + pack_series_items(value, dtype)
+
+def unpack_series(buf):
+	"""
+	Return the ndarray held in a packed series buffer.
+	"""
+	dtype = parse_series_header(buf)
+	return np.frombuffer(buf, dtype=dtype, offset=SERIES_HEADER_SIZE)
+
+def series_byte_range(dtype, start, end):
+	"""
+	Map an inclusive element range (Redis LRANGE semantics, end may be
+	negative) to an inclusive byte range of a packed series.
+	Negative start indices are not supported here, callers should slice.
+	"""
+	itemsize = np.dtype(dtype).itemsize
+	byte_start = SERIES_HEADER_SIZE + start * itemsize
+	if end < 0:
+		byte_end = (end + 1) * itemsize - 1
+	else:
+		byte_end = SERIES_HEADER_SIZE + (end + 1) * itemsize - 1
+	return byte_start, byte_end
+
+ARRAY_MAGIC = b'#A'
+
+def pack_array(value):
+	"""
+	Return a self-describing binary buffer (dtype, shape, C-order items) for an ndarray.
+	"""
+	arr = np.ascontiguousarray(value)
+	if arr.dtype.hasobject:
+		raise Exception('Cannot pack an object array')
+	tag = arr.dtype.str.encode('ascii')
+	header = ARRAY_MAGIC + struct.pack('<B', len(tag)) + tag + struct.pack('<B%dQ' % arr.ndim, arr.ndim, *arr.shape)
+	return header + arr.tobytes()
+
+def array_header(buf, offset = 0):
+	"""
+	Parse the header of a packed array.
+	Return (dtype, shape, offset of the first item).
+	"""
+	if bytes(buf[offset:offset + len(ARRAY_MAGIC)]) != ARRAY_MAGIC:
+		raise Exception('Not a packed array')
+	pos = offset + len(ARRAY_MAGIC)
+	taglen = buf[pos]
+	dtype = np.dtype(bytes(buf[pos + 1:pos + 1 + taglen]).decode('ascii'))
+	pos += 1 + taglen
+	ndim = buf[pos]
+	shape = struct.unpack_from('<%dQ' % ndim, buf, pos + 1)
+	return dtype, shape, pos + 1 + 8 * ndim
+
+def is_packed_array(buf):
+	return bytes(buf[:len(ARRAY_MAGIC)]) == ARRAY_MAGIC
+
+def unpack_array(buf, offset = 0):
+	"""
+	Return the ndarray held in a packed array buffer.
+	The result is a read-only view on buf, no copy is made.
+	"""
+	dtype, shape, pos = array_header(buf, offset)
+	count = int(np.prod(shape, dtype=np.int64))
+	return np.frombuffer(buf, dtype=dtype, count=count, offset=pos).reshape(shape)
@@ -0,0 +1,145 @@
+# coding=utf-8
+"""
+Counters and latency histograms of the MMDPDatabase tiers.
+
+Counters (hits, misses, bytes, round_trips) are kept per tier, latency
+histograms per stage (redis_get, mongo_find, decode, netattr, ...), and
+both are labelled with data source, atlas and feature.
+When disabled every call returns right away, so the stores can always
+record into a Stats object.
+"""
+import time
+import threading
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _NullTimer:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer:
+	def __init__(self, stats, stage, labels):
+		self.stats = stats
+		self.stage = stage
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		self.stats.observe(self.stage, self.labels, time.perf_counter() - self.start)
+		return False
+
+class Stats:
+	"""
+	labels are (data_source, atlas, feature) tuples.
+	"""
+
+	def __init__(self, enabled = False):
+		self.enabled = enabled
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			# (name, tier) + labels -> value
+			self.counters = {}
+			# stage + labels -> [bucket counts..., overflow count, sum, count]
+			self.histograms = {}
+
+	def incr(self, name, tier, labels, value = 1):
+		if not self.enabled:
+			return
+		key = (name, tier) + labels
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def hit(self, tier, labels, nbytes = 0):
+		if not self.enabled:
+			return
+		self.incr('hits', tier, labels)
+		self.incr('bytes', tier, labels, nbytes)
+
+	def miss(self, tier, labels):
+		self.incr('misses', tier, labels)
+
+	def observe(self, stage, labels, seconds):
+		if not self.enabled:
+			return
+		key = (stage,) + labels
+		with self.lock:
+			hist = self.histograms.get(key)
+			if hist is None:
+				hist = self.histograms[key] = [0] * (len(BUCKETS) + 3)
+			for i, bound in enumerate(BUCKETS):
+				if seconds <= bound:
+					hist[i] += 1
+					break
+			else:
+				hist[len(BUCKETS)] += 1
+			hist[-2] += seconds
+			hist[-1] += 1
+
+	def timer(self, stage, labels):
+		"""
+		Context manager adding the time spent in its body to the stage histogram.
+		"""
+		if not self.enabled:
+			return _NULL_TIMER
+		return _Timer(self, stage, labels)
+
+	def snapshot(self):
+		"""
+		Return a copy of all counters and histograms as plain dicts:
+			{'counters': {(name, tier, data_source, atlas, feature): value},
+			 'latency': {(stage, data_source, atlas, feature): {'count', 'sum', 'buckets'}}}
+		"""
+		with self.lock:
+			counters = dict(self.counters)
+			latency = {}
+			for key, hist in self.histograms.items():
+				latency[key] = dict(count = hist[-1], sum = hist[-2],
+					buckets = dict(zip(BUCKETS + (float('inf'),), _cumulative(hist[:-2]))))
+		return dict(counters = counters, latency = latency)
+
+	def prometheus(self, prefix = 'mmdpdb'):
+		"""
+		Return all counters and histograms in the Prometheus text exposition format.
+		"""
+		snap = self.snapshot()
+		lines = []
+		names = sorted(set(key[0] for key in snap['counters']))
+		for name in names:
+			metric = '%s_%s_total' % (prefix, name)
+			lines.append('# TYPE %s counter' % metric)
+			for key, value in sorted(snap['counters'].items()):
+				if key[0] == name:
+					lines.append('%s{%s} %s' % (metric, _labels(tier = key[1], data_source = key[2], atlas = key[3], feature = key[4]), value))
+		if snap['latency']:
+			metric = '%s_latency_seconds' % prefix
+			lines.append('# TYPE %s histogram' % metric)
+			for key, hist in sorted(snap['latency'].items()):
+				labels = dict(stage = key[0], data_source = key[1], atlas = key[2], feature = key[3])
+				for bound, count in hist['buckets'].items():
+					le = '+Inf' if bound == float('inf') else repr(bound)
+					lines.append('%s_bucket{%s} %d' % (metric, _labels(le = le, **labels), count))
+				lines.append('%s_sum{%s} %r' % (metric, _labels(**labels), hist['sum']))
+				lines.append('%s_count{%s} %d' % (metric, _labels(**labels), hist['count']))
+		return '\n'.join(lines) + '\n'
+
+def _cumulative(counts):
+	total = 0
+	ret = []
+	for count in counts:
+		total += count
+		ret.append(total)
+	return ret
+
+def _labels(**labels):
+	return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.items()))
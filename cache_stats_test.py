@@ -0,0 +1,97 @@
+"""
+Check of the tier counters, latency histograms and Prometheus export of cache_stats.
+Runs without Redis or MongoDB.
+"""
+import threading
+import cache_stats
+
+LABELS = ('Changgung', 'brodmann_lr', 'BOLD.net')
+
+def DisabledTest():
+	"""
+	A disabled Stats records nothing
+	"""
+	stats = cache_stats.Stats()
+	stats.hit('redis', LABELS, 100)
+	stats.miss('redis', LABELS)
+	stats.observe('redis_get', LABELS, 0.01)
+	with stats.timer('decode', LABELS):
+		pass
+	snap = stats.snapshot()
+	assert snap == dict(counters = {}, latency = {}), snap
+	assert stats.prometheus() == '\n'
+
+def CounterTest(thread_num = 8, count = 1000):
+	"""
+	Hits, misses and bytes per tier and labels, also from several threads
+	"""
+	stats = cache_stats.Stats(enabled = True)
+	def work():
+		for i in range(count):
+			stats.hit('redis', LABELS, 10)
+	threads = [threading.Thread(target = work) for i in range(thread_num)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	stats.miss('mongo', LABELS)
+	stats.incr('round_trips', 'redis', LABELS, 3)
+	counters = stats.snapshot()['counters']
+	assert counters[('hits', 'redis') + LABELS] == thread_num * count
+	assert counters[('bytes', 'redis') + LABELS] == thread_num * count * 10
+	assert counters[('misses', 'mongo') + LABELS] == 1
+	assert counters[('round_trips', 'redis') + LABELS] == 3
+	stats.reset()
+	assert stats.snapshot()['counters'] == {}
+
+def HistogramTest():
+	"""
+	Observations land in the first bucket they fit, buckets are cumulative in snapshots
+	"""
+	stats = cache_stats.Stats(enabled = True)
+	for seconds in [0.0001, 0.0005, 0.003, 0.3, 100.0]:
+		stats.observe('mongo_find', LABELS, seconds)
+	with stats.timer('decode', LABELS):
+		pass
+	latency = stats.snapshot()['latency']
+	hist = latency[('mongo_find',) + LABELS]
+	assert hist['count'] == 5
+	assert abs(hist['sum'] - 100.3036) < 1e-9
+	buckets = hist['buckets']
+	assert buckets[0.0005] == 2
+	assert buckets[0.0025] == 2
+	assert buckets[0.005] == 3
+	assert buckets[0.5] == 4
+	assert buckets[10.0] == 4
+	assert buckets[float('inf')] == 5
+	assert list(buckets.values()) == sorted(buckets.values())
+	assert latency[('decode',) + LABELS]['count'] == 1
+
+def PrometheusTest():
+	"""
+	Text exposition: one TYPE line per metric, escaped labels, _bucket/_sum/_count series
+	"""
+	stats = cache_stats.Stats(enabled = True)
+	stats.hit('redis', LABELS, 5)
+	stats.miss('redis', ('Changgung', 'aal', 'say "hi"\\'))
+	stats.observe('redis_get', LABELS, 0.002)
+	lines = stats.prometheus().splitlines()
+	assert lines.count('# TYPE mmdpdb_hits_total counter') == 1
+	assert lines.count('# TYPE mmdpdb_latency_seconds histogram') == 1
+	assert 'mmdpdb_hits_total{atlas="brodmann_lr",data_source="Changgung",feature="BOLD.net",tier="redis"} 1' in lines
+	assert 'mmdpdb_bytes_total{atlas="brodmann_lr",data_source="Changgung",feature="BOLD.net",tier="redis"} 5' in lines
+	assert 'mmdpdb_misses_total{atlas="aal",data_source="Changgung",feature="say \\"hi\\"\\\\",tier="redis"} 1' in lines
+	labels = 'atlas="brodmann_lr",data_source="Changgung",feature="BOLD.net"'
+	assert 'mmdpdb_latency_seconds_bucket{%s,le="0.001",stage="redis_get"} 0' % labels in lines
+	assert 'mmdpdb_latency_seconds_bucket{%s,le="0.0025",stage="redis_get"} 1' % labels in lines
+	assert 'mmdpdb_latency_seconds_bucket{%s,le="+Inf",stage="redis_get"} 1' % labels in lines
+	assert 'mmdpdb_latency_seconds_count{%s,stage="redis_get"} 1' % labels in lines
+	assert 'mmdpdb_latency_seconds_sum{%s,stage="redis_get"} 0.002' % labels in lines
+	print(stats.prometheus())
+
+if __name__ == '__main__':
+	DisabledTest()
+	CounterTest()
+	HistogramTest()
+	PrometheusTest()
+	print('cache_stats: OK')
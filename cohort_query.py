@@ -0,0 +1,195 @@
+# coding=utf-8
+"""
+Cohort selection compiled to a single SQL statement.
+
+	cohort = sdb.cohort('mri').gender('F').age(50, 70).modalities(hasBOLD = True, hasDWI = True) \
+		.machine(modelname = 'DISCOVERY MR750').date(after = datetime.datetime(2019, 1, 1))
+	scans = cohort.scans()
+	mmdpdb.get_feature(scans, atlasobj, 'BOLD.net')
+
+Every filter adds a WHERE clause; the Nth scan per person is ranked with a
+window function in a subquery, so scans() is always one SELECT.
+"""
+from sqlalchemy import or_, func, text
+
+from mmdps.dms import tables
+
+def scan_rank(scans, scanNum = 1):
+	"""
+	Rank of each scan among the scans of its person, by filename (name_date for MRI
+	scans) or exam id. CohortQuery.nth_scan and SQLiteDB.nth_mriscans (used by
+	newGroupByNames_forMRI) both rank with it, so 'the Nth scan' is the same scan everywhere.
+	For scanNum <= 0 the scans are ranked from the latest, see rank_condition.
+	"""
+	name = scans.c.filename if 'filename' in scans.c else scans.c.examid
+	return func.row_number().over(partition_by = scans.c.person_id, order_by = name if scanNum > 0 else name.desc())
+
+def rank_condition(rank, scanNum, accumulateScan = False):
+	"""
+	Condition on a scan_rank(scans, scanNum) column keeping the scanNum-th scan of each person,
+	or all scans up to it if accumulateScan. As in Python indexing 0 is the latest scan,
+	-1 the one before and so on.
+	"""
+	if scanNum > 0:
+		return rank <= scanNum if accumulateScan else rank == scanNum
+	return rank >= 1 - scanNum if accumulateScan else rank == 1 - scanNum
+
+class CohortQuery:
+	"""
+	Chainable filters over MRI scans (kind 'mri') or EEG exams (kind 'eeg').
+	"""
+
+	def __init__(self, session, kind = 'mri'):
+		if kind not in ('mri', 'eeg'):
+			raise Exception("kind must be 'mri' or 'eeg'")
+		self.session = session
+		self.kind = kind
+		self.scan_table = tables.MRIScan.__table__ if kind == 'mri' else tables.EEGScan.__table__
+		self.person_table = tables.Person.__table__
+		self.machine_table = tables.MRIMachine.__table__ if kind == 'mri' else tables.EEGMachine.__table__
+		self.assoc = tables.Base.metadata.tables['association_group_mriscan' if kind == 'mri' else 'association_group_eegscan']
+		self.conditions = []
+		self.nth = None
+		self.accumulate = False
+
+	def where(self, condition):
+		"""
+		Add a condition on columns of the scan, person or machine tables
+		"""
+		self.conditions.append(condition)
+		return self
+
+	def gender(self, *genders):
+		return self.where(self.person_table.c.gender.in_(genders))
+
+	def names(self, names):
+		"""
+		Pinyin names for MRI scans, Chinese names for EEG exams
+		"""
+		column = self.person_table.c.name if self.kind == 'mri' else self.person_table.c.name_chinese
+		return self.where(column.in_(list(names)))
+
+	def age(self, min_age = None, max_age = None):
+		"""
+		Age in years at the scan date, both bounds inclusive
+		"""
+		age = (func.julianday(self.scan_table.c.date) - func.julianday(self.person_table.c.birth)) / 365.25
+		if min_age is not None:
+			self.where(age >= min_age)
+		if max_age is not None:
+			self.where(age < max_age + 1)
+		return self
+
+	def birth(self, after = None, before = None):
+		if after is not None:
+			self.where(self.person_table.c.birth >= after)
+		if before is not None:
+			self.where(self.person_table.c.birth < before)
+		return self
+
+	def date(self, after = None, before = None):
+		"""
+		Scan date in [after, before)
+		"""
+		if after is not None:
+			self.where(self.scan_table.c.date >= after)
+		if before is not None:
+			self.where(self.scan_table.c.date < before)
+		return self
+
+	def modalities(self, **flags):
+		"""
+		hasT1, hasT2, hasBOLD and hasDWI flags of MRI scans, e.g. modalities(hasBOLD = True)
+		"""
+		if self.kind != 'mri':
+			raise Exception('Modalities only apply to MRI scans')
+		for key, value in flags.items():
+			if key not in ('hasT1', 'hasT2', 'hasBOLD', 'hasDWI'):
+				raise Exception('Unknown modality %s' % key)
+			column = self.scan_table.c[key]
+			self.where(column == 1 if value else or_(column == 0, column.is_(None)))
+		return self
+
+	def machine(self, **fields):
+		"""
+		Machine columns, institution/manufacturer/modelname for MRI, devicename/devicemode/... for EEG.
+		A list value matches any of its items.
+		"""
+		for key, value in fields.items():
+			if key not in self.machine_table.c or key == 'id':
+				raise Exception('Unknown machine field %s' % key)
+			column = self.machine_table.c[key]
+			self.where(column.in_(value) if isinstance(value, (list, tuple, set)) else column == value)
+		return self
+
+	def in_group(self, *groupNames):
+		"""
+		Keep scans belonging to any of the groups
+		"""
+		groups = tables.Group.__table__
+		members = self.session.query(self.assoc.c.scan_id).select_from(self.assoc) \
+			.join(groups, groups.c.id == self.assoc.c.group_id).filter(groups.c.name.in_(groupNames))
+		return self.where(self.scan_table.c.id.in_(members))
+
+	def in_study(self, *aliases):
+		"""
+		Keep scans belonging to any group of the research studies
+		"""
+		studies = tables.ResearchStudy.__table__
+		study_assoc = tables.Base.metadata.tables['association_group_study']
+		members = self.session.query(self.assoc.c.scan_id).select_from(self.assoc) \
+			.join(study_assoc, study_assoc.c.group_id == self.assoc.c.group_id) \
+			.join(studies, studies.c.id == study_assoc.c.study_id).filter(studies.c.alias.in_(aliases))
+		return self.where(self.scan_table.c.id.in_(members))
+
+	def nth_scan(self, scanNum, accumulateScan = False):
+		"""
+		Keep the scanNum-th scan of each person (0 the latest, -1 the one before), or all scans
+		up to it if accumulateScan, counted over all scans of the person ranked by scan_rank,
+		before the other filters apply.
+		"""
+		self.nth = scanNum
+		self.accumulate = accumulateScan
+		return self
+
+	def statement(self, columns = None):
+		"""
+		Return the SELECT of the cohort. columns default to the filename or exam id.
+		"""
+		scans = self.scan_table
+		name = scans.c.filename if self.kind == 'mri' else scans.c.examid
+		machine_id = scans.c.mrimachine_id if self.kind == 'mri' else scans.c.eegmachine_id
+		if columns is None:
+			columns = [name]
+		conditions = list(self.conditions)
+		if self.nth is not None:
+			ranked = self.session.query(scans.c.id, scan_rank(scans, self.nth).label('rank')).subquery('ranked')
+			conditions.append(scans.c.id.in_(self.session.query(ranked.c.id).filter(
+				rank_condition(ranked.c.rank, self.nth, self.accumulate))))
+		return self.session.query(*columns).select_from(scans) \
+			.outerjoin(self.person_table, self.person_table.c.id == scans.c.person_id) \
+			.outerjoin(self.machine_table, self.machine_table.c.id == machine_id) \
+			.filter(*conditions).order_by(name)
+
+	def scans(self):
+		"""
+		Return the list of scan filenames (MRI) or exam ids (EEG), ready for get_feature
+		"""
+		return [name for (name,) in self.statement()]
+
+	def count(self):
+		return self.statement().count()
+
+	def sql(self):
+		"""
+		Return the generated SQL with parameters inlined
+		"""
+		return str(self.statement().statement.compile(self.session.bind, compile_kwargs = {'literal_binds': True}))
+
+	def explain(self):
+		"""
+		Return the generated SQL and its EXPLAIN QUERY PLAN lines
+		"""
+		sql = self.sql()
+		plan = self.session.execute(text('EXPLAIN QUERY PLAN ' + sql)).fetchall()
+		return sql, [row[-1] for row in plan]
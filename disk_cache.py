@@ -0,0 +1,434 @@
+# coding=utf-8
+"""
+Disk cache is a local substitute for Redis on nodes without a redis-server.
+It has the same interface as RedisDatabase.
+
+Feature arrays are appended to fixed-size segment files and located
+through an index kept in a SQLite database next to them. Reads return
+np.memmap views on the segment files, so no copy is made and several
+processes share the pages through the page cache.
+SQLite transactions serialize writers across processes, WAL journaling
+keeps readers from blocking. When the segments grow beyond max_bytes
+the oldest segments are dropped as a whole.
+"""
+import os
+import time
+import json
+import pickle
+import sqlite3
+import numpy as np
+import array_codec, hash_store, redis_database, cache_stats
+from mmdps.proc import netattr
+
+ALIGNMENT = 64
+
+SCHEMA = [
+	'CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, size INTEGER NOT NULL)',
+	'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, segment INTEGER NOT NULL, offset INTEGER NOT NULL, '
+		'dtype TEXT NOT NULL, shape TEXT NOT NULL, expire REAL)',
+	'CREATE INDEX IF NOT EXISTS ix_entries_segment ON entries (segment)',
+	'CREATE TABLE IF NOT EXISTS series (key TEXT PRIMARY KEY, value BLOB NOT NULL)',
+	'CREATE TABLE IF NOT EXISTS hashes (name TEXT NOT NULL, field TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (name, field))',
+	'CREATE TABLE IF NOT EXISTS hash_expire (name TEXT PRIMARY KEY, expire REAL NOT NULL)',
+]
+
+class DiskCacheDatabase:
+	"""
+	Memory-mapped on-disk cache with the interface of RedisDatabase.
+	"""
+
+	def __init__(self, cache_dir = None, expire_time = 1800, max_bytes = 10 * 1024 ** 3, segment_size = 256 * 1024 ** 2, stats = None):
+		self.stats = stats if stats is not None else cache_stats.Stats()
+		if cache_dir is None:
+			cache_dir = os.path.join(os.path.expanduser('~'), '.mmdpdb_cache')
+		self.cache_dir = cache_dir
+		self.expire_time = max(expire_time, 1800)
+		self.max_bytes = max_bytes
+		self.segment_size = segment_size
+		os.makedirs(self.cache_dir, exist_ok = True)
+		self.index_path = os.path.join(self.cache_dir, 'index.db')
+		self.conn_pid = None
+		with self.transaction() as conn:
+			for statement in SCHEMA:
+				conn.execute(statement)
+
+	@property
+	def conn(self):
+		# sqlite connections must not cross fork(), open one per process
+		if self.conn_pid != os.getpid():
+			self._conn = sqlite3.connect(self.index_path, timeout = 60, isolation_level = None, check_same_thread = False)
+			self._conn.execute('PRAGMA journal_mode=WAL')
+			self._conn.execute('PRAGMA synchronous=NORMAL')
+			self.conn_pid = os.getpid()
+		return self._conn
+
+	def transaction(self):
+		return _Transaction(self.conn)
+
+	def segment_path(self, segment):
+		return os.path.join(self.cache_dir, 'seg-%08d.bin' % segment)
+
+	# the key layout and netattr construction are shared with RedisDatabase
+	generate_key_tag = redis_database.RedisDatabase.generate_key_tag
+	generate_static_key = redis_database.RedisDatabase.generate_static_key
+	generate_dynamic_key = redis_database.RedisDatabase.generate_dynamic_key
+	trans_netattr = redis_database.RedisDatabase.trans_netattr
+	trans_dynamic_netattr = redis_database.RedisDatabase.trans_dynamic_netattr
+	generate_eeg_key = redis_database.RedisDatabase.generate_eeg_key
+	generate_eeg_group_key = redis_database.RedisDatabase.generate_eeg_group_key
+
+	def is_redis_running(self):
+		return False
+
+	def start_redis(self, password = ''):
+		pass
+
+	def stop_redis(self):
+		pass
+
+	def put_array(self, key, value, ttl):
+		"""
+		Append an ndarray to the active segment and point key at it.
+		"""
+		value = np.ascontiguousarray(value)
+		evicted = []
+		with self.transaction() as conn:
+			row = conn.execute('SELECT id, size FROM segments ORDER BY id DESC LIMIT 1').fetchone()
+			if row is None or (row[1] > 0 and row[1] + value.nbytes > self.segment_size):
+				segment = 1 if row is None else row[0] + 1
+				offset = 0
+				conn.execute('INSERT INTO segments (id, size) VALUES (?, 0)', (segment,))
+			else:
+				segment = row[0]
+				offset = -(-row[1] // ALIGNMENT) * ALIGNMENT
+			path = self.segment_path(segment)
+			with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+				f.seek(offset)
+				f.write(value.tobytes())
+			conn.execute('UPDATE segments SET size = ? WHERE id = ?', (offset + value.nbytes, segment))
+			conn.execute('INSERT OR REPLACE INTO entries (key, segment, offset, dtype, shape, expire) VALUES (?, ?, ?, ?, ?, ?)',
+				(key, segment, offset, value.dtype.str, json.dumps(value.shape), time.time() + ttl))
+			evicted = self.evict(conn, segment)
+		for segment in evicted:
+			try:
+				os.remove(self.segment_path(segment))
+			except OSError:
+				# still mapped by a reader on Windows, leave it behind
+				pass
+
+	def evict(self, conn, active):
+		"""
+		Drop the oldest segments until the cache fits in max_bytes.
+		Return the dropped segment ids, their files are removed after commit.
+		"""
+		total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM segments').fetchone()[0]
+		evicted = []
+		for segment, size in conn.execute('SELECT id, size FROM segments WHERE id != ? ORDER BY id', (active,)).fetchall():
+			if total <= self.max_bytes:
+				break
+			conn.execute('DELETE FROM entries WHERE segment = ?', (segment,))
+			conn.execute('DELETE FROM segments WHERE id = ?', (segment,))
+			total -= size
+			evicted.append(segment)
+		return evicted
+
+	def get_array(self, key):
+		"""
+		Return a read-only np.memmap of the array stored with key, or None.
+		Reading refreshes the expiration time like RedisDatabase does.
+		"""
+		row = self.conn.execute('SELECT segment, offset, dtype, shape, expire FROM entries WHERE key = ?', (key,)).fetchone()
+		if row is None:
+			return None
+		segment, offset, dtype, shape, expire = row
+		now = time.time()
+		if expire is not None and expire < now:
+			return None
+		try:
+			value = np.memmap(self.segment_path(segment), dtype = np.dtype(dtype), mode = 'r', offset = offset, shape = tuple(json.loads(shape)))
+		except (OSError, ValueError):
+			# the segment has just been evicted
+			return None
+		if expire is not None and expire - now < self.expire_time / 2:
+			with self.transaction() as conn:
+				conn.execute('UPDATE entries SET expire = ? WHERE key = ?', (now + self.expire_time, key))
+		return value
+
+	def set_value(self, obj, data_source, atlas, feature, window_length=0, step_size=0):
+		"""
+		Using a dictionary, a Mongdb object, a Net class, a Attr class, a DynamicNet class or a DynamicAttr class
+			to set a new entry in the disk cache.
+		"""
+		if type(obj) is dict:
+			key = self.generate_static_key(data_source, obj['scan'], atlas, feature, obj['comment'])
+			value = pickle.loads(obj['value'])
+			self.put_array(key, value, self.expire_time)
+			return self.trans_netattr(obj['scan'], atlas, feature, value)
+		elif type(obj) is list:
+			scan = obj[0]['scan']
+			key_all = self.generate_dynamic_key(data_source, scan, atlas, feature, window_length, step_size, obj[0]['comment'])
+			value = hash_store.assemble_slices([doc['value'] for doc in obj])
+			self.put_array(key_all, value, self.expire_time)
+			return self.trans_dynamic_netattr(scan, atlas, feature, window_length, step_size, value)
+		elif type(obj) is netattr.Net or type(obj) is netattr.Attr:
+			key = self.generate_static_key(data_source, obj.scan, obj.atlasobj.name, obj.feature_name, {})
+			self.put_array(key, obj.data, self.expire_time)
+		elif type(obj) is netattr.DynamicNet or type(obj) is netattr.DynamicAttr:
+			key_all = self.generate_dynamic_key(data_source, obj.scan, obj.atlasobj.name, obj.feature_name, obj.window_length, obj.step_size, {})
+			# slices first, as stored by RedisDatabase
+			self.put_array(key_all, np.moveaxis(obj.data, -1, 0), self.expire_time)
+
+	def get_static_value(self, data_source, subject_scan, atlas_name, feature_name, comment = {}):
+		"""
+		Using data source, scan name, altasobj name, feature name to query static networks and attributes.
+		If the query succeeds, return a Net or Attr class backed by np.memmap, if not, return none.
+		"""
+		labels = (data_source, atlas_name, feature_name)
+		with self.stats.timer('disk_get', labels):
+			value = self.get_array(self.generate_static_key(data_source, subject_scan, atlas_name, feature_name, comment))
+		if value is None:
+			self.stats.miss('disk', labels)
+			return None
+		self.stats.hit('disk', labels, value.nbytes)
+		with self.stats.timer('netattr', labels):
+			return self.trans_netattr(subject_scan, atlas_name, feature_name, value)
+
+	def get_static_values(self, data_source, scan_list, atlas_name, feature_name, comment = {}):
+		return [self.get_static_value(data_source, scan, atlas_name, feature_name, comment) for scan in scan_list]
+
+	def get_dynamic_value(self, data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment = {}):
+		"""
+		Using data source, scan name, altasobj name, feature name, window length, step size to query dynamic
+			networks and attributes.
+		If the query succeeds, return a DynamicNet or DynamicAttr class backed by np.memmap, if not, return none.
+		"""
+		labels = (data_source, atlas_name, feature_name)
+		with self.stats.timer('disk_get', labels):
+			value = self.get_array(self.generate_dynamic_key(data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment))
+		if value is None:
+			self.stats.miss('disk', labels)
+			return None
+		self.stats.hit('disk', labels, value.nbytes)
+		with self.stats.timer('netattr', labels):
+			return self.trans_dynamic_netattr(subject_scan, atlas_name, feature_name, window_length, step_size, value)
+
+	def get_dynamic_values(self, data_source, scan_list, atlas_name, feature_name, window_length, step_size, comment = {}):
+		return [self.get_dynamic_value(data_source, scan, atlas_name, feature_name, window_length, step_size, comment) for scan in scan_list]
+
+	def set_eeg_values(self, data_source, mat, field, values):
+		"""
+		Store a dict of examid -> EEG feature array.
+		"""
+		for examid, value in values.items():
+			value = np.asarray(value)
+			# struct and cell arrays cannot be memory-mapped, they are read from mongo every time
+			if not value.dtype.hasobject:
+				self.put_array(self.generate_eeg_key(data_source, examid, mat, field), value, self.expire_time)
+
+	def get_eeg_values(self, data_source, examids, mat, field):
+		"""
+		Return a list of np.memmap EEG feature arrays in the order of examids, with None for missing entries.
+		"""
+		labels = (data_source, 'EEG', mat)
+		ret = []
+		for examid in examids:
+			with self.stats.timer('disk_get', labels):
+				value = self.get_array(self.generate_eeg_key(data_source, examid, mat, field))
+			if value is None:
+				self.stats.miss('disk', labels)
+			else:
+				self.stats.hit('disk', labels, value.nbytes)
+			ret.append(value)
+		return ret
+
+	def set_eeg_group_value(self, data_source, examids, mat, field, value, present):
+		"""
+		Store the matrix of an EEG feature of a list of exams and its present mask.
+		"""
+		key = self.generate_eeg_group_key(data_source, examids, mat, field)
+		self.put_array(key + ':present', np.asarray(present, dtype = bool), self.expire_time)
+		self.put_array(key, value, self.expire_time)
+
+	def get_eeg_group_value(self, data_source, examids, mat, field):
+		"""
+		Return (np.memmap matrix, present mask) of a list of exams, or None.
+		"""
+		labels = (data_source, 'EEG', mat)
+		key = self.generate_eeg_group_key(data_source, examids, mat, field)
+		with self.stats.timer('disk_get', labels):
+			value = self.get_array(key)
+			present = self.get_array(key + ':present')
+		if value is None or present is None:
+			self.stats.miss('disk', labels)
+			return None
+		self.stats.hit('disk', labels, value.nbytes)
+		return value, present
+
+	def exists_key(self,data_source, subject_scan, atlas_name, feature_name, isdynamic = False, window_length = 0, step_size = 0, comment ={}):
+		if isdynamic is False:
+			key = self.generate_static_key(data_source, subject_scan, atlas_name, feature_name, comment)
+		else:
+			key = self.generate_dynamic_key(data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment)
+		row = self.conn.execute('SELECT expire FROM entries WHERE key = ?', (key,)).fetchone()
+		return row is not None and (row[0] is None or row[0] >= time.time())
+
+	def flushall(self):
+		"""
+		Delete everything in the disk cache.
+		"""
+		with self.transaction() as conn:
+			segments = [row[0] for row in conn.execute('SELECT id FROM segments').fetchall()]
+			for table in ['entries', 'segments', 'series', 'hashes', 'hash_expire']:
+				conn.execute('DELETE FROM ' + table)
+		for segment in segments:
+			try:
+				os.remove(self.segment_path(segment))
+			except OSError:
+				pass
+
+	"""
+	Numeric series, stored packed as in RedisDatabase.
+	"""
+
+	def get_series_dtype(self, key):
+		buf = self.get_list_buffer(key)
+		if buf is None:
+			return None
+		return array_codec.parse_series_header(buf)
+
+	def set_list_all_cache(self, key, value, dtype = None):
+		buf = array_codec.pack_series(value, dtype)
+		with self.transaction() as conn:
+			conn.execute('INSERT OR REPLACE INTO series (key, value) VALUES (?, ?)', (key, buf))
+		return len(array_codec.unpack_series(buf))
+
+	def set_list_cache(self, key, value):
+		with self.transaction() as conn:
+			row = conn.execute('SELECT value FROM series WHERE key = ?', (key,)).fetchone()
+			if row is None:
+				buf = array_codec.pack_series(np.atleast_1d(value))
+			else:
+				buf = row[0] + array_codec.pack_series_items(value, array_codec.parse_series_header(row[0]))
+			conn.execute('INSERT OR REPLACE INTO series (key, value) VALUES (?, ?)', (key, buf))
+		return len(array_codec.unpack_series(buf))
+
+	def get_list_cache(self, key, start = 0, end = -1):
+		buf = self.get_list_buffer(key)
+		if buf is None:
+			return np.array([])
+		value = array_codec.unpack_series(buf)
+		return value[start:] if end == -1 else value[start:end + 1]
+
+	def get_list_buffer(self, key):
+		row = self.conn.execute('SELECT value FROM series WHERE key = ?', (key,)).fetchone()
+		return None if row is None else row[0]
+
+	def exists_key_cache(self, key):
+		return self.conn.execute('SELECT 1 FROM series WHERE key = ?', (key,)).fetchone() is not None
+
+	def delete_key_cache(self, key):
+		with self.transaction() as conn:
+			return conn.execute('DELETE FROM series WHERE key = ?', (key,)).rowcount
+
+	def clear_cache(self):
+		with self.transaction() as conn:
+			conn.execute('DELETE FROM series')
+
+	"""
+	Hashes, values encoded by hash_store.
+	"""
+
+	def hash_alive(self, name):
+		row = self.conn.execute('SELECT expire FROM hash_expire WHERE name = ?', (name,)).fetchone()
+		if row is not None and row[0] < time.time():
+			self.delete_hash(name)
+			return False
+		return True
+
+	def set_hash_all(self, name, hash, ttl = None):
+		self.delete_hash(name)
+		self.set_hash(name, hash, ttl = ttl)
+
+	def set_hash(self, name, item1, item2 = '', ttl = None):
+		if type(item1) is not dict:
+			item1 = {item1: item2}
+		with self.transaction() as conn:
+			conn.executemany('INSERT OR REPLACE INTO hashes (name, field, value) VALUES (?, ?, ?)',
+				((name, field, hash_store.encode_value(value)) for field, value in item1.items()))
+			if ttl is not None:
+				conn.execute('INSERT OR REPLACE INTO hash_expire (name, expire) VALUES (?, ?)', (name, time.time() + ttl))
+
+	def get_hash(self, name, keys = []):
+		if not self.hash_alive(name):
+			res = {}
+		elif not keys:
+			rows = self.conn.execute('SELECT field, value FROM hashes WHERE name = ?', (name,)).fetchall()
+			return dict((field, hash_store.decode_value(value)) for field, value in rows)
+		else:
+			fields = keys if type(keys) is list else [keys]
+			res = {}
+			for i in range(0, len(fields), 500):
+				chunk = fields[i:i + 500]
+				rows = self.conn.execute('SELECT field, value FROM hashes WHERE name = ? AND field IN (%s)' % ','.join('?' * len(chunk)),
+					[name] + chunk).fetchall()
+				res.update((field, hash_store.decode_value(value)) for field, value in rows)
+		if not keys:
+			return res
+		elif type(keys) is list:
+			return [res.get(key) for key in keys]
+		else:
+			return res.get(keys)
+
+	def iter_hash(self, name, match = None):
+		if not self.hash_alive(name):
+			return
+		if match is None:
+			rows = self.conn.execute('SELECT field, value FROM hashes WHERE name = ?', (name,))
+		else:
+			rows = self.conn.execute('SELECT field, value FROM hashes WHERE name = ? AND field GLOB ?', (name, match))
+		for field, value in rows:
+			yield field, hash_store.decode_value(value)
+
+	def expire_hash(self, name, ttl):
+		with self.transaction() as conn:
+			conn.execute('INSERT OR REPLACE INTO hash_expire (name, expire) VALUES (?, ?)', (name, time.time() + ttl))
+
+	def exists_hash(self, name):
+		return self.hash_alive(name) and self.conn.execute('SELECT 1 FROM hashes WHERE name = ? LIMIT 1', (name,)).fetchone() is not None
+
+	def exists_hash_key(self, name, key):
+		return self.hash_alive(name) and self.conn.execute('SELECT 1 FROM hashes WHERE name = ? AND field = ?', (name, key)).fetchone() is not None
+
+	def delete_hash(self, name):
+		with self.transaction() as conn:
+			conn.execute('DELETE FROM hashes WHERE name = ?', (name,))
+			conn.execute('DELETE FROM hash_expire WHERE name = ?', (name,))
+
+	def delete_hash_key(self, name, key):
+		with self.transaction() as conn:
+			conn.execute('DELETE FROM hashes WHERE name = ? AND field = ?', (name, key))
+
+	def clear_hash(self):
+		with self.transaction() as conn:
+			conn.execute('DELETE FROM hashes')
+			conn.execute('DELETE FROM hash_expire')
+
+class _Transaction:
+	"""
+	BEGIN IMMEDIATE ... COMMIT, taking the write lock up front so that
+	concurrent writers from other processes queue instead of deadlocking.
+	"""
+
+	def __init__(self, conn):
+		self.conn = conn
+
+	def __enter__(self):
+		self.conn.execute('BEGIN IMMEDIATE')
+		return self.conn
+
+	def __exit__(self, exc_type, exc, tb):
+		if exc_type is None:
+			self.conn.execute('COMMIT')
+		else:
+			self.conn.execute('ROLLBACK')
+		return False
@@ -0,0 +1,63 @@
+"""
+Peak memory of assembling a dynamic net from its encoded slices.
+Every method runs in a fresh process: the slices are encoded first, then
+assembled, and the growth of the peak RSS is compared to the size of the
+R x R x T result. Needs the resource module (Linux, macOS).
+"""
+import sys
+import time
+import pickle
+import resource
+import subprocess
+import numpy as np
+import hash_store
+
+ROI_NUM = 264
+SLICE_NUM = 200
+METHODS = ['list', 'assemble']
+ENCODINGS = ['pickle', 'tagged']
+
+def peak_rss():
+	"""
+	Peak resident set size of this process in bytes
+	"""
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+def make_slices(encoding, roi_num = ROI_NUM, slice_num = SLICE_NUM):
+	rand = np.random.RandomState(0)
+	encode = pickle.dumps if encoding == 'pickle' else hash_store.encode_value
+	return [encode(rand.rand(roi_num, roi_num)) for i in range(slice_num)]
+
+def assemble_list(slices):
+	"""
+	The former assembly: a list of decoded slices stacked by np.array
+	"""
+	return np.array([hash_store.decode_value(x) for x in slices])
+
+def run(method, encoding):
+	slices = make_slices(encoding)
+	before = peak_rss()
+	start = time.time()
+	if method == 'list':
+		value = assemble_list(slices)
+	else:
+		value = hash_store.assemble_slices(slices)
+	elapsed = time.time() - start
+	assert value.shape == (SLICE_NUM, ROI_NUM, ROI_NUM)
+	growth = peak_rss() - before
+	print('%-8s %-6s %6.1f MB output, peak RSS +%6.1f MB = %4.2fx, %5.3fs' % (method, encoding, value.nbytes / 1e6,
+		growth / 1e6, growth / value.nbytes, elapsed))
+
+def AssemblyMemoryTest():
+	for encoding in ENCODINGS:
+		slices = make_slices(encoding, 16, 10)
+		assert np.array_equal(assemble_list(slices), hash_store.assemble_slices(slices))
+		for method in METHODS:
+			subprocess.check_call([sys.executable, __file__, method, encoding])
+
+if __name__ == '__main__':
+	if len(sys.argv) == 3:
+		run(sys.argv[1], sys.argv[2])
+	else:
+		AssemblyMemoryTest()
@@ -0,0 +1,248 @@
+# coding=utf-8
+"""
+Raw EEG signal store in MongoDB, keyed by exam id.
+
+A recording is cut into chunks of channel_block channels by chunk_seconds
+of samples. Each chunk holds int16 samples and a per-channel gain and offset,
+physical = int16 * gain + offset, two thirds of the size of 24-bit BDF
+samples. The chunks collection, indexed on
+(examid, block, start, end), is the chunk index: read() fetches only the
+chunks overlapping the requested channels and time range.
+
+	store = EEGRawStore(mdb.EEG_raw_db)
+	store.import_folder(eegfolder)
+	epoch = store.read('E202001061653396619', ['Cz', 'Pz'], 60, 70)
+"""
+import os
+import re
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+CHUNK_SECONDS = 10
+CHANNEL_BLOCK = 16
+INT16_LEVELS = 65535
+
+def read_bdf(path):
+	"""
+	Read a BDF file, return (channel labels, samplerate, physical samples as a channels x samples float32 array).
+	Signals with another samplerate than the first one (e.g. 'BDF Annotations') are left out.
+	"""
+	with open(path, 'rb') as f:
+		header = f.read(256)
+		header_bytes = int(header[184:192])
+		records = int(header[236:244])
+		duration = float(header[244:252])
+		ns = int(header[252:256])
+		fields = f.read(header_bytes - 256)
+	def field(offset, size):
+		return [fields[offset + i * size:offset + (i + 1) * size].decode('latin-1').strip() for i in range(ns)]
+	offset = 0
+	columns = {}
+	for name, size in [('label', 16), ('transducer', 80), ('dimension', 8), ('physmin', 8), ('physmax', 8),
+					   ('digmin', 8), ('digmax', 8), ('prefilter', 80), ('samples', 8), ('reserved', 32)]:
+		columns[name] = field(offset, size)
+		offset += size * ns
+	samples = [int(n) for n in columns['samples']]
+	raw = np.fromfile(path, dtype = np.uint8, offset = header_bytes)
+	record_bytes = 3 * sum(samples)
+	records = records if records >= 0 else len(raw) // record_bytes
+	raw = raw[:records * record_bytes].reshape(records, record_bytes)
+	samplerate = samples[0] / duration
+	labels = []
+	signals = []
+	start = 0
+	for i in range(ns):
+		width = 3 * samples[i]
+		if samples[i] / duration == samplerate and columns['label'][i] != 'BDF Annotations':
+			b = raw[:, start:start + width].reshape(-1, 3).astype(np.int32)
+			digital = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+			digital = np.where(digital >= 1 << 23, digital - (1 << 24), digital)
+			physmin, physmax = float(columns['physmin'][i]), float(columns['physmax'][i])
+			digmin, digmax = float(columns['digmin'][i]), float(columns['digmax'][i])
+			gain = (physmax - physmin) / (digmax - digmin)
+			signals.append(((digital - digmin) * gain + physmin).astype(np.float32))
+			labels.append(columns['label'][i])
+		start += width
+	return labels, samplerate, np.array(signals)
+
+def quantize(data):
+	"""
+	Return (int16 array, gain, offset) of a channels x samples array, one gain and offset per channel.
+	"""
+	data = np.asarray(data, dtype = np.float64)
+	low = data.min(axis = 1)
+	high = data.max(axis = 1)
+	gain = (high - low) / INT16_LEVELS
+	gain[gain == 0] = 1.0
+	offset = low + 32768 * gain
+	values = np.clip(np.rint((data - offset[:, None]) / gain[:, None]), -32768, 32767).astype(np.int16)
+	return values, gain, offset
+
+def make_chunks(examid, data, start_sample, chunk_samples, channel_block = CHANNEL_BLOCK):
+	"""
+	Cut a channels x samples array recorded from start_sample into chunk documents.
+	"""
+	docs = []
+	for block, first in enumerate(range(0, data.shape[0], channel_block)):
+		for begin in range(0, data.shape[1], chunk_samples):
+			values, gain, offset = quantize(data[first:first + channel_block, begin:begin + chunk_samples])
+			docs.append(dict(examid = examid, block = block, start = start_sample + begin,
+							 end = start_sample + begin + values.shape[1], channels = values.shape[0],
+							 gain = gain.tolist(), offset = offset.tolist(), data = values.tobytes()))
+	return docs
+
+def data_files(folder):
+	"""
+	BDF data files of an exam folder in recording order: data.bdf, data1.bdf, data2.bdf, ...
+	"""
+	numbers = {}
+	for name in os.listdir(folder):
+		match = re.match(r'data(\d*)\.bdf$', name, re.IGNORECASE)
+		if match:
+			numbers[name] = int(match.group(1) or 0)
+	return sorted(numbers, key = numbers.get)
+
+def load_exam(folder, chunk_seconds = CHUNK_SECONDS, channel_block = CHANNEL_BLOCK):
+	"""
+	Read an exam folder, return (exam document, chunk documents).
+	Module level so that it runs in a process pool.
+	Every data file is placed at the BeginTimeStamp (milliseconds from the exam start)
+	of the matching DataFileInformations entry of recordInformation.json.
+	"""
+	with open(os.path.join(folder, 'recordInformation.json'), 'r', encoding = 'utf-8-sig') as f:
+		info = json.load(f)
+	examid = info['ExamID']
+	files = data_files(folder)
+	if len(files) != len(info['DataFileInformations']):
+		raise Exception('%s: %d data files but %d DataFileInformations' % (examid, len(files), len(info['DataFileInformations'])))
+	samplerate = info['SampleRate']
+	chunk_samples = int(chunk_seconds * samplerate)
+	channels = None
+	segments = []
+	chunks = []
+	for name, file_info in zip(files, info['DataFileInformations']):
+		labels, file_rate, data = read_bdf(os.path.join(folder, name))
+		if file_rate != samplerate:
+			raise Exception('%s: %s is sampled at %g Hz instead of %g Hz' % (examid, name, file_rate, samplerate))
+		if channels is None:
+			channels = labels
+		elif labels != channels:
+			raise Exception('%s: channels of %s differ from %s' % (examid, name, files[0]))
+		start = int(round(file_info['BeginTimeStamp'] * samplerate / 1000.0))
+		segments.append([start, data.shape[1]])
+		chunks += make_chunks(examid, data, start, chunk_samples, channel_block)
+	exam = dict(examid = examid, samplerate = samplerate, channels = channels, segments = segments,
+				length = max([start + length for start, length in segments] + [0]),
+				chunk_samples = chunk_samples, channel_block = channel_block)
+	return exam, chunks
+
+class EEGRawStore:
+	"""
+	db - pymongo Database holding the 'exams' and 'chunks' collections
+	"""
+
+	def __init__(self, db, chunk_seconds = CHUNK_SECONDS, channel_block = CHANNEL_BLOCK):
+		self.db = db
+		self.exams = db['exams']
+		self.chunks = db['chunks']
+		self.chunk_seconds = chunk_seconds
+		self.channel_block = channel_block
+		self.indexed = False
+
+	def create_indexes(self):
+		if not self.indexed:
+			self.exams.create_index('examid', unique = True)
+			self.chunks.create_index([('examid', 1), ('block', 1), ('start', 1), ('end', 1)])
+			self.indexed = True
+
+	def store(self, exam, chunks, batch_size = 64):
+		"""
+		Write the chunks of an exam, then its exam document, which marks the exam as complete.
+		"""
+		self.create_indexes()
+		# chunks of an interrupted former import
+		self.chunks.delete_many(dict(examid = exam['examid']))
+		for i in range(0, len(chunks), batch_size):
+			self.chunks.insert_many(chunks[i:i + batch_size], ordered = False)
+		self.exams.replace_one(dict(examid = exam['examid']), exam, upsert = True)
+
+	def write(self, examid, data, samplerate, channels, start_sample = 0):
+		"""
+		Store a channels x samples array of physical values as the whole recording of examid.
+		"""
+		data = np.asarray(data)
+		chunk_samples = int(self.chunk_seconds * samplerate)
+		exam = dict(examid = examid, samplerate = samplerate, channels = list(channels), segments = [[start_sample, data.shape[1]]],
+					length = start_sample + data.shape[1], chunk_samples = chunk_samples, channel_block = self.channel_block)
+		self.store(exam, make_chunks(examid, data, start_sample, chunk_samples, self.channel_block))
+
+	def import_folder(self, eegfolder, workers = None):
+		"""
+		Import every exam folder below eegfolder holding a recordInformation.json and data*.bdf files.
+		Exams already stored are skipped, so an interrupted import is resumed by running it again.
+		Return a dict with lists of 'inserted' and 'skipped' exam ids and 'failed' (folder, error) pairs.
+		"""
+		folders = sorted(root for root, dirs, files in os.walk(eegfolder)
+						 if 'recordInformation.json' in files and data_files(root))
+		stored = set(doc['examid'] for doc in self.exams.find({}, {'examid': 1, '_id': 0}))
+		report = dict(inserted = [], skipped = [], failed = [])
+		pending = []
+		for folder in folders:
+			with open(os.path.join(folder, 'recordInformation.json'), 'r', encoding = 'utf-8-sig') as f:
+				examid = json.load(f)['ExamID']
+			if examid in stored:
+				report['skipped'].append(examid)
+			else:
+				pending.append(folder)
+		with ProcessPoolExecutor(max_workers = workers) as pool:
+			futures = [(folder, pool.submit(load_exam, folder, self.chunk_seconds, self.channel_block)) for folder in pending]
+			for folder, future in futures:
+				start = time.time()
+				try:
+					exam, chunks = future.result()
+				except Exception as e:
+					report['failed'].append((folder, str(e)))
+					continue
+				self.store(exam, chunks)
+				report['inserted'].append(exam['examid'])
+				print('%s: %d chunks stored in %1.2fs' % (exam['examid'], len(chunks), time.time() - start))
+		print('%d exams inserted, %d skipped, %d failed' % (len(report['inserted']), len(report['skipped']), len(report['failed'])))
+		return report
+
+	def info(self, examid):
+		exam = self.exams.find_one(dict(examid = examid), {'_id': 0})
+		if exam is None:
+			raise Exception('No raw EEG stored for %s' % examid)
+		return exam
+
+	def read(self, examid, channels = None, t_start = 0, t_end = None):
+		"""
+		Return the physical samples of channels between t_start and t_end seconds from the
+		exam start as a channels x samples float32 array, NaN where nothing was recorded.
+		channels - list of channel names or indexes, default all
+		"""
+		exam = self.info(examid)
+		samplerate = exam['samplerate']
+		if channels is None:
+			indexes = list(range(len(exam['channels'])))
+		else:
+			indexes = [exam['channels'].index(ch) if isinstance(ch, str) else ch for ch in channels]
+		first = int(np.floor(t_start * samplerate))
+		last = exam['length'] if t_end is None else int(np.ceil(t_end * samplerate))
+		ret = np.full((len(indexes), max(last - first, 0)), np.nan, dtype = np.float32)
+		block_size = exam['channel_block']
+		rows = {}
+		for row, index in enumerate(indexes):
+			rows.setdefault(index // block_size, []).append((row, index % block_size))
+		query = dict(examid = examid, block = {'$in': list(rows)}, start = {'$lt': last}, end = {'$gt': first})
+		for chunk in self.chunks.find(query, {'_id': 0, 'examid': 0}):
+			values = np.frombuffer(chunk['data'], dtype = np.int16).reshape(chunk['channels'], -1)
+			begin = max(first, chunk['start'])
+			end = min(last, chunk['end'])
+			for row, channel in rows[chunk['block']]:
+				ret[row, begin - first:end - first] = values[channel, begin - chunk['start']:end - chunk['start']] \
+					* chunk['gain'][channel] + chunk['offset'][channel]
+		return ret
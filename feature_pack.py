@@ -0,0 +1,286 @@
+# coding=utf-8
+"""
+Feature packs: static and dynamic features of a study in one file, for
+compute nodes without access to MongoDB or Redis.
+
+A pack is
+	MAGIC, index offset and index length (little-endian uint64)
+	the raw C-order buffer of every feature, aligned to ALIGNMENT bytes
+	the index, JSON: data source, every feature collection with its scans,
+		and key -> (offset, dtype, shape) of every buffer
+keys are the cache keys of RedisDatabase. Dynamic features are stored
+slices first, as in the caches.
+
+	feature_pack.export_pack(mdb, 'study.mmdpack', ['BOLD.net'], atlases = ['brodmann_lr'], scans = scans,
+		dynamic_configs = [('BOLD.net', 22, 1)])
+	mmdb = mmdpdb.MMDPDatabase(feature_pack = 'study.mmdpack')
+
+FeaturePackDatabase maps every pack once, read-only, and returns views of
+it, so the values are np.memmap shared by all processes through the page cache.
+"""
+import os
+import json
+import struct
+
+import numpy as np
+
+import MongoDB
+import cache_stats
+import hash_store
+import redis_database
+
+MAGIC = b'MMDPPACK'
+HEADER = struct.Struct('<8sQQ')
+ALIGNMENT = 64
+EXTENSION = '.mmdpack'
+# 2: feature keys hash-tagged by data source, scan, atlas and feature only
+VERSION = 2
+EEG_UNAVAILABLE = 'EEG features are not available in feature pack mode, open MMDPDatabase without feature_pack to read them'
+
+def feature_dbname(feature_name, window_length = None):
+	if window_length is None:
+		return 'SA' if feature_name.find('.net') == -1 else 'SN'
+	return 'DA' if feature_name.find('.net') == -1 else 'DN'
+
+def comment_key(comment):
+	return json.dumps(comment, sort_keys = True)
+
+class PackWriter:
+	"""
+	Write a feature pack buffer by buffer, the file appears on close().
+	"""
+
+	def __init__(self, path, data_source):
+		self.path = path
+		self.tmp = path + '.tmp'
+		self.f = open(self.tmp, 'wb')
+		self.f.write(HEADER.pack(MAGIC, 0, 0))
+		self.entries = {}
+		self.features = []
+		self.data_source = data_source
+
+	def add(self, key, value):
+		value = np.ascontiguousarray(value)
+		if value.dtype.hasobject:
+			raise Exception('%s is not a numeric array' % key)
+		offset = -(-self.f.tell() // ALIGNMENT) * ALIGNMENT
+		self.f.seek(offset)
+		self.f.write(value.tobytes())
+		self.entries[key] = (offset, value.dtype.str, value.shape)
+
+	generate_key_tag = redis_database.RedisDatabase.generate_key_tag
+	generate_static_key = redis_database.RedisDatabase.generate_static_key
+	generate_dynamic_key = redis_database.RedisDatabase.generate_dynamic_key
+
+	def add_static(self, doc, atlas_name, feature_name, comment):
+		self.add(self.generate_static_key(self.data_source, doc['scan'], atlas_name, feature_name, comment), hash_store.decode_value(doc['value']))
+		return doc['scan']
+
+	def add_dynamic(self, slices, atlas_name, feature_name, window_length, step_size, comment):
+		scan = slices[0]['scan']
+		key = self.generate_dynamic_key(self.data_source, scan, atlas_name, feature_name, window_length, step_size, comment)
+		self.add(key, hash_store.assemble_slices([doc['value'] for doc in slices]))
+		return scan
+
+	def add_feature(self, dbname, col, comment, scans):
+		self.features.append(dict(db = dbname, col = col, comment = comment_key(comment), scans = scans))
+
+	def close(self):
+		index = json.dumps(dict(version = VERSION, data_source = self.data_source, features = self.features,
+			entries = self.entries)).encode('utf-8')
+		offset = self.f.tell()
+		self.f.write(index)
+		self.f.seek(0)
+		self.f.write(HEADER.pack(MAGIC, offset, len(index)))
+		self.f.close()
+		os.replace(self.tmp, self.path)
+
+def export_pack(mdb, path, features, atlases, scans = None, dynamic_configs = [], comment = {}, batch_size = 100):
+	"""
+	Export features from MongoDB to a feature pack.
+	mdb - MongoDB.MongoDBDatabase
+	features - static feature names, dynamic_configs - (feature name, window length, step size) tuples,
+		each exported for every atlas of atlases
+	scans - optional list of scans, default every scan having the feature
+	Return a dict of (atlas, feature[, window length, step size]) -> number of scans exported.
+	"""
+	writer = PackWriter(path, mdb.data_source)
+	report = {}
+	try:
+		for atlas_name in atlases:
+			for feature_name, window_length, step_size in [(feature, None, None) for feature in features] + [tuple(config) for config in dynamic_configs]:
+				dbname = feature_dbname(feature_name, window_length)
+				col = mdb.getcol(atlas_name, feature_name, window_length, step_size)
+				query = dict(comment = comment)
+				if scans is not None:
+					query['scan'] = {'$in': list(scans)}
+				cursor = mdb.getdb(dbname)[col].find(query, {'_id': 0}, batch_size = batch_size)
+				exported = []
+				if window_length is None:
+					exported = [writer.add_static(doc, atlas_name, feature_name, comment) for doc in cursor]
+				else:
+					# the slices of a scan come together, in order
+					slices = []
+					for doc in cursor.sort([('scan', 1), ('slice', 1)]):
+						if slices and slices[0]['scan'] != doc['scan']:
+							exported.append(writer.add_dynamic(slices, atlas_name, feature_name, window_length, step_size, comment))
+							slices = []
+						slices.append(doc)
+					if slices:
+						exported.append(writer.add_dynamic(slices, atlas_name, feature_name, window_length, step_size, comment))
+				writer.add_feature(dbname, col, comment, exported)
+				report[(atlas_name, feature_name) if window_length is None else (atlas_name, feature_name, window_length, step_size)] = len(exported)
+				print('%s: %d scans exported' % (col, len(exported)))
+	except Exception:
+		writer.f.close()
+		os.remove(writer.tmp)
+		raise
+	writer.close()
+	return report
+
+class FeaturePackDatabase:
+	"""
+	Read-only feature source over one pack or a directory of packs.
+	It stands in for both MongoDB.MongoDBDatabase and RedisDatabase in MMDPDatabase:
+	every value is served from the packs, nothing is fetched or cached.
+	"""
+
+	def __init__(self, path, stats = None):
+		self.stats = stats if stats is not None else cache_stats.Stats()
+		if os.path.isdir(path):
+			paths = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(EXTENSION))
+		else:
+			paths = [path]
+		if not paths:
+			raise Exception('No feature pack in %s' % path)
+		self.maps = []
+		self.entries = {}
+		self.features = {}
+		self.data_sources = []
+		for pack in paths:
+			self.open_pack(pack)
+
+	def open_pack(self, path):
+		with open(path, 'rb') as f:
+			magic, offset, length = HEADER.unpack(f.read(HEADER.size))
+			if magic != MAGIC:
+				raise Exception('%s is not a feature pack' % path)
+			f.seek(offset)
+			index = json.loads(f.read(length).decode('utf-8'))
+		if index['version'] != VERSION:
+			raise Exception('%s: unsupported feature pack version %d' % (path, index['version']))
+		buf = np.memmap(path, dtype = np.uint8, mode = 'r')
+		self.maps.append(buf)
+		if index['data_source'] not in self.data_sources:
+			self.data_sources.append(index['data_source'])
+		for key, (offset, dtype, shape) in index['entries'].items():
+			self.entries[key] = (buf, offset, np.dtype(dtype), tuple(shape))
+		for feature in index['features']:
+			self.features.setdefault((feature['db'], feature['col'], feature['comment']), set()).update(feature['scans'])
+
+	def get_array(self, key):
+		"""
+		Return a read-only np.memmap view of the array stored with key, or None.
+		"""
+		entry = self.entries.get(key)
+		if entry is None:
+			return None
+		buf, offset, dtype, shape = entry
+		return buf[offset:offset + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+
+	# the key layout and netattr construction are shared with RedisDatabase
+	generate_key_tag = redis_database.RedisDatabase.generate_key_tag
+	generate_static_key = redis_database.RedisDatabase.generate_static_key
+	generate_dynamic_key = redis_database.RedisDatabase.generate_dynamic_key
+	trans_netattr = redis_database.RedisDatabase.trans_netattr
+	trans_dynamic_netattr = redis_database.RedisDatabase.trans_dynamic_netattr
+	getcol = MongoDB.MongoDBDatabase.getcol
+	# nothing expires, the ttl passed to set_hash is ignored
+	expire_time = None
+
+	def get_static_values(self, data_source, scan_list, atlas_name, feature_name, comment = {}):
+		labels = (data_source, atlas_name, feature_name)
+		ret = []
+		for scan in scan_list:
+			value = self.get_array(self.generate_static_key(data_source, scan, atlas_name, feature_name, comment))
+			if value is None:
+				self.stats.miss('pack', labels)
+				ret.append(None)
+			else:
+				self.stats.hit('pack', labels, value.nbytes)
+				ret.append(self.trans_netattr(scan, atlas_name, feature_name, value))
+		return ret
+
+	def get_dynamic_values(self, data_source, scan_list, atlas_name, feature_name, window_length, step_size, comment = {}):
+		labels = (data_source, atlas_name, feature_name)
+		ret = []
+		for scan in scan_list:
+			value = self.get_array(self.generate_dynamic_key(data_source, scan, atlas_name, feature_name, window_length, step_size, comment))
+			if value is None:
+				self.stats.miss('pack', labels)
+				ret.append(None)
+			else:
+				self.stats.hit('pack', labels, value.nbytes)
+				ret.append(self.trans_dynamic_netattr(scan, atlas_name, feature_name, window_length, step_size, value))
+		return ret
+
+	def get_dynamic_summary(self, dbname, scans, atlas_name, feature, window_length, step_size, summary, comment = {}):
+		"""
+		Packs hold no summaries, they are reduced from the mapped slices (slices first) of each scan.
+		Return a dict of scan -> summary for scans having the feature, as MongoDBDatabase.get_dynamic_summary.
+		"""
+		if summary not in MongoDB.SUMMARIES:
+			raise Exception('summary must be one of %s' % (MongoDB.SUMMARIES,))
+		ret = {}
+		for scan in scans:
+			# called like the Mongo one, without the data source, which the pack index records
+			for data_source in self.data_sources:
+				value = self.get_array(self.generate_dynamic_key(data_source, scan, atlas_name, feature, window_length, step_size, comment))
+				if value is not None:
+					ret[scan] = np.asarray(MongoDB.dynamic_summary(value, summary, axis = 0))
+					break
+		return ret
+
+	def find_feature(self, dbname, scan, atlas_name, feature, comment = {}, window_length = None, step_size = None):
+		# everything of the pack is found by get_static_values/get_dynamic_values
+		return []
+
+	def scans_with_feature(self, dbname, atlas_name, feature, comment = {}, window_length = None, step_size = None):
+		return sorted(self.features.get((dbname, self.getcol(atlas_name, feature, window_length, step_size), comment_key(comment)), ()))
+
+	def feature_versions(self, dbname, atlas_name, feature, scans, comment = {}, window_length = None, step_size = None):
+		# a pack never changes, its scans have a single version
+		having = self.features.get((dbname, self.getcol(atlas_name, feature, window_length, step_size), comment_key(comment)), ())
+		return dict((scan, 'pack') for scan in scans if scan in having)
+
+	def get_hash(self, name, keys = []):
+		# nothing is cached, feature_availability reads the pack index every time
+		if keys == []:
+			return {}
+		return None if type(keys) is str else [None] * len(keys)
+
+	def set_hash_all(self, name, hash, ttl = None):
+		pass
+
+	def set_hash(self, name, item1, item2 = '', ttl = None):
+		pass
+
+	def delete_hash(self, name):
+		pass
+
+	def get_temp_value(self, description_dict):
+		# packs hold no temp features: get_temp_feature raises and memoize computes the value again
+		raise MongoDB.NoRecordFoundException(description_dict, 'Feature packs hold no temp features.')
+
+	def put_temp_value(self, value, description_dict, sources = None):
+		# read-only, derived values are not saved
+		pass
+
+	def get_eeg_values(self, data_source, examids, mat, field):
+		raise Exception(EEG_UNAVAILABLE)
+
+	def get_eeg_group_value(self, data_source, examids, mat, field):
+		raise Exception(EEG_UNAVAILABLE)
+
+	def get_mat_fields(self, scans, mat, field):
+		raise Exception(EEG_UNAVAILABLE)
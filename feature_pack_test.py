@@ -0,0 +1,104 @@
+"""
+Check of feature packs with a fake MongoDB: static and dynamic features exported and served
+by MMDPDatabase(feature_pack = ...), and the temp and EEG features a pack does not hold.
+Runs without Redis or MongoDB.
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import MongoDB
+import hash_store
+import feature_pack
+import mmdpdb
+
+class Cursor(list):
+	def sort(self, keys):
+		return Cursor(sorted(self, key = lambda doc: tuple(doc[key] for key, direction in keys)))
+
+class FakeCollection:
+	def __init__(self, docs):
+		self.docs = docs
+
+	def find(self, query, projection = None, batch_size = None):
+		return Cursor(doc for doc in self.docs if doc['comment'] == query['comment'])
+
+class FakeMongo:
+	data_source = 'Changgung'
+	getcol = MongoDB.MongoDBDatabase.getcol
+
+	def __init__(self, collections):
+		self.collections = collections
+
+	def getdb(self, dbname):
+		return self.collections
+
+def make_pack(folder):
+	rand = np.random.RandomState(0)
+	attrs = dict(('scan%d' % i, rand.rand(5)) for i in range(3))
+	nets = dict(('scan%d' % i, rand.rand(7, 5, 5)) for i in range(3))
+	# tagged and legacy pickled values, slices stored out of order
+	static_docs = [dict(scan = scan, comment = {}, value = hash_store.encode_value(value)) for scan, value in attrs.items()]
+	dynamic_docs = [dict(scan = scan, slice = t, comment = {}, value = pickle.dumps(value[t]) if t % 2 else hash_store.encode_value(value[t]))
+		for scan, value in nets.items() for t in reversed(range(len(value)))]
+	mdb = FakeMongo({'aal-BOLD.BC': FakeCollection(static_docs), 'aal-BOLD.net-(22,1)': FakeCollection(dynamic_docs)})
+	path = os.path.join(folder, 'study' + feature_pack.EXTENSION)
+	report = feature_pack.export_pack(mdb, path, ['BOLD.BC'], ['aal'], dynamic_configs = [('BOLD.net', 22, 1)])
+	assert report == {('aal', 'BOLD.BC'): 3, ('aal', 'BOLD.net', 22, 1): 3}, report
+	return mmdpdb.MMDPDatabase(feature_pack = path), attrs, nets
+
+def RoundTripTest(folder):
+	db, attrs, nets = make_pack(folder)
+	for scan, attr in zip(sorted(attrs), db.get_feature(sorted(attrs), 'aal', 'BOLD.BC')):
+		assert np.array_equal(attr.data, attrs[scan])
+	net = db.get_dynamic_feature('scan1', 'aal', 'BOLD.net', 22, 1)
+	assert np.array_equal(net.data, np.moveaxis(nets['scan1'], 0, -1))
+
+def TempFeatureTest(folder):
+	"""
+	A pack holds no temp features: get_temp_feature raises NoRecordFoundException,
+	derived functions are computed on every call and nothing is saved
+	"""
+	db, attrs, nets = make_pack(folder)
+	try:
+		db.get_temp_feature('collection', 'feature')
+	except MongoDB.NoRecordFoundException:
+		pass
+	else:
+		raise AssertionError('a temp feature was found in a pack')
+	db.save_temp_feature('collection', 'feature', np.arange(3))
+	calls = []
+	@db.derived()
+	def mean(attrs):
+		calls.append(len(attrs))
+		return np.mean([attr.data for attr in attrs], axis = 0)
+	for i in range(2):
+		assert np.allclose(mean(sorted(attrs), 'aal', 'BOLD.BC'), np.mean(list(attrs.values()), axis = 0))
+	assert calls == [3, 3], calls
+
+def EEGTest(folder):
+	"""
+	EEG features are not in packs, reading them raises a clear error instead of an AttributeError
+	"""
+	db, attrs, nets = make_pack(folder)
+	for read in [lambda: db.get_eeg_feature(['E1'], 'power', 'alphapower'),
+				 lambda: db.get_group_eeg_feature(['E1', 'E2'], 'power', 'alphapower'),
+				 lambda: db.get_eeg_signal('E1')]:
+		try:
+			read()
+		except AttributeError:
+			raise
+		except Exception as e:
+			assert str(e) == feature_pack.EEG_UNAVAILABLE, e
+		else:
+			raise AssertionError('an EEG feature was read from a pack')
+
+if __name__ == '__main__':
+	for test in [RoundTripTest, TempFeatureTest, EEGTest]:
+		folder = tempfile.mkdtemp()
+		try:
+			test(folder)
+		finally:
+			shutil.rmtree(folder)
+	print('feature_pack: OK')
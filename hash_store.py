@@ -0,0 +1,189 @@
+# coding=utf-8
+"""
+Hash store on top of a Redis connection.
+
+Every field value is encoded on its own with a one-byte tag:
+	m - msgpack, for str/int/float/bool/bytes/None and lists and
+	    str-keyed dicts of them, which msgpack returns unchanged
+	a - packed ndarray, see array_codec
+	p - pickle, for anything else
+Values written by the former pickle-per-field implementation are
+still readable.
+Writes are sent as HSET in pipelines of at most batch_size fields,
+and huge hashes can be streamed with HSCAN.
+"""
+import pickle
+
+import msgpack
+import numpy as np
+
+import array_codec
+
+TAG_MSGPACK = b'm'
+TAG_ARRAY = b'a'
+TAG_PICKLE = b'p'
+PICKLE_PROTO = b'\x80'
+
+MSGPACK_SCALARS = (str, int, float, bool, bytes, type(None))
+
+def _msgpackable(value):
+	"""
+	Whether msgpack round-trips value exactly: exact scalar types, lists and dicts with str keys of them.
+	Subclasses (namedtuples, numpy scalars, ...) and tuples would come back as other types.
+	"""
+	if type(value) in MSGPACK_SCALARS:
+		return True
+	if type(value) is list:
+		return all(_msgpackable(item) for item in value)
+	if type(value) is dict:
+		return all(type(k) is str and _msgpackable(v) for k, v in value.items())
+	return False
+
+def encode_value(value):
+	"""
+	Encode one field value to bytes.
+	"""
+	if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+		return TAG_ARRAY + array_codec.pack_array(value)
+	if _msgpackable(value):
+		try:
+			return TAG_MSGPACK + msgpack.packb(value, use_bin_type=True)
+		except (TypeError, ValueError, OverflowError):
+			# e.g. an int beyond 64 bits
+			pass
+	return TAG_PICKLE + pickle.dumps(value)
+
+def decode_value(buf):
+	"""
+	Decode one field value, None stays None.
+	"""
+	if buf is None:
+		return None
+	tag = buf[:1]
+	if tag == TAG_MSGPACK:
+		return msgpack.unpackb(buf[1:], raw=False, strict_map_key=False)
+	elif tag == TAG_ARRAY:
+		return array_codec.unpack_array(buf, 1)
+	elif tag == TAG_PICKLE:
+		return pickle.loads(buf[1:])
+	elif tag == PICKLE_PROTO:
+		# written by the old pickle-per-field implementation
+		return pickle.loads(buf)
+	else:
+		raise Exception('Unknown hash value encoding %r' % tag)
+
+def decode_into(buf, out):
+	"""
+	Decode one value into out, a preallocated array of its shape.
+	Packed arrays are copied straight from buf, other encodings are decoded first.
+	"""
+	value = array_codec.unpack_array(buf, 1) if buf[:1] == TAG_ARRAY else decode_value(buf)
+	if np.shape(value) != out.shape:
+		raise Exception('Cannot decode a value of shape %s into %s' % (np.shape(value), out.shape))
+	out[...] = value
+
+def assemble_slices(bufs, count = None):
+	"""
+	Decode the encoded slices of a dynamic feature into one slices-first ndarray,
+	allocated once from the first slice and filled in place, so the peak memory is
+	the result plus one slice.
+	bufs - slices in order, any iterable (e.g. over a cursor) when count is given
+	"""
+	if count is None:
+		bufs = list(bufs)
+		count = len(bufs)
+	ret = None
+	num = 0
+	for buf in bufs:
+		if num >= count:
+			raise Exception('More than %d slices' % count)
+		if ret is None:
+			first = np.asarray(decode_value(buf))
+			ret = np.empty((count,) + first.shape, dtype = first.dtype)
+			ret[0] = first
+			del first
+		else:
+			decode_into(buf, ret[num])
+		num += 1
+	if num != count:
+		raise Exception('%d slices expected, %d found' % (count, num))
+	return ret
+
+def _field_name(field):
+	if type(field) is bytes:
+		return field.decode()
+	return field
+
+class RedisHashStore:
+	"""
+	Batched, typed hash storage on a StrictRedis connection.
+	"""
+
+	def __init__(self, db, batch_size = 1000):
+		self.db = db
+		self.batch_size = batch_size
+
+	def _batches(self, items):
+		batch = []
+		for item in items:
+			batch.append(item)
+			if len(batch) >= self.batch_size:
+				yield batch
+				batch = []
+		if batch:
+			yield batch
+
+	def set(self, name, mapping, ttl = None, replace = False):
+		"""
+		Write the fields of mapping to the hash name, the mapping itself is left untouched.
+		replace - delete the hash first
+		ttl - expire the hash after ttl seconds
+		Return the number of fields written.
+		"""
+		pipe = self.db.pipeline(transaction=False)
+		if replace:
+			pipe.delete(name)
+		count = 0
+		for batch in self._batches(mapping.items()):
+			pipe.hset(name, mapping=dict((k, encode_value(v)) for k, v in batch))
+			count += len(batch)
+			if len(pipe) >= 8:
+				pipe.execute()
+		if ttl is not None:
+			pipe.expire(name, ttl)
+		if len(pipe):
+			pipe.execute()
+		return count
+
+	def get(self, name, fields = None):
+		"""
+		Return a dict of the hash name.
+		fields - only fetch these fields, missing ones map to None
+		"""
+		if fields is None:
+			res = self.db.hgetall(name)
+			return dict((_field_name(k), decode_value(v)) for k, v in res.items())
+		ret = {}
+		pipe = self.db.pipeline(transaction=False)
+		batches = list(self._batches(fields))
+		for batch in batches:
+			pipe.hmget(name, batch)
+		for batch, values in zip(batches, pipe.execute()):
+			for field, value in zip(batch, values):
+				ret[field] = decode_value(value)
+		return ret
+
+	def get_one(self, name, field):
+		return decode_value(self.db.hget(name, field))
+
+	def scan(self, name, match = None, count = None):
+		"""
+		Iterate (field, value) over the hash name with HSCAN, without loading it whole.
+		"""
+		if count is None:
+			count = self.batch_size
+		for field, value in self.db.hscan_iter(name, match=match, count=count):
+			yield _field_name(field), decode_value(value)
+
+	def expire(self, name, ttl):
+		return self.db.expire(name, ttl)
@@ -0,0 +1,105 @@
+"""
+Throughput test of the Redis hash store on 10^5-field hashes.
+Needs a local redis-server, db 15 is flushed.
+The codec round trip runs without Redis.
+"""
+import time
+import pickle
+import datetime
+import collections
+import numpy as np
+from redis import StrictRedis
+import hash_store
+
+FIELD_NUM = 100000
+
+def make_scalar_hash(n = FIELD_NUM):
+	return dict(('field%d' % i, float(i) / 7) for i in range(n))
+
+def make_array_hash(n = FIELD_NUM, size = 16):
+	return dict(('field%d' % i, np.random.rand(size)) for i in range(n))
+
+Record = collections.namedtuple('Record', ['examid', 'date'])
+
+ROUND_TRIP_VALUES = [None, True, 0, -1, 2 ** 70, 1.5, 'str', b'bytes', [1, 'a', None], {'a': [1, 2], 'b': {'c': 1.0}},
+					 {1: 'a'}, {'a': {2: 'b'}}, (1, 2), [(1, 2)], {'a': (1,)}, Record('E1', None), Record('E2', datetime.datetime(2020, 1, 6)),
+					 (), np.float64(1.5), np.int32(3), [np.float32(2)], np.arange(6).reshape(2, 3), np.zeros(0), set([1, 2])]
+
+def CodecRoundTripTest():
+	"""
+	Every value decodes to an equal value of the same type
+	"""
+	def check(value, decoded):
+		assert type(decoded) is type(value), (value, decoded)
+		if isinstance(value, np.ndarray):
+			assert value.dtype == decoded.dtype and np.array_equal(value, decoded), (value, decoded)
+		elif isinstance(value, (list, tuple)):
+			assert len(value) == len(decoded), (value, decoded)
+			for item, decoded_item in zip(value, decoded):
+				check(item, decoded_item)
+		elif isinstance(value, dict):
+			assert list(value) == list(decoded), (value, decoded)
+			for k in value:
+				check(value[k], decoded[k])
+		else:
+			assert value == decoded, (value, decoded)
+	for value in ROUND_TRIP_VALUES:
+		check(value, hash_store.decode_value(hash_store.encode_value(value)))
+	assert hash_store.encode_value({'a': [1, 2]})[:1] == hash_store.TAG_MSGPACK
+	assert hash_store.encode_value({1: 'a'})[:1] == hash_store.TAG_PICKLE
+	assert hash_store.encode_value(Record('E1', None))[:1] == hash_store.TAG_PICKLE
+	print('Codec round trip of %d values: OK' % len(ROUND_TRIP_VALUES))
+
+def PickleHashTest(db, hash):
+	"""
+	Time usage of the former pickle-per-field HMSET implementation
+	"""
+	db.delete('pickle_hash')
+	write_start = time.time()
+	encoded = {}
+	for k in hash:
+		encoded[k] = pickle.dumps(hash[k])
+	db.hmset('pickle_hash', encoded)
+	write_end = time.time()
+	res = db.hgetall('pickle_hash')
+	value = dict((k.decode(), pickle.loads(v)) for k, v in res.items())
+	read_end = time.time()
+	assert len(value) == len(hash)
+	print('Pickle HMSET write %d fields: %1.2fs, %d fields/s' % (len(hash), write_end - write_start, len(hash) / (write_end - write_start)))
+	print('Pickle HGETALL read %d fields: %1.2fs, %d fields/s' % (len(hash), read_end - write_end, len(hash) / (read_end - write_end)))
+
+def HashStoreTest(db, hash, batch_size = 1000):
+	"""
+	Time usage of the batched hash store: write, full read, projection and HSCAN streaming
+	"""
+	store = hash_store.RedisHashStore(db, batch_size)
+	write_start = time.time()
+	store.set('store_hash', hash, ttl = 600, replace = True)
+	write_end = time.time()
+	value = store.get('store_hash')
+	read_end = time.time()
+	assert len(value) == len(hash)
+	fields = list(hash.keys())[::100]
+	proj = store.get('store_hash', fields)
+	proj_end = time.time()
+	assert len(proj) == len(fields)
+	count = 0
+	for field, value in store.scan('store_hash'):
+		count += 1
+	scan_end = time.time()
+	assert count == len(hash)
+	print('HashStore write %d fields (batch %d): %1.2fs, %d fields/s' % (len(hash), batch_size, write_end - write_start, len(hash) / (write_end - write_start)))
+	print('HashStore HGETALL read %d fields: %1.2fs, %d fields/s' % (len(hash), read_end - write_end, len(hash) / (read_end - write_end)))
+	print('HashStore projected read %d fields: %1.4fs' % (len(fields), proj_end - read_end))
+	print('HashStore HSCAN stream %d fields: %1.2fs, %d fields/s' % (count, scan_end - proj_end, count / (scan_end - proj_end)))
+
+if __name__ == '__main__':
+	CodecRoundTripTest()
+	db = StrictRedis(host='localhost', port=6379, db=15)
+	db.flushdb()
+	for name, hash in [('scalar', make_scalar_hash()), ('ndarray', make_array_hash())]:
+		print('--- %s hash ---' % name)
+		PickleHashTest(db, hash)
+		for batch_size in [100, 1000, 10000]:
+			HashStoreTest(db, hash, batch_size)
+	db.flushdb()
@@ -0,0 +1,147 @@
+# coding=utf-8
+"""
+Memoized metadata lookups of SQLiteDB.
+
+Records are kept in an in-process LRU keyed by (kind, key), e.g.
+('mriscan', filename), ('eegscan', examid) or ('person', name).
+Optionally a second level is kept in the hash store of the feature cache
+(RedisDatabase or DiskCacheDatabase), one hash per kind, so several
+processes share the lookups. Every write to the database invalidates it.
+
+Shared records are pickled, so namedtuples and tuples come back as such.
+The shared hashes are named after a generation token kept in the store.
+clear() writes a new token, and every process re-reads the token at most
+check_interval seconds after its last read, dropping its own LRU when it changed.
+"""
+import os
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+KINDS = ('mriscan', 'eegscan', 'person')
+
+class MetadataCache:
+	"""
+	Thread-safe LRU of immutable records.
+	store - optional object with get_hash/set_hash/delete_hash (RedisDatabase, DiskCacheDatabase)
+	check_interval - seconds a generation token read from the store is trusted
+	"""
+
+	def __init__(self, maxsize = 10000, store = None, ttl = 3600, prefix = 'mmdpdb:metadata:', check_interval = 1.0):
+		self.maxsize = maxsize
+		self.store = store
+		self.ttl = ttl
+		self.prefix = prefix
+		self.check_interval = check_interval
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.generation = None
+		self.checked = 0
+
+	def hash_name(self, kind):
+		return self.prefix + kind + ':' + self.generation
+
+	def check_generation(self):
+		"""
+		Re-read the generation token of the store when check_interval has passed,
+		drop the in-process records when another process cleared the cache.
+		"""
+		if self.store is None or time.time() - self.checked < self.check_interval:
+			return
+		# a missing token (never cleared, or the store was flushed) is ''
+		generation = self.store.get_hash(self.prefix + 'generation', 'generation') or ''
+		with self.lock:
+			if generation != self.generation:
+				self.entries.clear()
+				self.generation = generation
+			self.checked = time.time()
+
+	def get(self, kind, key):
+		"""
+		Return the cached record or None
+		"""
+		self.check_generation()
+		with self.lock:
+			record = self.entries.get((kind, key))
+			if record is not None:
+				self.entries.move_to_end((kind, key))
+				self.hits += 1
+				return record
+		if self.store is not None:
+			record = self.store.get_hash(self.hash_name(kind), key)
+			if record is not None:
+				record = pickle.loads(record)
+				self._put(kind, key, record)
+				with self.lock:
+					self.hits += 1
+				return record
+		with self.lock:
+			self.misses += 1
+		return None
+
+	def get_many(self, kind, keys):
+		"""
+		Return a dict of key -> record of the cached keys
+		"""
+		self.check_generation()
+		ret = {}
+		missing = []
+		with self.lock:
+			for key in keys:
+				record = self.entries.get((kind, key))
+				if record is not None:
+					self.entries.move_to_end((kind, key))
+					ret[key] = record
+				else:
+					missing.append(key)
+		if missing and self.store is not None:
+			for key, record in zip(missing, self.store.get_hash(self.hash_name(kind), missing)):
+				if record is not None:
+					record = pickle.loads(record)
+					self._put(kind, key, record)
+					ret[key] = record
+		with self.lock:
+			self.hits += len(ret)
+			self.misses += len(keys) - len(ret)
+		return ret
+
+	def put(self, kind, key, record):
+		self.put_many(kind, {key: record})
+
+	def put_many(self, kind, records):
+		self.check_generation()
+		for key, record in records.items():
+			self._put(kind, key, record)
+		if records and self.store is not None:
+			self.store.set_hash(self.hash_name(kind), dict((key, pickle.dumps(record)) for key, record in records.items()), ttl = self.ttl)
+
+	def _put(self, kind, key, record):
+		with self.lock:
+			self.entries[(kind, key)] = record
+			self.entries.move_to_end((kind, key))
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last = False)
+
+	def clear(self):
+		"""
+		Drop every record, in process and in the store, and start a new generation
+		so that other processes drop theirs
+		"""
+		with self.lock:
+			self.entries.clear()
+		if self.store is not None:
+			self.check_generation()
+			for kind in KINDS:
+				self.store.delete_hash(self.hash_name(kind))
+			generation = '%x-%x' % (os.getpid(), time.time_ns())
+			self.store.set_hash(self.prefix + 'generation', 'generation', generation)
+			with self.lock:
+				self.generation = generation
+				self.checked = time.time()
+
+	def info(self):
+		with self.lock:
+			return dict(hits = self.hits, misses = self.misses, size = len(self.entries), maxsize = self.maxsize)
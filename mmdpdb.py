@@ -11,9 +11,21 @@ mmdpdb is the database of MMDPS, containing 3 databased.
 
 """
 import os
+import time
+import hashlib
+import functools
+import json
+import sqlite3
+import threading
+import numpy as np
+import scipy.io as scio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from sqlalchemy import create_engine, exists, and_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, exists, and_, event
+from contextlib import contextmanager
+from sqlalchemy.pool import StaticPool, QueuePool
+from sqlalchemy.orm import sessionmaker, scoped_session, selectinload
 
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
@@ -23,10 +35,30 @@ from mmdps.util import loadsave, clock
 from mmdps import rootconfig
 
 # from . import mongodb_database, redis_database
-import MongoDB, redis_database
+import MongoDB, redis_database, disk_cache, cache_stats, cohort_query, metadata_cache, eeg_raw_store
+from feature_pack import FeaturePackDatabase, EEG_UNAVAILABLE
 from Cryptodome.Cipher import AES
 from Cryptodome import Random
 
+# files of each modality in an MRI scan folder
+MRI_MODALITY_FILES = {'hasT1': 'T1.nii.gz', 'hasT2': 'T2.nii.gz', 'hasBOLD': 'BOLD.nii.gz', 'hasDWI': 'DWI.nii.gz'}
+
+# lightweight, immutable result rows returned instead of live ORM objects
+MRIScanRecord = namedtuple('MRIScanRecord', ['id', 'filename', 'date', 'hasT1', 'hasT2', 'hasBOLD', 'hasDWI',
+	'person_id', 'name', 'gender', 'birth', 'institution', 'manufacturer', 'modelname'])
+EEGScanRecord = namedtuple('EEGScanRecord', ['id', 'examid', 'date', 'examitem', 'samplerate',
+	'person_id', 'name_chinese', 'eegid', 'gender', 'birth', 'devicename', 'devicemode'])
+PersonRecord = namedtuple('PersonRecord', ['id', 'name', 'name_chinese', 'gender', 'birth', 'patientid', 'eegid', 'mriid'])
+
+# values per IN (...) query, below SQLite's default limit of 999 host parameters
+IN_CHUNK = 500
+
+# seconds a feature availability snapshot stays in the cache
+AVAILABILITY_TTL = 60
+AGGREGATE_STATS = ('count', 'sum', 'mean', 'var', 'std', 'min', 'max')
+# seconds an aggregate state is kept in the cache after its last update
+AGGREGATE_TTL = 7 * 24 * 3600
+
 class AESCoding:
 	def __init__(self, tkey = b'this is a 16 key'):
 		#you can change the mode here, there are five mode for you to choose,
@@ -45,15 +77,49 @@ class AESCoding:
 		return mydecrypt.decrypt(data[16:]).decode()
 
 class MMDPDatabase:
-	def __init__(self, data_source= 'Changgung', username = None, password = None):
-		self.rdb = redis_database.RedisDatabase()
-		if username is None:
-			self.mdb = MongoDB.MongoDBDatabase(data_source= data_source)
+	def __init__(self, data_source= 'Changgung', username = None, password = None, redis_nodes = None,
+				 cache_backend = 'auto', cache_dir = None, collect_stats = False, sqlite_snapshot = False, shared_metadata_cache = False,
+				 feature_pack = None):
+		"""
+		redis_nodes - optional list of (host, port) of redis-servers to shard the feature cache over
+		cache_backend - 'redis', 'disk' (memory-mapped local cache, see disk_cache),
+			or 'auto' to use redis and fall back to disk when no redis-server is reachable
+		cache_dir - directory of the disk cache
+		collect_stats - record per-tier hits, bytes, round trips and latencies, see stats()
+		sqlite_snapshot - serve metadata from a read-only in-memory copy of the SQLite database
+		shared_metadata_cache - back the metadata lookup cache with the hashes of the feature cache,
+			shared by all processes using it
+		feature_pack - path of a feature pack or a directory of packs (see feature_pack) serving
+			get_feature and get_dynamic_feature read-only instead of MongoDB and the cache
+		"""
+		self.metrics = cache_stats.Stats(collect_stats)
+		if feature_pack is not None:
+			self.rdb = self.mdb = FeaturePackDatabase(feature_pack, stats = self.metrics)
+			self.eeg_raw = None
 		else:
-			self.mdb = MongoDB.MongoDBDatabase(data_source= data_source, user= username, pwd= password)
-		self.sdb = SQLiteDB()
+			self.rdb = self.open_cache(cache_backend, redis_nodes, cache_dir)
+			if username is None:
+				self.mdb = MongoDB.MongoDBDatabase(data_source= data_source, stats= self.metrics)
+			else:
+				self.mdb = MongoDB.MongoDBDatabase(data_source= data_source, user= username, pwd= password, stats= self.metrics)
+			self.eeg_raw = eeg_raw_store.EEGRawStore(self.mdb.EEG_raw_db)
+		self.sdb = SQLiteDB(snapshot = sqlite_snapshot, metadata_store = self.rdb if shared_metadata_cache else None)
 		self.data_source = data_source
 
+	def open_cache(self, cache_backend, redis_nodes, cache_dir):
+		if cache_backend == 'redis':
+			return redis_database.RedisDatabase(nodes = redis_nodes, stats = self.metrics)
+		elif cache_backend == 'disk':
+			return disk_cache.DiskCacheDatabase(cache_dir, stats = self.metrics)
+		elif cache_backend == 'auto':
+			try:
+				return redis_database.RedisDatabase(nodes = redis_nodes, stats = self.metrics)
+			except Exception as e:
+				print('Redis unavailable, falling back to disk cache: ' + str(e))
+				return disk_cache.DiskCacheDatabase(cache_dir, stats = self.metrics)
+		else:
+			raise Exception("cache_backend must be 'redis', 'disk' or 'auto'")
+
 	def get_feature(self, scan_list, atlasobj, feature_name, comment={}):
 		"""
 		Designed for static networks and attributes query.
@@ -72,16 +138,15 @@ class MMDPDatabase:
 		if (not (type(scan_list) is list or type(scan_list) is str) or type(atlasobj) is not str or type(feature_name) is not str):
 			raise Exception("Please input in the format as follows : scan must be str or a list of str, atlas and feature must be str")
 		ret_list = []
-		for scan in scan_list:
-			res = self.rdb.get_static_value(self.data_source, scan, atlasobj, feature_name, comment)
+		cached = self.rdb.get_static_values(self.data_source, scan_list, atlasobj, feature_name, comment)
+		for scan, res in zip(scan_list, cached):
 			if res is not None:
 				ret_list.append(res)
 			else:
 				if feature_name.find('.net') == -1:
-					doc = self.mdb.total_query('SA', scan, atlasobj, feature_name, comment)
+					doc = self.mdb.find_feature('SA', scan, atlasobj, feature_name, comment)
 				else:
-					doc = self.mdb.total_query('SN', scan, atlasobj, feature_name, comment)
-				doc = list(doc)
+					doc = self.mdb.find_feature('SN', scan, atlasobj, feature_name, comment)
 				# doc =self.mdb.total_query('SA',scan,atlasobj,feature_name,comment)
 				# doc =self.mdb,total_query('SN',scan,atlasobj,feature_name,comment)
 				if len(doc) != 0:
@@ -94,13 +159,15 @@ class MMDPDatabase:
 		else:
 			return ret_list
 
-	def get_dynamic_feature(self, scan_list, atlasobj, feature_name, window_length, step_size, comment= {}):
+	def get_dynamic_feature(self, scan_list, atlasobj, feature_name, window_length, step_size, comment= {}, summary = None):
 		"""
 		Designed for dynamic networks and attributes query.
 		Using scan name , altasobj/altasobj name, feature name, window length, step size and data source(the default is Changgung)
 			to query data from Redis.
 		If the data is not in Redis, try to query data from Mongodb and store the data in Redis.
 		If the query succeeds, return a DynamicNet or DynamicAttr class, if not, rasie an arror.
+		summary - one of MongoDB.SUMMARIES ('mean', 'std', 'cv', 'min', 'max'): return the Net or Attr of that
+			reduction over time, read from the summaries stored with the feature instead of the slices
 		"""
 		return_single = False
 		if type(scan_list) is str:
@@ -110,19 +177,21 @@ class MMDPDatabase:
 			atlasobj = atlasobj.name
 		if (not (type(scan_list) is list or type(scan_list) is str) or type(atlasobj) is not str or type(feature_name) is not str or type(window_length) is not int or type(step_size) is not int):
 			raise Exception("Please input in the format as follows : scan must be str or a list of str, atlas and feature must be str, window length and step size must be int")
+		if summary is not None:
+			ret_list = self.get_dynamic_summary(scan_list, atlasobj, feature_name, window_length, step_size, summary, comment)
+			return ret_list[0] if return_single else ret_list
 		ret_list = []
-		for scan in scan_list:
-			res = self.rdb.get_dynamic_value(self.data_source, scan, atlasobj, feature_name, window_length, step_size, comment)
+		cached = self.rdb.get_dynamic_values(self.data_source, scan_list, atlasobj, feature_name, window_length, step_size, comment)
+		for scan, res in zip(scan_list, cached):
 			if res is not None:
 				ret_list.append(res)
 			else:
 				# doc = self.mdb.total_query('DA',scan, atlasobj, feature_name, comment, window_length, step_size)
 				# doc = self.mdb.total_query('DN',scan, atlasobj, feature_name, comment, window_length, step_size)
 				if feature_name.find('.net') == -1:
-					doc = self.mdb.total_query('DA', scan, atlasobj, feature_name, comment, window_length, step_size)
+					doc = self.mdb.find_feature('DA', scan, atlasobj, feature_name, comment, window_length, step_size)
 				else:
-					doc = self.mdb.total_query('DN', scan, atlasobj, feature_name, comment, window_length, step_size)
-				doc = list(doc)
+					doc = self.mdb.find_feature('DN', scan, atlasobj, feature_name, comment, window_length, step_size)
 				if len(doc) != 0:
 					mat = self.rdb.set_value(doc,self.data_source, atlasobj, feature_name, window_length, step_size)
 					ret_list.append(mat)
@@ -135,17 +204,247 @@ class MMDPDatabase:
 		else:
 			return ret_list
 
-	def get_temp_feature(self, feature_collection, feature_name):
-		pass
+	def get_dynamic_summary(self, scan_list, atlasobj, feature_name, window_length, step_size, summary, comment = {}):
+		"""
+		Return the Net or Attr of a summary of a dynamic feature for every scan of scan_list,
+		through the cache, misses are fetched from MongoDB in one query.
+		"""
+		name = 'summary:%s:%s:%s:%d:%d:%s:%s' % (self.data_source, atlasobj, feature_name, window_length, step_size, summary,
+			json.dumps(comment, sort_keys = True))
+		values = self.rdb.get_hash(name, scan_list)
+		missing = [scan for scan, value in zip(scan_list, values) if value is None]
+		if missing:
+			dbname = 'DA' if feature_name.find('.net') == -1 else 'DN'
+			found = self.mdb.get_dynamic_summary(dbname, missing, atlasobj, feature_name, window_length, step_size, summary, comment)
+			lacking = [scan for scan in missing if scan not in found]
+			if lacking:
+				raise MongoDB.NoRecordFoundException('No %s summary in redis or mongodb: %s %s %s %d %d' % (summary, ', '.join(lacking),
+					atlasobj, feature_name, window_length, step_size), 'Run MongoDBDatabase.backfill_dynamic_summaries.')
+			self.rdb.set_hash(name, found, ttl = self.rdb.expire_time)
+			values = [found[scan] if value is None else value for scan, value in zip(scan_list, values)]
+		return [self.rdb.trans_netattr(scan, atlasobj, feature_name, value) for scan, value in zip(scan_list, values)]
+
+	def get_eeg_feature(self, scan_list, mat, field):
+		"""
+		Return the field of an EEG .mat feature (e.g. 'chan_abspower_dB', 'alphapower') as arrays in memory.
+		Values are read through the cache, misses are fetched from MongoDB in one query and cached
+		with the expiration time of MRI features.
+		scan_list - exam id or list of exam ids, a list returns a list in the same order
+		"""
+		return_single = False
+		if type(scan_list) is str:
+			scan_list = [scan_list]
+			return_single = True
+		if not (type(scan_list) is list and type(mat) is str and type(field) is str):
+			raise Exception("Please input in the format as follows : scan must be str or a list of str, mat and field must be str")
+		if mat.endswith('.mat'):
+			mat = mat[:-4]
+		ret_list = self.fetch_eeg_values(scan_list, mat, field)
+		lacking = [scan for scan, value in zip(scan_list, ret_list) if value is None]
+		if lacking:
+			raise MongoDB.NoRecordFoundException('No such item in redis or mongodb: ' + ', '.join(lacking) + ' ' + mat + ' ' + field)
+		if return_single:
+			return ret_list[0]
+		else:
+			return ret_list
+
+	def fetch_eeg_values(self, scan_list, mat, field):
+		"""
+		Read the field of an EEG .mat feature through the cache, misses are fetched from MongoDB
+		in one query and cached. Return a list in the order of scan_list, None for exams lacking it.
+		"""
+		ret_list = self.rdb.get_eeg_values(self.data_source, scan_list, mat, field)
+		missing = [scan for scan, value in zip(scan_list, ret_list) if value is None]
+		if missing:
+			found = self.mdb.get_mat_fields(missing, mat, field)
+			if found:
+				self.rdb.set_eeg_values(self.data_source, mat, field, found)
+			ret_list = [found.get(scan) if value is None else value for scan, value in zip(scan_list, ret_list)]
+		return ret_list
+
+	def get_group_eeg_feature(self, group, mat, field, skip_missing = False):
+		"""
+		Return the field of an EEG .mat feature (e.g. 'chan_abspower_dB', 'alphapower') of every exam
+		of a group stacked as one exams x channels (x bands) ndarray.
+		group - group name, Group object or list of exam ids
+		Return (matrix, examids, missing): examids are the exams of the matrix rows in group order,
+		missing the exams lacking the feature. They raise NoRecordFoundException unless skip_missing.
+		The whole matrix is cached as one entry keyed by the ordered exam ids of the group.
+		"""
+		if type(group) is str:
+			examids = [scan.examid for scan in self.sdb.getEEGScansInGroup(group, lightweight = True)]
+		elif isinstance(group, tables.Group):
+			examids = [scan.examid for scan in group.eegscans]
+		else:
+			examids = list(group)
+		if mat.endswith('.mat'):
+			mat = mat[:-4]
+		if not examids:
+			raise Exception('No EEG scans in group %s' % group)
+		cached = self.rdb.get_eeg_group_value(self.data_source, examids, mat, field)
+		if cached is not None:
+			matrix, present = cached
+		else:
+			values = self.fetch_eeg_values(examids, mat, field)
+			present = np.array([value is not None for value in values])
+			arrays = [np.asarray(value) for value in values if value is not None]
+			if not arrays:
+				raise MongoDB.NoRecordFoundException('No exam of the group has ' + mat + ' ' + field)
+			shapes = set(value.shape for value in arrays)
+			if len(shapes) != 1:
+				raise Exception('%s %s has different shapes among exams: %s' % (mat, field, sorted(shapes)))
+			if arrays[0].dtype.hasobject:
+				raise Exception('%s %s is not a numeric array' % (mat, field))
+			dtype = np.result_type(*arrays)
+			if not present.all():
+				# missing exams are NaN rows of the cached matrix
+				dtype = np.result_type(dtype, np.float32)
+			matrix = np.full((len(examids),) + arrays[0].shape, np.nan if dtype.kind in 'fc' else 0, dtype = dtype)
+			matrix[present] = arrays
+			self.rdb.set_eeg_group_value(self.data_source, examids, mat, field, matrix, present)
+		missing = [examid for examid, has in zip(examids, present) if not has]
+		if missing and not skip_missing:
+			raise MongoDB.NoRecordFoundException('No such item in redis or mongodb: ' + ', '.join(missing) + ' ' + mat + ' ' + field)
+		if missing:
+			matrix = matrix[np.asarray(present, dtype = bool)]
+		return matrix, [examid for examid, has in zip(examids, present) if has], missing
+
+	def get_eeg_signal(self, examid, channels = None, t_start = 0, t_end = None):
+		"""
+		Return raw EEG samples of an exam between t_start and t_end seconds as a channels x samples array,
+		reading only the stored chunks overlapping them, see eeg_raw_store.
+		"""
+		if self.eeg_raw is None:
+			raise Exception(EEG_UNAVAILABLE)
+		return self.eeg_raw.read(examid, channels, t_start, t_end)
+
+	def export_eeg_feature(self, scan_list, mat, field, folder):
+		"""
+		Save the field of an EEG .mat feature of every scan to folder/<scan>_<mat>_<field>.mat
+		Return the list of written paths.
+		"""
+		if type(scan_list) is str:
+			scan_list = [scan_list]
+		if mat.endswith('.mat'):
+			mat = mat[:-4]
+		paths = []
+		for scan, value in zip(scan_list, self.get_eeg_feature(scan_list, mat, field)):
+			path = os.path.join(folder, '%s_%s_%s.mat' % (scan, mat, field))
+			scio.savemat(path, {field: value})
+			paths.append(path)
+		return paths
+
+	def enable_stats(self, enabled = True):
+		"""
+		Turn statistics collection on or off, see stats()
+		"""
+		self.metrics.enabled = enabled
+
+	def stats(self):
+		"""
+		Return a snapshot of the statistics of all tiers:
+			counters - hits, misses, bytes and round_trips per tier (redis, disk, mongo)
+			latency - histograms of redis_get, disk_get, mongo_find, decode and netattr
+		both keyed by data source, atlas and feature.
+		"""
+		return self.metrics.snapshot()
+
+	def reset_stats(self):
+		self.metrics.reset()
+
+	def export_stats(self):
+		"""
+		Return the statistics in Prometheus text format
+		"""
+		return self.metrics.prometheus()
 
-	def save_temp_feature(self, feature_collection, feature_name, value):
-		pass
+	def get_temp_feature(self, feature_collection, feature_name, sources = None):
+		"""
+		Return a value saved by save_temp_feature, from the cache or else from MongoDB.
+		sources - optional list of [source, version] pairs, the value is only served if it was saved with the same ones
+		Raise NoRecordFoundException if it is missing or stale.
+		"""
+		name = 'temp:%s:%s' % (self.data_source, feature_collection)
+		value, saved = self.rdb.get_hash(name, [feature_name + ':value', feature_name + ':sources'])
+		if saved is None:
+			value, saved = self.mdb.get_temp_value(dict(collection = feature_collection, feature = feature_name))
+			self.rdb.set_hash(name, {feature_name + ':value': value, feature_name + ':sources': saved}, ttl = self.rdb.expire_time)
+		if sources is not None and [list(source) for source in saved] != [list(source) for source in sources]:
+			raise MongoDB.NoRecordFoundException((feature_collection, feature_name), 'Its sources changed since it was saved.')
+		return value
+
+	def save_temp_feature(self, feature_collection, feature_name, value, sources = None):
+		"""
+		Save a derived value to MongoDB and the cache.
+		sources - optional list of [source, version] pairs it was derived from, see get_temp_feature
+		"""
+		sources = [] if sources is None else [list(source) for source in sources]
+		self.mdb.put_temp_value(value, dict(collection = feature_collection, feature = feature_name), sources)
+		name = 'temp:%s:%s' % (self.data_source, feature_collection)
+		self.rdb.set_hash(name, {feature_name + ':value': value, feature_name + ':sources': sources}, ttl = self.rdb.expire_time)
+
+	def derived(self, version = '1', name = None):
+		"""
+		Decorator memoizing a function of features in the temp features, e.g.
+			@mmdb.derived(version = '2')
+			def thresholded(nets, threshold = 0.3):
+				...
+			thresholded(scans, 'brodmann_lr', 'BOLD.net', threshold = 0.5)
+		The decorated function takes (scan_list, atlasobj, feature_name, window_length = None, step_size = None,
+		comment = {}, **params) and calls the function on what get_feature (get_dynamic_feature when
+		window_length is given) returns for them, with params.
+		Results are keyed by function name and version, source features and params, and only served
+		while the source documents are unchanged. Bump version whenever the function changes.
+		params must be JSON values or ndarrays, see memo_param.
+		"""
+		def decorator(func):
+			func_name = name if name is not None else func.__module__ + '.' + func.__qualname__
+			@functools.wraps(func)
+			def wrapper(scan_list, atlasobj, feature_name, window_length = None, step_size = None, comment = {}, **params):
+				return self.memoize(func, func_name, version, scan_list, atlasobj, feature_name, window_length, step_size, comment, params)
+			return wrapper
+		return decorator
+
+	def memoize(self, func, func_name, version, scan_list, atlasobj, feature_name, window_length = None, step_size = None, comment = {}, params = {}):
+		"""
+		Return func(features of scan_list, **params), computed once and then read from the temp features,
+		see derived.
+		"""
+		if type(atlasobj) is atlas.Atlas:
+			atlasobj = atlasobj.name
+		scans = [scan_list] if type(scan_list) is str else list(scan_list)
+		if window_length is None:
+			dbname = 'SA' if feature_name.find('.net') == -1 else 'SN'
+		else:
+			dbname = 'DA' if feature_name.find('.net') == -1 else 'DN'
+		versions = self.mdb.feature_versions(dbname, atlasobj, feature_name, scans, comment, window_length, step_size)
+		lacking = [scan for scan in scans if scan not in versions]
+		if lacking:
+			raise MongoDB.NoRecordFoundException('No such item in mongodb: ' + ', '.join(lacking) + ' ' + atlasobj + ' ' + feature_name)
+		sources = [[scan, versions[scan]] for scan in scans]
+		collection = 'derived:%s:%s' % (func_name, version)
+		key = hashlib.sha1(json.dumps(dict(scans = scan_list, atlas = atlasobj, feature = feature_name, window_length = window_length,
+			step_size = step_size, comment = comment, params = params), sort_keys = True, default = memo_param).encode('utf-8')).hexdigest()
+		try:
+			return self.get_temp_feature(collection, key, sources)
+		except MongoDB.NoRecordFoundException:
+			pass
+		if window_length is None:
+			features = self.get_feature(scan_list, atlasobj, feature_name, comment)
+		else:
+			features = self.get_dynamic_feature(scan_list, atlasobj, feature_name, window_length, step_size, comment)
+		value = func(features, **params)
+		self.save_temp_feature(collection, key, value, sources)
+		return value
 
 	def set_cache_list(self, cache_key, value):
 		"""
-		Store a list to redis as cache with cache_key
+		Store a list/ndarray of numbers to redis as a packed series with cache_key
 		"""
-		if (type(cache_key) is not str or not all((type(x) is int or type(x) is float) for x in value)):
+		if type(cache_key) is not str:
+			raise Exception("Please input in the format as follows : key must be str, value must be a list of float or int")
+		value = np.asarray(value)
+		if value.ndim != 1 or value.dtype.kind not in 'iuf':
 			raise Exception("Please input in the format as follows : key must be str, value must be a list of float or int")
 		self.rdb.set_list_all_cache(cache_key, value)
 
@@ -158,19 +457,21 @@ class MMDPDatabase:
 			raise Exception("Please input in the format as follows : key mast be str, value must be int or float")
 		self.rdb.set_list_cache(cache_key, value)
 
-	def get_cache_list(self, cache_key):
+	def get_cache_list(self, cache_key, start = 0, end = -1):
 		"""
-		Return a list with given cache_key in redis
+		Return the list with given cache_key in redis as an ndarray
 		"""
-		return self.rdb.get_list_cache(cache_key)
+		return self.rdb.get_list_cache(cache_key, start, end)
 
-	def save_cache_list(self, cache_key):
+	def save_cache_list(self, cache_key, overwrite = False):
 		"""
-		Save list from redis to MongoDB
+		Save the packed list buffer from redis to MongoDB
 		"""
-		a = self.get_cache_list(cache_key)
+		buf = self.rdb.get_list_buffer(cache_key)
+		if buf is None:
+			raise MongoDB.NoRecordFoundException(cache_key, 'No such list in redis')
 		#self.rdb.delete_key_cache(cache_key)
-		self.mdb.put_temp_data(a,cache_key)
+		self.mdb.put_temp_buffer(buf, dict(cache_key = cache_key), overwrite)
 
 
 	def delete_cache_list(self, cache_key):
@@ -178,30 +479,379 @@ class MMDPDatabase:
 		Remove list from redis and mongo
 		"""
 		self.rdb.delete_key_cache(cache_key)
-		# TODO: delete the list from mongo
+		self.mdb.remove_temp_data(dict(cache_key = cache_key, codec = 'series'))
+
+	def feature_availability(self, atlasobj, feature_name, window_length = None, step_size = None, comment = {}):
+		"""
+		Return the set of scans having the feature in MongoDB.
+		The scan list is fetched with one projected query and kept in the cache for AVAILABILITY_TTL seconds.
+		"""
+		if type(atlasobj) is atlas.Atlas:
+			atlasobj = atlasobj.name
+		if window_length is None:
+			dbname = 'SA' if feature_name.find('.net') == -1 else 'SN'
+		else:
+			dbname = 'DA' if feature_name.find('.net') == -1 else 'DN'
+		name = 'availability:%s:%s:%s:%s' % (self.data_source, dbname, self.mdb.getcol(atlasobj, feature_name, window_length, step_size),
+			json.dumps(comment, sort_keys = True))
+		scans = self.rdb.get_hash(name)
+		if not scans:
+			scans = dict.fromkeys(self.mdb.scans_with_feature(dbname, atlasobj, feature_name, comment, window_length, step_size), 1)
+			# an empty hash cannot be stored, empty collections are simply queried again
+			if scans:
+				self.rdb.set_hash_all(name, scans, ttl = AVAILABILITY_TTL)
+		return set(scans)
+
+	def resolve_cohort(self, selection, atlasobj, features = [], dynamic_configs = [], comment = {}):
+		"""
+		Check which scans of a cohort have all requested features before any value is read.
+		selection - a CohortQuery (see SQLiteDB.cohort) or a list of scan names
+		features - static feature names, e.g. ['BOLD.net', 'BOLD.net.inter-region_bc']
+		dynamic_configs - (feature name, window length, step size) tuples of dynamic features
+		Return (available, missing): the scans having every feature, in selection order,
+		and a dict of feature -> list of scans lacking it, features keyed by name
+		or by (name, window length, step size).
+		"""
+		if isinstance(selection, cohort_query.CohortQuery):
+			selection = selection.scans()
+		missing = {}
+		lacking = set()
+		requested = [(feature, None, None) for feature in features] + [tuple(config) for config in dynamic_configs]
+		for feature_name, window_length, step_size in requested:
+			found = self.feature_availability(atlasobj, feature_name, window_length, step_size, comment)
+			scans = [scan for scan in selection if scan not in found]
+			if scans:
+				missing[feature_name if window_length is None else (feature_name, window_length, step_size)] = scans
+				lacking.update(scans)
+		return [scan for scan in selection if scan not in lacking], missing
+
+	def group_scans(self, group):
+		"""
+		Return (scan list, group name or None) of a group name, Group object, CohortQuery or list of scans
+		"""
+		if type(group) is str:
+			return [scan.filename for scan in self.sdb.getMRIScansInGroup(group, lightweight = True)], group
+		elif isinstance(group, tables.Group):
+			return sorted(scan.filename for scan in group.mriscans), group.name
+		elif isinstance(group, cohort_query.CohortQuery):
+			return group.scans(), None
+		return list(group), None
 
-	def get_study(self, alias):
+	def aggregate(self, group, atlasobj, feature_name, stats = ['mean', 'std', 'count'], window_length = None, step_size = None,
+				  comment = {}, batch_size = 20, ddof = 1):
+		"""
+		Element-wise statistics of a feature over the scans of a group, without holding all values.
+		group - group name, Group object, CohortQuery or list of scans
+		stats - any of AGGREGATE_STATS, var and std with ddof degrees of freedom
+		window_length, step_size - aggregate a dynamic feature
+		Values are read batch_size scans at a time and folded into a running count, mean and sum of
+		squared deviations with the pairwise Welford update. The running state is kept in the cache
+		for AGGREGATE_TTL seconds, keyed by the hash of the members and their feature versions, so an
+		unchanged group is not read again while a feature saved again is. For a named group that only
+		gained scans since the last call just the new scans are read, and the former state is dropped.
+		Every scan must have a value of the same shape, so a dynamic feature is only aggregated over
+		scans with the same number of slices.
+		Return a dict of stat -> value.
+		"""
+		if type(atlasobj) is atlas.Atlas:
+			atlasobj = atlasobj.name
+		unknown = [stat for stat in stats if stat not in AGGREGATE_STATS]
+		if unknown:
+			raise Exception('Unknown statistics %s, choose from %s' % (unknown, AGGREGATE_STATS))
+		scans, group_name = self.group_scans(group)
+		if not scans:
+			raise Exception('No scans in group %s' % group)
+		scans = sorted(set(scans))
+		if window_length is None:
+			dbname = 'SA' if feature_name.find('.net') == -1 else 'SN'
+		else:
+			dbname = 'DA' if feature_name.find('.net') == -1 else 'DN'
+		versions = self.mdb.feature_versions(dbname, atlasobj, feature_name, scans, comment, window_length, step_size)
+		name = 'aggregate:%s:%s:%s:%s:%s:%s' % (self.data_source, atlasobj, feature_name, window_length, step_size, json.dumps(comment, sort_keys = True))
+		digest = hashlib.sha1('\n'.join('%s:%s' % (scan, versions.get(scan, '')) for scan in scans).encode('utf-8')).hexdigest()
+		state = self.load_aggregate(name, digest)
+		latest = self.rdb.get_hash(name, ['latest:' + group_name])[0] if group_name is not None else None
+		if state is None:
+			state = dict(members = [], versions = [], count = 0, mean = None, m2 = None, min = None, max = None)
+			previous = self.load_aggregate(name, latest) if latest is not None else None
+			if previous is not None and set(previous['members']) <= set(scans) \
+				and all(versions.get(scan) == version for scan, version in zip(previous['members'], previous['versions'])):
+				state = previous
+			folded = set(state['members'])
+			pending = [scan for scan in scans if scan not in folded]
+			for start in range(0, len(pending), batch_size):
+				batch = pending[start:start + batch_size]
+				if window_length is None:
+					values = self.get_feature(batch, atlasobj, feature_name, comment)
+				else:
+					values = self.get_dynamic_feature(batch, atlasobj, feature_name, window_length, step_size, comment)
+				shape = state['mean'].shape if state['count'] else np.shape(values[0].data)
+				for scan, value in zip(batch, values):
+					if np.shape(value.data) != shape:
+						# e.g. dynamic features of scans of different lengths, nothing is saved
+						raise Exception('Cannot aggregate %s %s of %s: shape %s differs from %s of the other scans' % (atlasobj,
+							feature_name, scan, np.shape(value.data), shape))
+				fold_aggregate(state, np.array([value.data for value in values], dtype = np.float64))
+				state['members'] += batch
+				state['versions'] += [versions.get(scan, '') for scan in batch]
+			self.save_aggregate(name, digest, state)
+		if group_name is not None and latest != digest:
+			self.rdb.set_hash(name, 'latest:' + group_name, digest, ttl = AGGREGATE_TTL)
+			if latest is not None:
+				# superseded by the new membership or feature versions
+				self.rdb.delete_hash(name + ':' + latest)
+		count = state['count']
+		ret = {}
+		for stat in stats:
+			if stat == 'count':
+				ret[stat] = count
+			elif stat == 'sum':
+				ret[stat] = state['mean'] * count
+			elif stat == 'mean':
+				ret[stat] = state['mean']
+			elif stat in ('var', 'std'):
+				var = state['m2'] / (count - ddof) if count > ddof else np.full_like(state['m2'], np.nan)
+				ret[stat] = var if stat == 'var' else np.sqrt(var)
+			else:
+				ret[stat] = state[stat]
+		return ret
+
+	def load_aggregate(self, name, digest):
+		"""
+		The aggregate state of one membership is a hash of its own, expiring after AGGREGATE_TTL seconds
+		"""
+		fields = ['members', 'versions', 'mean', 'm2', 'min', 'max']
+		values = self.rdb.get_hash(name + ':' + digest, fields)
+		if any(value is None for value in values):
+			return None
+		state = dict(zip(fields, values))
+		state['members'] = list(state['members'])
+		state['versions'] = list(state['versions'])
+		state['count'] = len(state['members'])
+		return state
+
+	def save_aggregate(self, name, digest, state):
+		fields = ['members', 'versions', 'mean', 'm2', 'min', 'max']
+		self.rdb.set_hash_all(name + ':' + digest, dict((field, state[field]) for field in fields), ttl = AGGREGATE_TTL)
+
+	def get_study(self, alias, lightweight = False):
 		# TODO: input part of alias and search automatically
-		return self.sdb.getResearchStudy(alias)
+		return self.sdb.getResearchStudy(alias, lightweight)
 
-	def get_group(self, group_name):
+	def get_group(self, group_name, lightweight = False):
 		# TODO: input part of group_name and search automatically
-		session = self.sdb.new_session()
-		return session.query(tables.Group).filter_by(name = group_name).one()
+		return self.sdb.get_group(group_name, lightweight)
+
+
+def memo_param(obj):
+	"""
+	JSON encoding of the memoize key for values json cannot encode: ndarrays by dtype, shape
+	and a hash of their items, numpy scalars as Python ones. Anything else is rejected, its
+	repr may not tell values apart (numpy truncates the repr of large arrays).
+	"""
+	if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+		return dict(dtype = obj.dtype.str, shape = obj.shape, sha1 = hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest())
+	elif isinstance(obj, np.generic):
+		return obj.item()
+	raise Exception('Cannot memoize a parameter of type %s, use JSON values or ndarrays' % type(obj).__name__)
+
+def fold_aggregate(state, values):
+	"""
+	Fold a batch of values (scans first) into a running aggregate state,
+	merging the batch mean and squared deviations with the pairwise Welford update.
+	"""
+	count = values.shape[0]
+	mean = values.mean(axis = 0)
+	m2 = ((values - mean) ** 2).sum(axis = 0)
+	if state['count'] == 0:
+		state.update(count = count, mean = mean, m2 = m2, min = values.min(axis = 0), max = values.max(axis = 0))
+		return
+	if mean.shape != state['mean'].shape:
+		raise Exception('Values of shape %s cannot be aggregated with %s' % (mean.shape, state['mean'].shape))
+	total = state['count'] + count
+	delta = mean - state['mean']
+	state['mean'] = state['mean'] + delta * (count / total)
+	state['m2'] = state['m2'] + m2 + delta ** 2 * (state['count'] * count / total)
+	state['min'] = np.minimum(state['min'], values.min(axis = 0))
+	state['max'] = np.maximum(state['max'], values.max(axis = 0))
+	state['count'] = total
 
+def eeg_gender(gen):
+	if gen == 0:
+		return 'F'
+	else:
+		return 'M'
+
+def parse_eeg_record(path):
+	"""
+	Parse one recordInformation.json into plain dicts of machine, scan and person columns.
+	Module level so that it can run in a process pool.
+	"""
+	with open(path, 'r', encoding = 'utf-8-sig') as f:
+		eegjson = json.load(f)
+	machine = dict(devicename = eegjson["DeviceName"],
+				   devicemode = eegjson["DeviceMode"],
+				   recordchannelsettinggroup = eegjson["RecordChannelSettingGroup"],
+				   recordmontagename = eegjson["RecordMontageName"],
+				   recordprotocolname = eegjson["RecordProtocolName"],
+				   recordeegcapname = eegjson["RecordEEGCapName"])
+	scan = dict(examid = eegjson["ExamID"],
+				date = clock.eeg_time(eegjson["ExamTime"]),
+				examitem = eegjson["ExamItem"],
+				impedancepos = ','.join(eegjson["ImpedanceData"]["Item1"]),
+				impedancedata = ','.join([str(i) for i in eegjson["ImpedanceData"]["Item2"]]),
+				impedanceonline = eegjson["ImpedanceOnline"],
+				begintimestamp = ','.join([str(i["BeginTimeStamp"]) for i in eegjson["DataFileInformations"]]),
+				digitalmin = eegjson["DigitalMinimum"],
+				digitalmax = eegjson["DigitalMaximum"],
+				physicalmin = eegjson["PhysicalMinimum"],
+				physicalmax = eegjson["PhysicalMaximum"],
+				samplerate = eegjson["SampleRate"])
+	person = dict(name_chinese = eegjson["PatientName"],
+				  eegid = eegjson["PatientID"],
+				  gender = eeg_gender(eegjson["Gender"]),
+				  birth = clock.eeg_time(eegjson["BirthDate"]))
+	return machine, scan, person
+
+class MissingRecordException(Exception):
+	"""
+	missing - dict of kind ('missing names', 'ambiguous names', 'missing scans', ...) -> list of values
+	"""
+
+	def __init__(self, missing):
+		super(MissingRecordException, self).__init__()
+		self.missing = missing
+
+	def __str__(self):
+		return '; '.join('%d %s: %s' % (len(values), kind, ', '.join(str(v) for v in values)) for kind, values in self.missing.items())
+
+	def __repr__(self):
+		return 'MissingRecordException(%r)' % self.missing
 
 class SQLiteDB:
 	"""
 	SQLite stores meta-info like patient information, scan date, group
 	relationships, research study cases and so on.
 	"""
-	def __init__(self, dbFilePath = rootconfig.dms.mmdpdb_filepath):
-		self.engine = create_engine('sqlite:///' + dbFilePath)
-		self.Session = sessionmaker(bind = self.engine)
-		self.session = self.Session()
+	def __init__(self, dbFilePath = rootconfig.dms.mmdpdb_filepath, snapshot = False, refresh_interval = 30, journal_mode = 'WAL',
+				 pool_size = 8, busy_timeout = 30, metadata_cache_size = 10000, metadata_store = None):
+		"""
+		Sessions are scoped to the calling thread: self.session is the thread's own
+		session, so the query methods can be called from many threads at once.
+		Call remove_session() at the end of a request or thread to release it.
+		snapshot - read-only mode: the whole database is copied into memory with the
+			SQLite backup API and all queries are served from the copy. A watcher thread
+			reloads it every refresh_interval seconds if the file's mtime or data_version changed.
+		journal_mode - journal mode set on every writer connection, WAL lets readers
+			proceed while a writer commits.
+		pool_size - connections kept open to the database file, as many more may be opened under load
+		busy_timeout - seconds a writer waits for another writer's lock before failing
+		metadata_cache_size - records kept by the lookup cache, see get_mriscan_records
+		metadata_store - optional RedisDatabase/DiskCacheDatabase whose hashes back the lookup cache
+		"""
+		self.metadata = metadata_cache.MetadataCache(metadata_cache_size, metadata_store)
+		self.dbFilePath = dbFilePath
+		self.snapshot = snapshot
+		if snapshot:
+			self.refresh_interval = refresh_interval
+			self.version_conn = sqlite3.connect(dbFilePath, check_same_thread = False)
+			self.snapshot_lock = threading.Lock()
+			self.load_snapshot()
+			self.watcher = threading.Thread(target = self.watch_snapshot, daemon = True)
+			self.watcher.start()
+		else:
+			# pooled connections are handed from thread to thread, each is used by one session at a time
+			self.engine = create_engine('sqlite:///' + dbFilePath, poolclass = QueuePool, pool_size = pool_size, max_overflow = pool_size,
+				connect_args = {'check_same_thread': False, 'timeout': busy_timeout})
+			if journal_mode is not None:
+				def set_journal_mode(dbapi_connection, connection_record):
+					dbapi_connection.execute('PRAGMA journal_mode=%s' % journal_mode)
+				event.listen(self.engine, 'connect', set_journal_mode)
+			self.Session = scoped_session(sessionmaker(bind = self.engine))
 
-	def new_session(self):
+	def file_version(self):
+		"""
+		Return what identifies the current content of the database file.
+		"""
+		stat = os.stat(self.dbFilePath)
+		data_version = self.version_conn.execute('PRAGMA data_version').fetchone()[0]
+		return stat.st_mtime_ns, stat.st_size, data_version
+
+	def load_snapshot(self):
+		"""
+		Copy the database file into a new in-memory connection and switch all
+		later queries to it. Objects loaded from the former snapshot stay usable.
+		"""
+		with self.snapshot_lock:
+			version = self.file_version()
+			memory = sqlite3.connect(':memory:', check_same_thread = False)
+			source = sqlite3.connect(self.dbFilePath)
+			try:
+				source.backup(memory)
+			finally:
+				source.close()
+			memory.execute('PRAGMA query_only=ON')
+			engine = create_engine('sqlite://', creator = lambda: memory, poolclass = StaticPool)
+			# sessions of all threads share the single read-only in-memory connection
+			self.engine, self.Session = engine, scoped_session(sessionmaker(bind = engine))
+			self.snapshot_version = version
+
+	def refresh_snapshot(self, force = False):
+		"""
+		Reload the in-memory snapshot if the database file changed.
+		Return True if it was reloaded.
+		"""
+		if force or self.file_version() != self.snapshot_version:
+			self.load_snapshot()
+			self.metadata.clear()
+			return True
+		return False
+
+	def watch_snapshot(self):
+		while True:
+			time.sleep(self.refresh_interval)
+			try:
+				self.refresh_snapshot()
+			except Exception as e:
+				print('Unable to refresh the SQLite snapshot: ' + str(e))
+
+	@property
+	def session(self):
+		"""
+		The session of the calling thread
+		"""
 		return self.Session()
+
+	def remove_session(self):
+		"""
+		Close the session of the calling thread, e.g. at the end of a request.
+		"""
+		self.Session.remove()
+
+	def new_session(self):
+		"""
+		Return a new session independent of the thread's one, the caller has to close it.
+		Prefer session_scope().
+		"""
+		return self.Session.session_factory()
+
+	@contextmanager
+	def session_scope(self):
+		"""
+		Context manager of a new session, committed if the block succeeds,
+		rolled back if it raises, and closed in both cases.
+			with sdb.session_scope() as session:
+				session.add(scan)
+		"""
+		session = self.new_session()
+		try:
+			yield session
+			session.commit()
+		except Exception:
+			session.rollback()
+			raise
+		finally:
+			session.close()
 	
 	def init(self):
 		tables.Base.metadata.create_all(self.engine)
@@ -235,6 +885,7 @@ class SQLiteDB:
 				person = self.session.query(tables.Person).filter_by(name = name).one()
 				person.mriscans.append(db_mriscan)
 				self.session.commit()
+				self.metadata.clear()
 				print('Old patient new scan %s inserted' % scan)
 				return 0
 		except MultipleResultsFound:
@@ -244,15 +895,106 @@ class SQLiteDB:
 		db_person.mriscans.append(db_mriscan)
 		self.session.add(db_person)
 		self.session.commit()
+		self.metadata.clear()
 		print('New patient new scan %s inserted' % scan)
 		return 0
 
-	def insert_eegrow(self, eegjson):
-		def to_gender(gen):
-			if gen == 0:
-				return 'F'
+	def import_mri_folder(self, mrifolder = None, scan_list = None, workers = 16):
+		"""
+		Register all scans of an MRI data folder at once.
+		scan_info.json files are read in parallel, existing persons, scans and machines
+		are preloaded, machines are deduplicated and everything is inserted in one
+		transaction with bulk inserts.
+		scan_list - only import these scan folders, default all folders named name_date
+		Return a dict with lists of 'inserted', 'skipped' (already registered) scans,
+		'conflicting' (scan, reason) pairs and 'failed' (scan, error) pairs for unreadable
+		or malformed scan_info.json files.
+		"""
+		if mrifolder is None:
+			mrifolder = rootconfig.dms.folder_mridata
+		if scan_list is None:
+			scan_list = [scan for scan in sorted(os.listdir(mrifolder))
+						 if scan.count('_') == 1 and os.path.isfile(os.path.join(mrifolder, scan, 'scan_info.json'))]
+		report = dict(inserted = [], skipped = [], conflicting = [], failed = [])
+		session = self.session
+		existing_scans = set(filename for (filename,) in session.query(tables.MRIScan.filename))
+		people = {}
+		for person in session.query(tables.Person).filter(tables.Person.name.isnot(None)):
+			people.setdefault(person.name, []).append(person)
+		machines = {}
+		for machine in session.query(tables.MRIMachine):
+			machines.setdefault((machine.institution, machine.manufacturer, machine.modelname), machine)
+
+		new_scans = []
+		for scan in scan_list:
+			if scan in existing_scans:
+				report['skipped'].append(scan)
+			else:
+				new_scans.append(scan)
+		def read_scan(scan):
+			folder = os.path.join(mrifolder, scan)
+			scan_info = loadsave.load_json(os.path.join(folder, 'scan_info.json'))
+			patientid = scan_info['Patient']['ID']
+			machine_key = (scan_info['Machine']['Institution'], scan_info['Machine']['Manufacturer'], scan_info['Machine']['ManufacturerModelName'])
+			modalities = dict((key, os.path.isfile(os.path.join(folder, filename))) for key, filename in MRI_MODALITY_FILES.items())
+			return scan_info, patientid, machine_key, modalities
+		with ThreadPoolExecutor(max_workers = workers) as pool:
+			futures = [(scan, pool.submit(read_scan, scan)) for scan in new_scans]
+			infos = []
+			for scan, future in futures:
+				try:
+					infos.append((scan,) + future.result())
+				except Exception as e:
+					report['failed'].append((scan, '%s: %s' % (type(e).__name__, e)))
+
+		new_people = {}
+		new_machines = {}
+		pending = []
+		for scan, scan_info, patientid, machine_key, modalities in infos:
+			name, date = scan.split('_')
+			candidates = people.get(name, [])
+			if len(candidates) > 1:
+				report['conflicting'].append((scan, 'multiple person records found for %s' % name))
+				continue
+			elif len(candidates) == 1:
+				if candidates[0].patientid != patientid:
+					report['conflicting'].append((scan, 'patient id %s differs from registered %s' % (patientid, candidates[0].patientid)))
+					continue
+				person = candidates[0]
 			else:
-				return 'M'
+				person = new_people.get(name)
+				if person is None:
+					person = new_people[name] = tables.Person.build_person(name, scan_info)
+				elif person.patientid != patientid:
+					report['conflicting'].append((scan, 'patient id %s differs from %s in this import' % (patientid, person.patientid)))
+					continue
+			machine = machines.get(machine_key)
+			if machine is None:
+				machine = machines[machine_key] = new_machines[machine_key] = tables.MRIMachine(institution = machine_key[0],
+					manufacturer = machine_key[1], modelname = machine_key[2])
+			pending.append((scan, clock.simple_to_time(date), modalities, person, machine))
+
+		try:
+			session.add_all(list(new_people.values()) + list(new_machines.values()))
+			session.flush()
+			rows = [dict(filename = scan, date = dateobj, person_id = person.id, mrimachine_id = machine.id,
+						 hasT1 = modalities['hasT1'], hasT2 = modalities['hasT2'], hasBOLD = modalities['hasBOLD'], hasDWI = modalities['hasDWI'])
+					for scan, dateobj, modalities, person, machine in pending]
+			if rows:
+				session.execute(tables.MRIScan.__table__.insert(), rows)
+			session.commit()
+		except Exception:
+			session.rollback()
+			raise
+		# the bulk insert bypassed the ORM, make relationships reload
+		session.expire_all()
+		self.metadata.clear()
+		report['inserted'] = [row['filename'] for row in rows]
+		print('%d scans inserted, %d skipped, %d conflicting, %d failed' % (len(report['inserted']), len(report['skipped']), len(report['conflicting']), len(report['failed'])))
+		return report
+
+	def insert_eegrow(self, eegjson):
+		to_gender = eeg_gender
 		try:
 			ret = self.session.query(tables.EEGScan).filter(tables.EEGScan.examid == eegjson['ExamID']).scalar()
 			if ret:
@@ -297,6 +1039,7 @@ class SQLiteDB:
 				raise Exception('Information about %s is not consistent' % eegjson["PatientName"])
 			person.eegscans.append(scan)
 			self.session.commit()
+			self.metadata.clear()
 			print('Old patient new scan %s inserted' % eegjson["PatientName"])
 			return 0
 		except MultipleResultsFound:
@@ -311,20 +1054,247 @@ class SQLiteDB:
 			self.session.add(person)
 			person.eegscans.append(scan)
 			self.session.commit()
+			self.metadata.clear()
 			print('New patient new scan %s inserted' % eegjson["PatientName"])
 			return 0
 
-	def getMRIScansInGroup(self, groupName):
-		group = self.session.query(tables.Group).filter_by(name = groupName).one()
-		return group.mriscans
+	def import_eeg_folder(self, eegfolder, workers = None, batch_size = 500):
+		"""
+		Register all EEG exams below eegfolder, one recordInformation.json per exam folder.
+		JSON files are parsed in a process pool, machines, persons and exams already in the
+		database are loaded with one query each, and exams are inserted in transactions
+		of batch_size exams.
+		Return a dict with lists of 'inserted' and 'skipped' exam ids, 'conflicting'
+		(examid, reason) pairs for gender/birth mismatches and 'failed' (path, error) pairs.
+		"""
+		paths = []
+		for root, dirs, files in os.walk(eegfolder):
+			if 'recordInformation.json' in files:
+				paths.append(os.path.join(root, 'recordInformation.json'))
+		paths.sort()
+		report = dict(inserted = [], skipped = [], conflicting = [], failed = [])
+		session = self.session
+		existing_exams = set(examid for (examid,) in session.query(tables.EEGScan.examid))
+		machines = {}
+		for machine in session.query(tables.EEGMachine):
+			machines.setdefault(machine.devicename, machine)
+		people = {}
+		for person in session.query(tables.Person).filter(tables.Person.eegid.isnot(None)):
+			people.setdefault((person.name_chinese, person.eegid), []).append(person)
+
+		with ProcessPoolExecutor(max_workers = workers) as pool:
+			futures = [pool.submit(parse_eeg_record, path) for path in paths]
+			records = []
+			for path, future in zip(paths, futures):
+				try:
+					records.append(future.result())
+				except Exception as e:
+					report['failed'].append((path, str(e)))
+
+		for start in range(0, len(records), batch_size):
+			new_objects = []
+			pending = []
+			for machine_cols, scan_cols, person_cols in records[start:start + batch_size]:
+				examid = scan_cols['examid']
+				if examid in existing_exams:
+					report['skipped'].append(examid)
+					continue
+				candidates = people.get((person_cols['name_chinese'], person_cols['eegid']), [])
+				if len(candidates) > 1:
+					report['conflicting'].append((examid, 'multiple person records found for %s' % person_cols['name_chinese']))
+					continue
+				elif len(candidates) == 1:
+					person = candidates[0]
+					if person.gender != person_cols['gender'] or person.birth != person_cols['birth']:
+						report['conflicting'].append((examid, 'Information about %s is not consistent' % person_cols['name_chinese']))
+						continue
+				else:
+					person = tables.Person(**person_cols)
+					people[(person_cols['name_chinese'], person_cols['eegid'])] = [person]
+					new_objects.append(person)
+				machine = machines.get(machine_cols['devicename'])
+				if machine is None:
+					machine = machines[machine_cols['devicename']] = tables.EEGMachine(**machine_cols)
+					new_objects.append(machine)
+				existing_exams.add(examid)
+				pending.append((scan_cols, person, machine))
+			try:
+				session.add_all(new_objects)
+				session.flush()
+				rows = [dict(scan_cols, person_id = person.id, eegmachine_id = machine.id) for scan_cols, person, machine in pending]
+				if rows:
+					session.execute(tables.EEGScan.__table__.insert(), rows)
+				session.commit()
+			except Exception:
+				session.rollback()
+				raise
+			report['inserted'] += [row['examid'] for row in rows]
+		session.expire_all()
+		self.metadata.clear()
+		print('%d exams inserted, %d skipped, %d conflicting, %d failed' % (len(report['inserted']), len(report['skipped']), len(report['conflicting']), len(report['failed'])))
+		return report
+
+	def group_query(self):
+		"""
+		Query of groups eagerly loading scans, their people and machines,
+		and the people of the group, in a fixed number of SELECTs.
+		"""
+		return self.session.query(tables.Group).options(
+			selectinload(tables.Group.mriscans).selectinload(tables.MRIScan.person),
+			selectinload(tables.Group.mriscans).selectinload(tables.MRIScan.machine),
+			selectinload(tables.Group.eegscans).selectinload(tables.EEGScan.person),
+			selectinload(tables.Group.eegscans).selectinload(tables.EEGScan.machine),
+			selectinload(tables.Group.people))
+
+	def scan_record_columns(self, kind):
+		"""
+		Return (scan table, machine table, machine id column, record columns, record class)
+		of the records of kind 'mriscans' or 'eegscans'.
+		"""
+		people = tables.Person.__table__
+		if kind == 'mriscans':
+			scans = tables.MRIScan.__table__
+			machines = tables.MRIMachine.__table__
+			columns = [scans.c.id, scans.c.filename, scans.c.date, scans.c.hasT1, scans.c.hasT2, scans.c.hasBOLD, scans.c.hasDWI,
+					   people.c.id, people.c.name, people.c.gender, people.c.birth,
+					   machines.c.institution, machines.c.manufacturer, machines.c.modelname]
+			return scans, machines, scans.c.mrimachine_id, columns, MRIScanRecord
+		elif kind == 'eegscans':
+			scans = tables.EEGScan.__table__
+			machines = tables.EEGMachine.__table__
+			columns = [scans.c.id, scans.c.examid, scans.c.date, scans.c.examitem, scans.c.samplerate,
+					   people.c.id, people.c.name_chinese, people.c.eegid, people.c.gender, people.c.birth,
+					   machines.c.devicename, machines.c.devicemode]
+			return scans, machines, scans.c.eegmachine_id, columns, EEGScanRecord
+		else:
+			raise Exception("kind must be 'mriscans' or 'eegscans'")
+
+	def group_records(self, kind, groupNames):
+		"""
+		Return a dict of group name -> list of records for kind 'mriscans', 'eegscans' or 'people',
+		fetched with a single joined SELECT.
+		"""
+		metadata = tables.Base.metadata
+		groups = tables.Group.__table__
+		people = tables.Person.__table__
+		if kind == 'people':
+			assoc = metadata.tables['association_group_person']
+			columns = [people.c.id, people.c.name, people.c.name_chinese, people.c.gender, people.c.birth,
+					   people.c.patientid, people.c.eegid, people.c.mriid]
+			rows = self.session.query(groups.c.name, *columns).select_from(groups) \
+				.join(assoc, assoc.c.group_id == groups.c.id) \
+				.join(people, people.c.id == assoc.c.person_id) \
+				.filter(groups.c.name.in_(groupNames)).order_by(people.c.name)
+			ret = dict((name, []) for name in groupNames)
+			for row in rows:
+				ret[row[0]].append(PersonRecord(*row[1:]))
+			return ret
+		scans, machines, machine_id, columns, record = self.scan_record_columns(kind)
+		assoc = metadata.tables['association_group_mriscan' if kind == 'mriscans' else 'association_group_eegscan']
+		rows = self.session.query(groups.c.name, *columns).select_from(groups) \
+			.join(assoc, assoc.c.group_id == groups.c.id) \
+			.join(scans, scans.c.id == assoc.c.scan_id) \
+			.outerjoin(people, people.c.id == scans.c.person_id) \
+			.outerjoin(machines, machines.c.id == machine_id) \
+			.filter(groups.c.name.in_(groupNames)).order_by(columns[1])
+		ret = dict((name, []) for name in groupNames)
+		for row in rows:
+			ret[row[0]].append(record(*row[1:]))
+		return ret
+
+	def scan_records(self, kind, column, values):
+		"""
+		Return the records of kind 'mriscans' or 'eegscans' whose column is in values,
+		with one IN query per IN_CHUNK values.
+		"""
+		scans, machines, machine_id, columns, record = self.scan_record_columns(kind)
+		people = tables.Person.__table__
+		ret = []
+		for start in range(0, len(values), IN_CHUNK):
+			rows = self.session.query(*columns).select_from(scans) \
+				.outerjoin(people, people.c.id == scans.c.person_id) \
+				.outerjoin(machines, machines.c.id == machine_id) \
+				.filter(column.in_(values[start:start + IN_CHUNK])).order_by(columns[1])
+			ret += [record(*row) for row in rows]
+		return ret
 
-	def getEEGScansInGroup(self, groupName):
-		group = self.session.query(tables.Group).filter_by(name = groupName).one()
-		return group.eegscans
+	def get_mriscan_records(self, filenames):
+		"""
+		Return a dict of filename -> MRIScanRecord, memoized in self.metadata.
+		Unknown filenames are left out.
+		"""
+		ret = self.metadata.get_many('mriscan', filenames)
+		missing = [filename for filename in dict.fromkeys(filenames) if filename not in ret]
+		if missing:
+			found = dict((rec.filename, rec) for rec in self.scan_records('mriscans', tables.MRIScan.__table__.c.filename, missing))
+			self.metadata.put_many('mriscan', found)
+			ret.update(found)
+		return ret
 
-	def getNamesInGroup(self, groupName):
-		group = self.session.query(tables.Group).filter_by(name = groupName).one()
-		return group.people
+	def get_mriscan_record(self, filename):
+		ret = self.get_mriscan_records([filename])
+		if filename not in ret:
+			raise NoResultFound('No MRI scan %s' % filename)
+		return ret[filename]
+
+	def get_eegscan_records(self, examids):
+		"""
+		Return a dict of examid -> EEGScanRecord, memoized in self.metadata.
+		Unknown exams are left out.
+		"""
+		ret = self.metadata.get_many('eegscan', examids)
+		missing = [examid for examid in dict.fromkeys(examids) if examid not in ret]
+		if missing:
+			found = dict((rec.examid, rec) for rec in self.scan_records('eegscans', tables.EEGScan.__table__.c.examid, missing))
+			self.metadata.put_many('eegscan', found)
+			ret.update(found)
+		return ret
+
+	def get_eegscan_record(self, examid):
+		ret = self.get_eegscan_records([examid])
+		if examid not in ret:
+			raise NoResultFound('No EEG exam %s' % examid)
+		return ret[examid]
+
+	def get_person_mriscan_records(self, person_name):
+		"""
+		Return the tuple of MRIScanRecords of a person ordered by filename, memoized in self.metadata.
+		"""
+		ret = self.metadata.get('person', person_name)
+		if ret is None:
+			# raise if the name is unknown or ambiguous, like get_all_mriscans_of_person
+			self.session.query(tables.Person.id).filter_by(name = person_name).one()
+			ret = tuple(self.scan_records('mriscans', tables.Person.__table__.c.name, [person_name]))
+			self.metadata.put('person', person_name, ret)
+		return ret
+
+	def get_group(self, groupName, lightweight = False):
+		"""
+		Return the group with scans, people and machines loaded eagerly.
+		lightweight - return a dict of 'mriscans', 'eegscans' and 'people' record lists instead of the ORM object
+		"""
+		if lightweight:
+			self.session.query(tables.Group.id).filter_by(name = groupName).one()
+			return dict((kind, self.group_records(kind, [groupName])[groupName]) for kind in ['mriscans', 'eegscans', 'people'])
+		return self.group_query().filter_by(name = groupName).one()
+
+	def getMRIScansInGroup(self, groupName, lightweight = False):
+		if lightweight:
+			self.session.query(tables.Group.id).filter_by(name = groupName).one()
+			return self.group_records('mriscans', [groupName])[groupName]
+		return self.get_group(groupName).mriscans
+
+	def getEEGScansInGroup(self, groupName, lightweight = False):
+		if lightweight:
+			self.session.query(tables.Group.id).filter_by(name = groupName).one()
+			return self.group_records('eegscans', [groupName])[groupName]
+		return self.get_group(groupName).eegscans
+
+	def getNamesInGroup(self, groupName, lightweight = False):
+		if lightweight:
+			self.session.query(tables.Group.id).filter_by(name = groupName).one()
+			return self.group_records('people', [groupName])[groupName]
+		return self.get_group(groupName).people
 
 	def getAllGroups(self):
 		"""
@@ -332,98 +1302,171 @@ class SQLiteDB:
 		"""
 		return self.session.query(tables.Group).all()
 
-	def getResearchStudy(self, alias):
-		return self.session.query(tables.ResearchStudy).filter_by(alias = alias).one()
+	def getResearchStudy(self, alias, lightweight = False):
+		"""
+		Return the research study with its groups, their scans, people and machines loaded eagerly.
+		lightweight - return a dict of group name -> dict of 'mriscans', 'eegscans' and 'people' record lists
+		"""
+		if lightweight:
+			study = self.session.query(tables.ResearchStudy.id).filter_by(alias = alias).one()
+			assoc = tables.Base.metadata.tables['association_group_study']
+			groups = tables.Group.__table__
+			groupNames = [name for (name,) in self.session.query(groups.c.name).select_from(groups)
+						  .join(assoc, assoc.c.group_id == groups.c.id).filter(assoc.c.study_id == study.id)]
+			records = dict((kind, self.group_records(kind, groupNames)) for kind in ['mriscans', 'eegscans', 'people'])
+			return dict((name, dict((kind, records[kind][name]) for kind in records)) for name in groupNames)
+		return self.session.query(tables.ResearchStudy).options(
+			selectinload(tables.ResearchStudy.groups).selectinload(tables.Group.mriscans).selectinload(tables.MRIScan.person),
+			selectinload(tables.ResearchStudy.groups).selectinload(tables.Group.mriscans).selectinload(tables.MRIScan.machine),
+			selectinload(tables.ResearchStudy.groups).selectinload(tables.Group.eegscans).selectinload(tables.EEGScan.person),
+			selectinload(tables.ResearchStudy.groups).selectinload(tables.Group.eegscans).selectinload(tables.EEGScan.machine),
+			selectinload(tables.ResearchStudy.groups).selectinload(tables.Group.people)).filter_by(alias = alias).one()
+
+	def cohort(self, kind = 'mri'):
+		"""
+		Return a CohortQuery selecting MRI scans (kind 'mri') or EEG exams (kind 'eeg'),
+		e.g. sdb.cohort().gender('F').age(50, 70).modalities(hasBOLD = True).scans()
+		"""
+		return cohort_query.CohortQuery(self.session, kind)
 
 	def getHealthyGroup(self):
 		"""
 		"""
 		return self.session.query(tables.Group).filter_by(name = 'Changgung HC').one()
 
-	def newGroupByScans_forMRI(self, groupName, scanList, desc = None):
+	def lookup_ids(self, column, values):
 		"""
-		Initialize a group by a list of mriscans
+		Return a dict of value -> list of ids of the rows whose column equals value,
+		looked up with IN queries of at most IN_CHUNK values.
 		"""
-		group = tables.Group(name = groupName, description = desc)
-		# check if group already exist
-		try:
-			self.session.query(tables.Group).filter_by(name = groupName).one()
-		except NoResultFound:
-			# alright
-			for scan in scanList:
-				db_scan = self.session.query(tables.MRIScan).filter_by(filename = scan).one()
-				group.mriscans.append(db_scan)
-				group.people.append(db_scan.person)
-			self.session.add(group)
-			self.session.commit()
-			return
-		except MultipleResultsFound:
-			# more than one record found
+		values = list(dict.fromkeys(values))
+		ret = {}
+		for start in range(0, len(values), IN_CHUNK):
+			for value, id in self.session.query(column, column.table.c.id).filter(column.in_(values[start:start + IN_CHUNK])):
+				ret.setdefault(value, []).append(id)
+		return ret
+
+	def unique_ids(self, column, values, missing, kind):
+		"""
+		Return a dict of value -> id for values with exactly one row. Values without
+		a row or with several are added to missing['missing ' + kind] or missing['ambiguous ' + kind].
+		"""
+		found = self.lookup_ids(column, values)
+		ret = {}
+		for value in dict.fromkeys(values):
+			ids = found.get(value, [])
+			if len(ids) == 1:
+				ret[value] = ids[0]
+			else:
+				missing.setdefault(('ambiguous ' if ids else 'missing ') + kind, []).append(value)
+		return ret
+
+	def nth_mriscans(self, person_ids, scanNum, accumulateScan = False):
+		"""
+		Return a dict of person id -> list of mriscan ids, the scanNum-th scan of the person
+		(0 the latest, -1 the one before), or all scans up to it if accumulateScan, ordered by filename.
+		Scans are ranked in SQL by cohort_query.scan_rank, as in CohortQuery.nth_scan.
+		"""
+		scans = tables.MRIScan.__table__
+		rank = cohort_query.scan_rank(scans, scanNum).label('rank')
+		ret = {}
+		for start in range(0, len(person_ids), IN_CHUNK):
+			ranked = self.session.query(scans.c.person_id, scans.c.id, rank) \
+				.filter(scans.c.person_id.in_(person_ids[start:start + IN_CHUNK])).subquery()
+			query = self.session.query(ranked.c.person_id, ranked.c.id) \
+				.filter(cohort_query.rank_condition(ranked.c.rank, scanNum, accumulateScan))
+			for person_id, scan_id in query.order_by(ranked.c.person_id, ranked.c.rank if scanNum > 0 else ranked.c.rank.desc()):
+				ret.setdefault(person_id, []).append(scan_id)
+		return ret
+
+	def create_group(self, groupName, desc = None, mriscan_ids = (), eegscan_ids = (), person_ids = ()):
+		"""
+		Insert a group and all its association rows in one transaction.
+		"""
+		session = self.session
+		found = session.query(tables.Group.id).filter_by(name = groupName).count()
+		if found > 1:
 			raise Exception("More than one %s group found!" % groupName)
-		# found one existing record
-		raise Exception("%s group already exist" % groupName)
+		elif found == 1:
+			raise Exception("%s group already exist" % groupName)
+		metadata = tables.Base.metadata
+		try:
+			group = tables.Group(name = groupName, description = desc)
+			session.add(group)
+			session.flush()
+			for table, column, ids in [('association_group_mriscan', 'scan_id', mriscan_ids),
+									   ('association_group_eegscan', 'scan_id', eegscan_ids),
+									   ('association_group_person', 'person_id', person_ids)]:
+				rows = [{'group_id': group.id, column: id} for id in dict.fromkeys(ids)]
+				if rows:
+					session.execute(metadata.tables[table].insert(), rows)
+			session.commit()
+		except Exception:
+			session.rollback()
+			raise
+		# association rows bypassed the ORM, make relationships reload
+		session.expire_all()
+		self.metadata.clear()
+
+	def newGroupByScans_forMRI(self, groupName, scanList, desc = None):
+		"""
+		Initialize a group by a list of mriscans, the people of the scans are added too.
+		Raise MissingRecordException listing all unknown scans.
+		"""
+		missing = {}
+		scan_ids = self.unique_ids(tables.MRIScan.__table__.c.filename, scanList, missing, 'scans')
+		if missing:
+			raise MissingRecordException(missing)
+		scans = tables.MRIScan.__table__
+		ids = list(scan_ids.values())
+		person_ids = []
+		for start in range(0, len(ids), IN_CHUNK):
+			person_ids += [person_id for (person_id,) in self.session.query(scans.c.person_id)
+						   .filter(scans.c.id.in_(ids[start:start + IN_CHUNK])) if person_id is not None]
+		self.create_group(groupName, desc, mriscan_ids = [scan_ids[scan] for scan in scanList], person_ids = person_ids)
 
 	def newGroupByNames_forMRI(self, groupName, nameList, scanNum, desc = None, accumulateScan = False):
 		"""
 		Initialize a group by a list of names. The mriscans are generated automatically.
-		scanNum - which scan (first/second/etc)
+		scanNum - which scan (first/second/etc, 0 the latest, -1 the one before)
 		accumulateScan - whether keep former mriscans in this group
+		Raise MissingRecordException listing all unknown or ambiguous names and
+		names without a scanNum-th scan.
 		"""
-		group = tables.Group(name = groupName, description = desc)
-		try:
-			self.session.query(tables.Group).filter_by(name = groupName).one()
-		except NoResultFound:
-			for name in nameList:
-				db_person = self.session.query(tables.Person).filter_by(name = name).one()
-				group.people.append(db_person)
-				if accumulateScan:
-					group.mriscans += sorted(db_person.mriscans, key = lambda x: x.filename)[:scanNum]
-				else:
-					group.mriscans.append(sorted(db_person.mriscans, key = lambda x: x.filename)[scanNum - 1])
-			self.session.add(group)
-			self.session.commit()
-			return
-		except MultipleResultsFound:
-			# more than one record found
-			raise Exception("More than one %s group found!" % groupName)
-		# found one existing record
-		raise Exception("%s group already exist" % groupName)
+		missing = {}
+		person_ids = self.unique_ids(tables.Person.__table__.c.name, nameList, missing, 'names')
+		scan_ids = self.nth_mriscans(list(person_ids.values()), scanNum, accumulateScan)
+		if not accumulateScan:
+			for name, person_id in person_ids.items():
+				if person_id not in scan_ids:
+					missing.setdefault('names without scan %d' % scanNum, []).append(name)
+		if missing:
+			raise MissingRecordException(missing)
+		self.create_group(groupName, desc, person_ids = list(person_ids.values()),
+			mriscan_ids = [scan_id for name in person_ids for scan_id in scan_ids.get(person_ids[name], [])])
 
 	def newGroupByNamesAndScans_forMRI(self, groupName, nameList, scanList, desc = None):
 		"""
 		Initialize a group by giving both name and scans
+		Raise MissingRecordException listing all unknown names and scans together.
 		"""
-		group = tables.Group(name = groupName, description = desc)
-		for name in nameList:
-			db_person = self.session.query(tables.Person).filter_by(name = name).one()
-			group.people.append(db_person)
-		for scan in scanList:
-			db_scan = self.session.query(tables.MRIScan).filter_by(filename = scan).one()
-			group.mriscans.append(db_scan)
-		self.session.add(group)
-		self.session.commit()
+		missing = {}
+		person_ids = self.unique_ids(tables.Person.__table__.c.name, nameList, missing, 'names')
+		scan_ids = self.unique_ids(tables.MRIScan.__table__.c.filename, scanList, missing, 'scans')
+		if missing:
+			raise MissingRecordException(missing)
+		self.create_group(groupName, desc, person_ids = list(person_ids.values()), mriscan_ids = list(scan_ids.values()))
 
 	def newGroupByID_forEEG(self, groupName, scanList, desc = None):
 		"""
-		Initialize a group by a list of mriscans
+		Initialize a group by a list of eegscan exam ids
+		Raise MissingRecordException listing all unknown exams.
 		"""
-		group = tables.Group(name = groupName, description = desc)
-		# check if group already exist
-		try:
-			self.session.query(tables.Group).filter_by(name = groupName).one()
-		except NoResultFound:
-			# alright
-			for scan in scanList:
-				db_scan = self.session.query(tables.EEGScan).filter_by(examid = scan).one()
-				group.eegscans.append(db_scan)
-			self.session.add(group)
-			self.session.commit()
-			return
-		except MultipleResultsFound:
-			# more than one record found
-			raise Exception("More than one %s group found!" % groupName)
-		# found one existing record
-		raise Exception("%s group already exist" % groupName)
+		missing = {}
+		scan_ids = self.unique_ids(tables.EEGScan.__table__.c.examid, scanList, missing, 'scans')
+		if missing:
+			raise MissingRecordException(missing)
+		self.create_group(groupName, desc, eegscan_ids = list(scan_ids.values()))
 
 	def deleteGroupByName(self, groupName):
 		groupList = self.session.query(tables.Group).filter_by(name = groupName).all()
@@ -432,22 +1475,31 @@ class SQLiteDB:
 		for group in groupList:
 			self.session.delete(group)
 		self.session.commit()
+		self.metadata.clear()
 
 	def personname_to_id(self, personnames):
-		session = self.new_session()
-		personIDs = []
-		for personname in personnames:
-			person = session.query(tables.Person).filter_by(name = personname).one()
-			personIDs.append(person.id)
-		return personIDs
+		"""
+		Return a dict of person name -> person id, resolved with one IN query per IN_CHUNK names.
+		Raise MissingRecordException listing all unknown or ambiguous names.
+		"""
+		missing = {}
+		ret = self.unique_ids(tables.Person.__table__.c.name, personnames, missing, 'names')
+		if missing:
+			raise MissingRecordException(missing)
+		return ret
 
-	def get_all_mriscans_of_person(self, person_name):
-		session = self.new_session()
-		one_person = session.query(tables.Person).filter_by(name = person_name).one()
-		return session.query(tables.MRIScan).filter_by(person_id = one_person.id)
+	def get_all_mriscans_of_person(self, person_name, lightweight = False):
+		"""
+		lightweight - return the memoized tuple of MRIScanRecords instead of a query of ORM objects
+		"""
+		if lightweight:
+			return self.get_person_mriscan_records(person_name)
+		one_person = self.session.query(tables.Person).filter_by(name = person_name).one()
+		return self.session.query(tables.MRIScan).filter_by(person_id = one_person.id)
 
 	def deleteScan(self, session, mriscanFilename):
 		db_scan = session.query(tables.MRIScan).filter_by(filename = mriscanFilename).one()
 		session.delete(db_scan)
 		session.commit()
+		self.metadata.clear()
 
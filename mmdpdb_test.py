@@ -318,7 +318,25 @@ def MMDPDBDynamicNet(feature_root = rootconfig.path.dynamic_feature_root):
 	print('Query %d dynamic networks (netattr.DynamicNet) using RedisDatabase time cost: %1.2fs' % (load_counter, query_time))
 	print(attr.data.shape)
 
+def CacheListTest(cache_key = 'mmdpdb_test_list'):
+	"""
+	A cache list saved to MongoDB is removed from both redis and MongoDB by delete_cache_list
+	"""
+	db = mmdpdb.MMDPDatabase()
+	db.set_cache_list(cache_key, [1.0, 2.0, 3.0])
+	db.save_cache_list(cache_key, overwrite = True)
+	assert np.array_equal(db.mdb.get_temp_buffer(dict(cache_key = cache_key)), [1.0, 2.0, 3.0])
+	db.delete_cache_list(cache_key)
+	assert db.rdb.get_list_buffer(cache_key) is None
+	try:
+		db.mdb.get_temp_buffer(dict(cache_key = cache_key))
+	except MongoDB.NoRecordFoundException:
+		pass
+	else:
+		raise AssertionError('the list is still in MongoDB')
+
 if __name__ == '__main__':
+	# CacheListTest()
 	# LoadAttrNetTest_AttrNetTest()
 	# LoadDynamicAttrTest()
 	# LoadDynamicNetTest()
@@ -0,0 +1,172 @@
+# coding=utf-8
+"""
+Columnar export of static attributes for analytics.
+
+Every (atlas, feature) collection of the _SA database is streamed with a
+batched cursor and written as one Parquet partition,
+	folder/atlas=<atlas>/feature=<feature>/part-0.parquet
+one row per scan: scan, atlas, feature, the demographics of the scan from
+SQLite and one float column per ROI (roi_0, roi_1, ...). Rows are written
+as Arrow record batches, so only batch_size documents are held in memory.
+
+	parquet_export.export_static_attrs(mmdb, folder, [('brodmann_lr', 'BOLD.inter-region_bc')], scans = cohort)
+	table = parquet_export.read_static_attrs(folder, 'brodmann_lr', 'BOLD.inter-region_bc')
+	df = table.to_pandas()
+
+read_static_attrs keeps an uncompressed Arrow IPC copy next to each
+partition and memory-maps it, so reloading a partition does not decode
+anything.
+"""
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+import cohort_query
+import hash_store
+
+PARTITION_FILE = 'part-0.parquet'
+CACHE_FILE = 'part-0.arrow'
+
+DEMOGRAPHIC_FIELDS = [('person', pa.string()), ('gender', pa.string()), ('birth', pa.timestamp('us')),
+					  ('date', pa.timestamp('us')), ('age', pa.float64()), ('institution', pa.string()),
+					  ('manufacturer', pa.string()), ('modelname', pa.string())]
+
+def partition_path(folder, atlas_name, feature):
+	return os.path.join(folder, 'atlas=' + atlas_name, 'feature=' + feature)
+
+def partitions(folder):
+	"""
+	Return the exported (atlas, feature) pairs of folder
+	"""
+	ret = []
+	for atlas_dir in sorted(os.listdir(folder)):
+		if not atlas_dir.startswith('atlas='):
+			continue
+		for feature_dir in sorted(os.listdir(os.path.join(folder, atlas_dir))):
+			if feature_dir.startswith('feature=') and os.path.exists(os.path.join(folder, atlas_dir, feature_dir, PARTITION_FILE)):
+				ret.append((atlas_dir[len('atlas='):], feature_dir[len('feature='):]))
+	return ret
+
+def schema(roi_num):
+	fields = [('scan', pa.string()), ('atlas', pa.dictionary(pa.int32(), pa.string())),
+			  ('feature', pa.dictionary(pa.int32(), pa.string()))] + DEMOGRAPHIC_FIELDS
+	fields += [('roi_%d' % i, pa.float64()) for i in range(roi_num)]
+	return pa.schema(fields)
+
+def demographics(record):
+	"""
+	Demographic column values of an MRIScanRecord, None for scans unknown to SQLite
+	"""
+	if record is None:
+		return [None] * len(DEMOGRAPHIC_FIELDS)
+	age = None
+	if record.birth is not None and record.date is not None:
+		age = (record.date - record.birth).days / 365.25
+	return [record.name, record.gender, record.birth, record.date, age,
+			record.institution, record.manufacturer, record.modelname]
+
+def record_batch(atlas_name, feature, docs, records, roi_num):
+	"""
+	Build the record batch of a list of _SA documents
+	"""
+	values = np.array([hash_store.decode_value(doc['value']) for doc in docs], dtype = np.float64)
+	if values.ndim != 2 or values.shape[1] != roi_num:
+		raise Exception('%s %s: values of %s are not vectors of %d ROIs' % (atlas_name, feature, docs[0]['scan'], roi_num))
+	rows = [demographics(records.get(doc['scan'])) for doc in docs]
+	columns = [pa.array([doc['scan'] for doc in docs], pa.string()),
+			   pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(docs), dtype = np.int32)), pa.array([atlas_name])),
+			   pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(docs), dtype = np.int32)), pa.array([feature]))]
+	columns += [pa.array([row[i] for row in rows], field_type) for i, (name, field_type) in enumerate(DEMOGRAPHIC_FIELDS)]
+	columns += [pa.array(values[:, i]) for i in range(roi_num)]
+	return pa.RecordBatch.from_arrays(columns, schema = schema(roi_num))
+
+def export_partition(db, folder, atlas_name, feature, scans = None, comment = {}, batch_size = 1000, compression = 'zstd'):
+	"""
+	Stream the _SA collection of (atlas_name, feature) into its Parquet partition.
+	Return the number of rows written.
+	"""
+	query = dict(comment = comment)
+	if scans is not None:
+		query['scan'] = {'$in': list(scans)}
+	col = db.mdb.sadb[db.mdb.getcol(atlas_name, feature)]
+	cursor = col.find(query, {'scan': 1, 'value': 1, '_id': 0}, batch_size = batch_size)
+	path = partition_path(folder, atlas_name, feature)
+	os.makedirs(path, exist_ok = True)
+	# written aside and renamed, a failed export leaves no partial partition and no tmp file
+	tmp = os.path.join(path, PARTITION_FILE + '.tmp')
+	writer = None
+	rows = 0
+	try:
+		for docs in batches(cursor, batch_size):
+			if writer is None:
+				roi_num = len(hash_store.decode_value(docs[0]['value']))
+				writer = pq.ParquetWriter(tmp, schema(roi_num), compression = compression)
+			records = db.sdb.get_mriscan_records([doc['scan'] for doc in docs])
+			writer.write_batch(record_batch(atlas_name, feature, docs, records, roi_num))
+			rows += len(docs)
+		if writer is None:
+			writer = pq.ParquetWriter(tmp, schema(0), compression = compression)
+	except Exception:
+		if writer is not None:
+			writer.close()
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+	writer.close()
+	os.replace(tmp, os.path.join(path, PARTITION_FILE))
+	return rows
+
+def batches(cursor, batch_size):
+	batch = []
+	for doc in cursor:
+		batch.append(doc)
+		if len(batch) >= batch_size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+def export_static_attrs(db, folder, atlas_features, scans = None, comment = {}, batch_size = 1000, compression = 'zstd'):
+	"""
+	Export static attributes to partitioned Parquet.
+	db - MMDPDatabase, attributes are read from its MongoDB and demographics from its SQLite database
+	atlas_features - list of (atlas name, feature name)
+	scans - optional CohortQuery or list of scans, default every scan having the feature
+	Return a dict of (atlas, feature) -> rows written.
+	"""
+	if isinstance(scans, cohort_query.CohortQuery):
+		scans = scans.scans()
+	report = {}
+	for atlas_name, feature in atlas_features:
+		start = time.time()
+		report[(atlas_name, feature)] = export_partition(db, folder, atlas_name, feature, scans, comment, batch_size, compression)
+		print('%s %s: %d rows exported in %1.2fs' % (atlas_name, feature, report[(atlas_name, feature)], time.time() - start))
+	return report
+
+def read_static_attrs(folder, atlas_name, feature, columns = None):
+	"""
+	Return the partition of (atlas_name, feature) as a pyarrow Table memory-mapped from
+	its Arrow IPC copy, which is (re)written from the Parquet file when missing or older.
+	columns - optional list of column names
+	"""
+	path = partition_path(folder, atlas_name, feature)
+	parquet_file = os.path.join(path, PARTITION_FILE)
+	cache_file = os.path.join(path, CACHE_FILE)
+	if not os.path.exists(parquet_file):
+		raise Exception('%s %s is not exported in %s' % (atlas_name, feature, folder))
+	if not os.path.exists(cache_file) or os.path.getmtime(cache_file) <= os.path.getmtime(parquet_file):
+		parquet = pq.ParquetFile(parquet_file)
+		tmp = cache_file + '.tmp'
+		with pa.OSFile(tmp, 'wb') as sink:
+			with pa.ipc.new_file(sink, parquet.schema_arrow) as writer:
+				for batch in parquet.iter_batches():
+					writer.write_batch(batch)
+		os.replace(tmp, cache_file)
+	table = pa.ipc.open_file(pa.memory_map(cache_file, 'r')).read_all()
+	if columns is not None:
+		table = table.select(columns)
+	return table
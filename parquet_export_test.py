@@ -0,0 +1,112 @@
+"""
+Round trip of the Parquet export with fake MongoDB and SQLite databases:
+documents go through record_batch to a partition and are read back with read_static_attrs.
+Needs pyarrow, runs without MongoDB.
+"""
+import os
+import pickle
+import shutil
+import datetime
+import tempfile
+import collections
+import numpy as np
+import hash_store
+import parquet_export
+
+ROI_NUM = 4
+Record = collections.namedtuple('Record', ['name', 'gender', 'birth', 'date', 'institution', 'manufacturer', 'modelname'])
+
+class FakeCollection:
+	def __init__(self, docs):
+		self.docs = docs
+
+	def find(self, query, projection, batch_size = None):
+		scans = query.get('scan', {}).get('$in')
+		return iter([dict(scan = doc['scan'], value = doc['value']) for doc in self.docs
+			if doc['comment'] == query['comment'] and (scans is None or doc['scan'] in scans)])
+
+class FakeMongo:
+	def __init__(self, collections):
+		self.sadb = collections
+
+	def getcol(self, atlas_name, feature):
+		return atlas_name + '-' + feature
+
+class FakeSQLite:
+	def __init__(self, records):
+		self.records = records
+
+	def get_mriscan_records(self, scans):
+		return dict((scan, self.records[scan]) for scan in scans if scan in self.records)
+
+class FakeDB:
+	def __init__(self, collections, records):
+		self.mdb = FakeMongo(collections)
+		self.sdb = FakeSQLite(records)
+
+def make_db(scan_num = 25, bad_scan = None):
+	rand = np.random.RandomState(0)
+	values = dict(('scan%02d' % i, rand.rand(ROI_NUM)) for i in range(scan_num))
+	docs = []
+	for i, (scan, value) in enumerate(sorted(values.items())):
+		if scan == bad_scan:
+			value = rand.rand(ROI_NUM + 1)
+		# tagged and legacy pickled values
+		encoded = hash_store.encode_value(value) if i % 2 else pickle.dumps(value)
+		docs.append(dict(scan = scan, comment = {}, value = encoded))
+	docs.append(dict(scan = 'other', comment = {'note': 1}, value = hash_store.encode_value(rand.rand(ROI_NUM))))
+	records = dict((scan, Record('p' + scan, 'F', datetime.datetime(1950, 1, 1), datetime.datetime(2020, 1, 1), 'inst', 'GE', 'MR750'))
+		for scan in values if scan != 'scan00')
+	return FakeDB({'brodmann_lr-BOLD.inter-region_bc': FakeCollection(docs)}, records), values
+
+def RoundTripTest(folder):
+	db, values = make_db()
+	report = parquet_export.export_static_attrs(db, folder, [('brodmann_lr', 'BOLD.inter-region_bc')], batch_size = 10)
+	assert report == {('brodmann_lr', 'BOLD.inter-region_bc'): len(values)}
+	assert parquet_export.partitions(folder) == [('brodmann_lr', 'BOLD.inter-region_bc')]
+	table = parquet_export.read_static_attrs(folder, 'brodmann_lr', 'BOLD.inter-region_bc')
+	assert table.num_rows == len(values)
+	rows = table.to_pylist()
+	for row in rows:
+		value = [row['roi_%d' % i] for i in range(ROI_NUM)]
+		assert np.array_equal(value, values[row['scan']])
+		assert row['atlas'] == 'brodmann_lr' and row['feature'] == 'BOLD.inter-region_bc'
+	by_scan = dict((row['scan'], row) for row in rows)
+	assert by_scan['scan00']['person'] is None and by_scan['scan00']['age'] is None
+	assert by_scan['scan01']['person'] == 'pscan01' and abs(by_scan['scan01']['age'] - 70.0) < 0.01
+	# the second read maps the Arrow copy
+	cache_file = os.path.join(parquet_export.partition_path(folder, 'brodmann_lr', 'BOLD.inter-region_bc'), parquet_export.CACHE_FILE)
+	mtime = os.path.getmtime(cache_file)
+	table = parquet_export.read_static_attrs(folder, 'brodmann_lr', 'BOLD.inter-region_bc', columns = ['scan', 'roi_0'])
+	assert table.column_names == ['scan', 'roi_0'] and os.path.getmtime(cache_file) == mtime
+	rows = parquet_export.export_partition(db, folder, 'brodmann_lr', 'BOLD.inter-region_bc', scans = ['scan03', 'scan04'])
+	assert rows == 2
+	assert parquet_export.read_static_attrs(folder, 'brodmann_lr', 'BOLD.inter-region_bc').num_rows == 2
+
+def EmptyExportTest(folder):
+	db, values = make_db()
+	assert parquet_export.export_partition(db, folder, 'brodmann_lr', 'BOLD.inter-region_bc', scans = ['missing']) == 0
+	assert parquet_export.read_static_attrs(folder, 'brodmann_lr', 'BOLD.inter-region_bc').num_rows == 0
+
+def FailedExportTest(folder):
+	"""
+	A failed export leaves neither a partition nor its tmp file
+	"""
+	db, values = make_db(bad_scan = 'scan15')
+	try:
+		parquet_export.export_partition(db, folder, 'brodmann_lr', 'BOLD.inter-region_bc', batch_size = 10)
+	except Exception:
+		pass
+	else:
+		raise AssertionError('the export of a malformed value succeeded')
+	assert os.listdir(parquet_export.partition_path(folder, 'brodmann_lr', 'BOLD.inter-region_bc')) == []
+	assert parquet_export.partitions(folder) == []
+
+if __name__ == '__main__':
+	for test in [RoundTripTest, EmptyExportTest, FailedExportTest]:
+		folder = tempfile.mkdtemp()
+		try:
+			test(folder)
+		finally:
+			shutil.rmtree(folder)
+	print('parquet_export: OK')
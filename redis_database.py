@@ -5,19 +5,66 @@ A Redis database would be created on-the-fly and (possibly)
 destroyed after usage.
 """
 from redis import ConnectionPool, StrictRedis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from concurrent.futures import ThreadPoolExecutor
 import os, sys
+import hashlib
 import pymongo
 import pickle
 import numpy as np
+import array_codec, hash_store, shard_ring, cache_stats
 from mmdps.proc import netattr , atlas
 
+# Series scripts check the header in the same round trip as the read or the append,
+# so a series deleted, evicted or rewritten with another dtype by another client is never misread.
+# KEYS[1] series key, ARGV[1] header the items are packed for, ARGV[2] items
+APPEND_SERIES_SCRIPT = """
+local header = redis.call('GETRANGE', KEYS[1], 0, %(last)d)
+if header == '' then
+	redis.call('SET', KEYS[1], ARGV[1] .. ARGV[2])
+	return {1, string.len(ARGV[1]) + string.len(ARGV[2])}
+elseif header == ARGV[1] then
+	return {1, redis.call('APPEND', KEYS[1], ARGV[2])}
+end
+return {0, header}
+""" % dict(last = array_codec.SERIES_HEADER_SIZE - 1)
+
+# KEYS[1] series key, ARGV[1] and ARGV[2] inclusive element range as in LRANGE, start >= 0
+READ_SERIES_SCRIPT = """
+local header = redis.call('GETRANGE', KEYS[1], 0, %(last)d)
+if header == '' then
+	return {}
+end
+local itemsize = tonumber(string.match(header, '(%%d+)%%s*$'))
+local first = %(size)d + tonumber(ARGV[1]) * itemsize
+local last = (tonumber(ARGV[2]) + 1) * itemsize - 1
+if tonumber(ARGV[2]) >= 0 then
+	last = last + %(size)d
+end
+return {header, redis.call('GETRANGE', KEYS[1], first, last)}
+""" % dict(last = array_codec.SERIES_HEADER_SIZE - 1, size = array_codec.SERIES_HEADER_SIZE)
+
+# shared by every RedisDatabase of the process, threads are only started by fan-outs over several nodes
+FAN_OUT_POOL = ThreadPoolExecutor(max_workers = 8)
+
 class RedisDatabase:
 	"""
 	docstring for RedisDatabase
 	"""
 
-	def __init__(self, expire_time = 1800):
+	def __init__(self, expire_time = 1800, nodes = None, stats = None):
+		"""
+		nodes - list of (host, port) or 'host:port' of the redis-servers holding the feature cache.
+			Static and dynamic keys are spread over them by consistent hashing,
+			lists and hashes stay on the first node.
+			The default is a single local redis-server.
+		stats - cache_stats.Stats recording hits, bytes, round trips and latencies
+		"""
 		self.expire_time = max(expire_time, 1800)
+		self.stats = stats if stats is not None else cache_stats.Stats()
+		if nodes is None:
+			nodes = [('localhost', 6379)]
+		self.nodes = [self.parse_node(node) for node in nodes]
 		self.start_redis()
 
 	def is_redis_running(self):
@@ -28,12 +75,13 @@ class RedisDatabase:
 					return True
 				else:
 					return False
-			elif sys.platform == 'darwin':
-				# macOS
-				return True
 			else:
-				# other platform
+				# macOS and other platforms, check by connecting
+				for host, port in self.nodes:
+					StrictRedis(host=host, port=port, socket_connect_timeout=1).ping()
 				return True
+		except RedisConnectionError:
+			return False
 		except Exception as e:
 			raise Exception('Unable to check redis running staate，error message: ' + str(e))
 
@@ -42,20 +90,75 @@ class RedisDatabase:
 			if not self.is_redis_running():
 				if sys.platform == 'win32':
 					os.system("e:/redis/redis-server --service-start")
-				elif sys.platform == 'darwin':
-					# macOS
-					pass
 				else:
-					pass
+					raise Exception('redis-server is not running on ' + str(self.nodes))
 		except Exception as e:
 			raise Exception('Unble to start redis, error message: ' + str(e))
 		try:
-			self.datadb = StrictRedis(host='localhost', port=6379, db=0)
-			self.cachedb = StrictRedis(host='localhost', port=6379, db=1)
-			self.hashdb = StrictRedis(host='localhost', port=6379, db=2)
+			self.data_nodes = {}
+			self.ring = shard_ring.HashRing()
+			for host, port in self.nodes:
+				self.add_node(host, port)
+			host, port = self.nodes[0]
+			self.datadb = self.data_nodes['%s:%d' % (host, port)]
+			self.cachedb = StrictRedis(host=host, port=port, db=1)
+			self.append_series = self.cachedb.register_script(APPEND_SERIES_SCRIPT)
+			self.read_series = self.cachedb.register_script(READ_SERIES_SCRIPT)
+			self.hashdb = StrictRedis(host=host, port=port, db=2)
+			self.hash_store = hash_store.RedisHashStore(self.hashdb)
 		except Exception as e:
 			raise Exception('Redis connection failed，error message:' + str(e))
 
+	def parse_node(self, node):
+		if type(node) is str:
+			host, port = node.rsplit(':', 1)
+			return host, int(port)
+		return node[0], int(node[1])
+
+	def add_node(self, host, port):
+		"""
+		Add a redis-server to the feature cache ring.
+		Only about 1/N of the cached keys move to the new node, they are
+		simply missed once and refilled from MongoDB.
+		"""
+		name = '%s:%d' % (host, port)
+		self.data_nodes[name] = StrictRedis(host=host, port=port, db=0)
+		self.ring.add_node(name)
+
+	def remove_node(self, host, port):
+		"""
+		Remove a redis-server from the feature cache ring.
+		"""
+		name = '%s:%d' % (host, port)
+		self.ring.remove_node(name)
+		self.data_nodes.pop(name)
+
+	def data_node(self, key):
+		"""
+		Return the redis connection holding key.
+		"""
+		return self.data_nodes[self.ring.get_node(key)]
+
+	def fan_out(self, keys, func):
+		"""
+		Group keys by node and call func(connection, keys) for every node,
+		in parallel when more than one node is involved.
+		Return the results of func flattened in the order of keys.
+		"""
+		groups = self.ring.group_keys(keys)
+		ret = [None] * len(keys)
+		def run(node):
+			return func(self.data_nodes[node], [key for pos, key in groups[node]])
+		if len(groups) == 1:
+			node = list(groups)[0]
+			results = {node: run(node)}
+		else:
+			results = dict(zip(groups, FAN_OUT_POOL.map(run, list(groups))))
+		for node in groups:
+			for (pos, key), res in zip(groups[node], results[node]):
+				ret[pos] = res
+		return ret
+
 	def stop_redis(self):
 		try:
 			if self.is_redis_running():
@@ -74,34 +177,42 @@ class RedisDatabase:
 		Using a dictionary, a Mongdb object, a Net class, a Attr class, a DynamicNet class or a DynamicAttr class
 			to set a new entry in Redis.
 		"""
+		labels = (data_source, atlas, feature)
 		if type(obj) is dict:
 			key = self.generate_static_key(data_source, obj['scan'], atlas, feature, obj['comment'])
-			self.datadb.set(key, obj['value'], ex=self.expire_time)
-			return self.trans_netattr(obj['scan'], atlas, feature, pickle.loads(obj['value']))
+			self.data_node(key).set(key, obj['value'], ex=self.expire_time)
+			self.stats.incr('round_trips', 'redis', labels)
+			with self.stats.timer('decode', labels):
+				value = pickle.loads(obj['value'])
+			with self.stats.timer('netattr', labels):
+				return self.trans_netattr(obj['scan'], atlas, feature, value)
 		elif type(obj) is list:
 			value = []
 			scan = obj[0]['scan']
 			comment = obj[0]['comment']
 			key_all = self.generate_dynamic_key(data_source, scan, atlas, feature, window_length, step_size, comment)
-			pipe = self.datadb.pipeline()
+			pipe = self.data_node(key_all).pipeline()
 			length = len(obj)
 			try:
 				pipe.multi()
 				pipe.set(key_all + ':0', length, ex=self.expire_time - 200)
 				for i in range(length):  # 使用查询关键字保证升序
 					pipe.set(key_all + ':' + str(i + 1), (obj[i]['value']), ex=self.expire_time)
-					value.append(pickle.loads(obj[i]['value']))
 				pipe.execute()
 			except Exception as e:
 				raise Exception('An error occur when tring to set value in redis, error message: ' + str(e))
-			return self.trans_dynamic_netattr(scan, atlas, feature, window_length, step_size, np.array(value))
+			self.stats.incr('round_trips', 'redis', labels)
+			with self.stats.timer('decode', labels):
+				value = hash_store.assemble_slices([doc['value'] for doc in obj])
+			with self.stats.timer('netattr', labels):
+				return self.trans_dynamic_netattr(scan, atlas, feature, window_length, step_size, value)
 		elif type(obj) is netattr.Net or type(obj) is netattr.Attr:
 			key = self.generate_static_key(data_source, obj.scan, obj.atlasobj.name, obj.feature_name, {})
-			self.datadb.set(key, pickle.dumps(obj.data))
+			self.data_node(key).set(key, pickle.dumps(obj.data))
 		elif type(obj) is netattr.DynamicNet or type(obj) is netattr.DynamicAttr:
 			key_all = self.generate_dynamic_key(data_source, obj.scan, obj.atlasobj.name, obj.feature_name, obj.window_length, obj.step_size, {})
 			length=obj.data.shape[2]
-			pipe = self.datadb.pipeline()
+			pipe = self.data_node(key_all).pipeline()
 			if type(obj) is netattr.DynamicNet:
 				flag = True
 			else:
@@ -120,14 +231,25 @@ class RedisDatabase:
 
 
 
+	def generate_key_tag(self, data_source, subject_scan, atlas_name, feature_name):
+		"""
+		The {hash tag} deciding the node of a feature key: data source, scan, atlas and feature,
+		never the comment, whose str() has braces of its own.
+		"""
+		return '{' + data_source + ':' + subject_scan + ':' + atlas_name + ':' + feature_name + '}'
+
 	def generate_static_key(self, data_source, subject_scan, atlas_name, feature_name, comment):
-		key = data_source + ':' + subject_scan + ':' + atlas_name + ':' + feature_name + ':0'
+		key = self.generate_key_tag(data_source, subject_scan, atlas_name, feature_name) + ':0'
 		if comment != None:
 			key += ':' + str(comment)
 		return key
 
 	def generate_dynamic_key(self, data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment):
-		key = data_source + ':' + subject_scan + ':' + atlas_name + ':' + feature_name +':1:'+ str(window_length) + ':' + str(step_size)
+		"""
+		The length key and all slice keys (key:0, key:1, ...) of one dynamic
+		feature share its hash tag, so they live on the same node.
+		"""
+		key = self.generate_key_tag(data_source, subject_scan, atlas_name, feature_name) + ':1:' + str(window_length) + ':' + str(step_size)
 		if comment != None:
 			key += ':' + str(comment)
 		return key
@@ -137,13 +259,121 @@ class RedisDatabase:
 		Using data source, scan name, altasobj name, feature name to query static networks and attributes from Redis.
 		If the query succeeds, return a Net or Attr class, if not, return none.
 		"""
-		key = self.generate_static_key(data_source, subject_scan, atlas_name, feature_name, comment)
-		res = self.datadb.get(key)
-		self.datadb.expire(key, self.expire_time)
-		if res is not None:
-			return self.trans_netattr(subject_scan, atlas_name, feature_name, pickle.loads(res))
-		else:
+		return self.get_static_values(data_source, [subject_scan], atlas_name, feature_name, comment)[0]
+
+	def get_static_values(self, data_source, scan_list, atlas_name, feature_name, comment = {}):
+		"""
+		Batched get_static_value for a list of scans.
+		Keys are fetched with one pipeline per node, nodes are queried in parallel.
+		Return a list in the order of scan_list, with None for missing entries.
+		"""
+		labels = (data_source, atlas_name, feature_name)
+		keys = [self.generate_static_key(data_source, scan, atlas_name, feature_name, comment) for scan in scan_list]
+		def fetch(db, node_keys):
+			pipe = db.pipeline(transaction = False)
+			for key in node_keys:
+				pipe.get(key)
+				pipe.expire(key, self.expire_time)
+			self.stats.incr('round_trips', 'redis', labels)
+			return pipe.execute()[::2]
+		with self.stats.timer('redis_get', labels):
+			res = self.fan_out(keys, fetch)
+		ret = []
+		for scan, value in zip(scan_list, res):
+			if value is not None:
+				self.stats.hit('redis', labels, len(value))
+				with self.stats.timer('decode', labels):
+					value = pickle.loads(value)
+				with self.stats.timer('netattr', labels):
+					ret.append(self.trans_netattr(scan, atlas_name, feature_name, value))
+			else:
+				self.stats.miss('redis', labels)
+				ret.append(None)
+		return ret
+
+	def generate_eeg_key(self, data_source, examid, mat, field):
+		return '{' + data_source + ':' + examid + ':EEG:' + mat + ':' + field + '}'
+
+	def set_eeg_values(self, data_source, mat, field, values):
+		"""
+		Store a dict of examid -> EEG feature value, encoded by hash_store, with the expiration time of MRI features.
+		"""
+		labels = (data_source, 'EEG', mat)
+		bufs = dict((self.generate_eeg_key(data_source, examid, mat, field), hash_store.encode_value(value)) for examid, value in values.items())
+		def store(db, node_keys):
+			pipe = db.pipeline(transaction = False)
+			for key in node_keys:
+				pipe.set(key, bufs[key], ex = self.expire_time)
+			self.stats.incr('round_trips', 'redis', labels)
+			return pipe.execute()
+		self.fan_out(list(bufs), store)
+
+	def get_eeg_values(self, data_source, examids, mat, field):
+		"""
+		Batched read of EEG feature values, refreshing their expiration time.
+		Return a list in the order of examids, with None for missing entries.
+		"""
+		labels = (data_source, 'EEG', mat)
+		keys = [self.generate_eeg_key(data_source, examid, mat, field) for examid in examids]
+		def fetch(db, node_keys):
+			pipe = db.pipeline(transaction = False)
+			for key in node_keys:
+				pipe.get(key)
+				pipe.expire(key, self.expire_time)
+			self.stats.incr('round_trips', 'redis', labels)
+			return pipe.execute()[::2]
+		with self.stats.timer('redis_get', labels):
+			res = self.fan_out(keys, fetch)
+		ret = []
+		for value in res:
+			if value is not None:
+				self.stats.hit('redis', labels, len(value))
+				with self.stats.timer('decode', labels):
+					ret.append(hash_store.decode_value(value))
+			else:
+				self.stats.miss('redis', labels)
+				ret.append(None)
+		return ret
+
+	def generate_eeg_group_key(self, data_source, examids, mat, field):
+		"""
+		Key of the EEG feature matrix of a list of exams, the exam ids are hashed in order
+		so any change of membership or order makes a new key.
+		"""
+		digest = hashlib.sha1('\n'.join(examids).encode('utf-8')).hexdigest()
+		return '{' + data_source + ':EEGGROUP:' + mat + ':' + field + ':' + digest + '}'
+
+	def set_eeg_group_value(self, data_source, examids, mat, field, value, present):
+		"""
+		Store the exams x ... matrix of an EEG feature and the boolean mask of the exams having it
+		as one unit, with the expiration time of MRI features.
+		"""
+		key = self.generate_eeg_group_key(data_source, examids, mat, field)
+		pipe = self.data_node(key).pipeline(transaction = False)
+		pipe.set(key, hash_store.encode_value(np.ascontiguousarray(value)), ex = self.expire_time)
+		pipe.set(key + ':present', hash_store.encode_value(np.asarray(present, dtype = bool)), ex = self.expire_time)
+		self.stats.incr('round_trips', 'redis', (data_source, 'EEG', mat))
+		pipe.execute()
+
+	def get_eeg_group_value(self, data_source, examids, mat, field):
+		"""
+		Return (matrix, present mask) stored by set_eeg_group_value, or None, refreshing the expiration time.
+		"""
+		labels = (data_source, 'EEG', mat)
+		key = self.generate_eeg_group_key(data_source, examids, mat, field)
+		pipe = self.data_node(key).pipeline(transaction = False)
+		for name in [key, key + ':present']:
+			pipe.get(name)
+			pipe.expire(name, self.expire_time)
+		self.stats.incr('round_trips', 'redis', labels)
+		with self.stats.timer('redis_get', labels):
+			value, present = pipe.execute()[::2]
+		if value is None or present is None:
+			self.stats.miss('redis', labels)
 			return None
+		self.stats.hit('redis', labels, len(value))
+		with self.stats.timer('decode', labels):
+			return hash_store.decode_value(value), hash_store.decode_value(present)
 
 	def trans_netattr(self,subject_scan, atlas_name, feature_name, value):
 		if value.ndim == 1:  # 这里要改一下
@@ -159,37 +389,66 @@ class RedisDatabase:
 			networks and attributes from Redis.
 		If the query succeeds, return a DynamicNet or DynamicAttr class, if not, return none.
 		"""
-		key_all = self.generate_dynamic_key(data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment)
-		if self.datadb.exists(key_all + ':0'):
-			pipe = self.datadb.pipeline()
+		return self.get_dynamic_values(data_source, [subject_scan], atlas_name, feature_name, window_length, step_size, comment)[0]
+
+	def get_dynamic_values(self, data_source, scan_list, atlas_name, feature_name, window_length, step_size, comment = {}):
+		"""
+		Batched get_dynamic_value for a list of scans.
+		All slices of one scan are on one node, nodes are queried in parallel.
+		Return a list in the order of scan_list, with None for missing entries.
+		"""
+		labels = (data_source, atlas_name, feature_name)
+		keys = [self.generate_dynamic_key(data_source, scan, atlas_name, feature_name, window_length, step_size, comment) for scan in scan_list]
+		def fetch(db, node_keys):
 			try:
-				pipe.multi()
-				length = int(self.datadb.get(key_all + ':0').decode())
-				for i in range(1,length + 1,1):
-					pipe.get(key_all + ':' + str(i))
+				pipe = db.pipeline(transaction = False)
+				for key_all in node_keys:
+					pipe.get(key_all + ':0')
+				lengths = [None if res is None else int(res) for res in pipe.execute()]
+				for key_all, length in zip(node_keys, lengths):
+					if length is None:
+						continue
+					for i in range(1, length + 1, 1):
+						pipe.get(key_all + ':' + str(i))
+						pipe.expire(key_all + ':' + str(i), self.expire_time)
+					pipe.expire(key_all + ':0', self.expire_time - 200)
 				res = pipe.execute()
 			except Exception as e:
 				raise Exception('An error occur when tring to get value in redis, error message: ' + str(e))
-			try:
-				pipe.multi()
-				value = []
-				for i in range(length):
-					value.append(pickle.loads(res[i]))
-					pipe.expire(key_all + ':' + str(i+1), self.expire_time)
-				pipe.expire(key_all + ':0', self.expire_time - 200)
-				pipe.execute()
-			except Exception as e:
-				raise Exception('An error occur when tring to update expiration time in redis, error message: ' + str(e))
-			return self.trans_dynamic_netattr(subject_scan, atlas_name, feature_name, window_length, step_size, np.array(value))
-		else:
-			return None
+			self.stats.incr('round_trips', 'redis', labels, 2)
+			ret = []
+			pos = 0
+			for length in lengths:
+				if length is None:
+					ret.append(None)
+					continue
+				slices = res[pos:pos + 2 * length:2]
+				pos += 2 * length + 1
+				# a slice expired before its length key
+				ret.append(None if any(x is None for x in slices) else slices)
+			return ret
+		with self.stats.timer('redis_get', labels):
+			res = self.fan_out(keys, fetch)
+		ret = []
+		for scan, slices in zip(scan_list, res):
+			if slices is not None:
+				self.stats.hit('redis', labels, sum(len(x) for x in slices))
+				with self.stats.timer('decode', labels):
+					value = hash_store.assemble_slices(slices)
+				with self.stats.timer('netattr', labels):
+					ret.append(self.trans_dynamic_netattr(scan, atlas_name, feature_name, window_length, step_size, value))
+			else:
+				self.stats.miss('redis', labels)
+				ret.append(None)
+		return ret
 
 	def trans_dynamic_netattr(self, subject_scan, atlas_name, feature_name, window_length, step_size, value):
+		# value is slices first, time becomes the last axis by a view
 		if value.ndim == 2:  # 这里要改一下
-			arr = netattr.DynamicAttr(value.swapaxes(0,1), atlas.get(atlas_name), window_length, step_size, subject_scan, feature_name)
+			arr = netattr.DynamicAttr(np.moveaxis(value, 0, -1), atlas.get(atlas_name), window_length, step_size, subject_scan, feature_name)
 			return arr
 		else:
-			net = netattr.DynamicNet(value.swapaxes(0,2).swapaxes(0,1), atlas.get(atlas_name), window_length, step_size, subject_scan, feature_name)
+			net = netattr.DynamicNet(np.moveaxis(value, 0, -1), atlas.get(atlas_name), window_length, step_size, subject_scan, feature_name)
 			return net
 
 	def exists_key(self,data_source, subject_scan, atlas_name, feature_name, isdynamic = False, window_length = 0, step_size = 0, comment ={}):
@@ -198,44 +457,76 @@ class RedisDatabase:
 		You can add isdynamic(True), window length, step size to check the existence of an dynamic entry in Redis.
 		"""
 		if isdynamic is False:
-			return self.datadb.exists(self.generate_static_key(data_source, subject_scan, atlas_name, feature_name,comment))
+			key = self.generate_static_key(data_source, subject_scan, atlas_name, feature_name,comment)
 		else:
-			return self.datadb.exists(self.generate_dynamic_key(data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment) + ':0')
+			key = self.generate_dynamic_key(data_source, subject_scan, atlas_name, feature_name, window_length, step_size, comment) + ':0'
+		return self.data_node(key).exists(key)
 
 	"""
-	Redis supports storing and querying list as cache.
-	Note: the items in list must be int or float.
+	Redis supports storing and querying numeric series as cache.
+	A series is kept as one packed binary string (see array_codec):
+	a dtype tag followed by the raw items, so appending is a single
+	APPEND and a range read is a single GETRANGE, each run in a script
+	together with the check of the header.
+	Note: the items in series must be int or float.
 	"""
 
-	def set_list_all_cache(self,key,value):
+	def get_series_dtype(self, key):
+		"""
+		Return the dtype of the series stored with cache_key, or None if it does not exist.
 		"""
-		Store a list to Redis as cache with cache_key.
+		header = self.cachedb.getrange(key, 0, array_codec.SERIES_HEADER_SIZE - 1)
+		if not header:
+			return None
+		return array_codec.parse_series_header(header)
+
+	def set_list_all_cache(self, key, value, dtype = None):
+		"""
+		Store a list/ndarray to Redis as a packed series with cache_key.
 		Note: please check the existence of the cache_key, or it will cover the origin entry.
+		Return the length of the series.
 		"""
-		self.cachedb.delete(key)
-		for i in value:
-			self.cachedb.rpush(key, pickle.dumps(i))
-		#self.cachedb.save()
-		return self.cachedb.llen(key)
+		if dtype is None:
+			dtype = array_codec.series_dtype(value)
+		dtype = np.dtype(dtype)
+		buf = array_codec.pack_series(value, dtype)
+		self.cachedb.set(key, buf)
+		return (len(buf) - array_codec.SERIES_HEADER_SIZE) // dtype.itemsize
 
-	def set_list_cache(self,key,value):
+	def set_list_cache(self, key, value):
 		"""
-		Append value to a list as the last one in Redis with cache_key.
-		If the given key is empty in Redis, a new list will be created.
+		Append value (a number or a list of numbers) to the end of a series in Redis with cache_key.
+		If the given key is empty in Redis, a new series will be created.
+		Return the length of the series.
 		"""
-		self.cachedb.rpush(key, pickle.dumps(value))
-		#self.cachedb.save()
-		return self.cachedb.llen(key)
+		dtype = array_codec.series_dtype(value)
+		while True:
+			ok, res = self.append_series(keys = [key], args = [array_codec.series_header(dtype), array_codec.pack_series_items(value, dtype)])
+			if ok:
+				return (res - array_codec.SERIES_HEADER_SIZE) // dtype.itemsize
+			# the series holds another dtype, pack the items for it
+			dtype = array_codec.parse_series_header(res)
 
 	def get_list_cache(self, key, start = 0, end = -1):
 		"""
-		Return a list with given cache_key in Redis.
+		Return the series with given cache_key in Redis as an ndarray.
+		start and end are inclusive element indices, as in LRANGE.
+		Return an empty ndarray if the key does not exist.
+		"""
+		if start < 0:
+			# the tail length is unknown without a round trip, read all and slice
+			value = self.get_list_cache(key)
+			return value[start:] if end == -1 else value[start:end + 1]
+		res = self.read_series(keys = [key], args = [start, end])
+		if not res:
+			return np.array([])
+		return np.frombuffer(res[1], dtype = array_codec.parse_series_header(res[0]))
+
+	def get_list_buffer(self, key):
+		"""
+		Return the packed series (header and items) stored with cache_key, or None.
 		"""
-		res = self.cachedb.lrange(key, start, end)
-		lst=[]
-		for x in res:
-				lst.append(pickle.loads(x))
-		return lst
+		return self.cachedb.get(key)
 
 	def exists_key_cache(self, key):
 		"""
@@ -263,20 +554,19 @@ class RedisDatabase:
 	"""
 	Redis supports storing and querying hash.
 	Note: the keys in hash must be string.
+	Values are encoded field by field by hash_store (msgpack for scalars,
+	packed binary for ndarrays) and written in bounded HSET batches.
 	"""
 
-	def set_hash_all(self,name,hash):
+	def set_hash_all(self, name, hash, ttl = None):
 		"""
 		Store a hash to Redis with hash_name and a hash.
 		Note: please check the existence of the hash_name, or it will cover the origin hash.
+		ttl - optional expiration time of the whole hash in seconds.
 		"""
-		self.hashdb.delete(name)
-		for i in hash:
-			hash[i]=pickle.dumps(hash[i])
-		self.hashdb.hmset(name,hash)
-
+		self.hash_store.set(name, hash, ttl, replace = True)
 
-	def set_hash(self,name, item1, item2=''):
+	def set_hash(self, name, item1, item2 = '', ttl = None):
 		"""
 		Append an entry/entries to a hash in Redis with hash_name.
 		If the given name is empty in Redis, a new hash will be created.
@@ -285,35 +575,39 @@ class RedisDatabase:
 			2.A key and a value
 		"""
 		if type(item1) is dict:
-			for i in item1:
-				item1[i] = pickle.dumps(item1[i])
-			self.hashdb.hmset(name,item1)
+			self.hash_store.set(name, item1, ttl)
 		else:
-			self.hashdb.hset(name, item1, pickle.dumps(item2))
+			self.hash_store.set(name, {item1: item2}, ttl)
 
-	def get_hash(self,name,keys=[]):
+	def get_hash(self, name, keys = []):
 		"""
 		Support three query functions:
 			1.Return a hash with a given hash_name in Redis.
 			2.Return a value_list with a given hash_name and a key_list in Redis,
 				the value_list is the same sequence as key_list.
 			3.Return a value with a given hash_name and a key in Redis.
+		Missing keys are returned as None.
 		"""
 		if not keys:
-			res = self.hashdb.hgetall(name)
-			hash={}
-			for i in res:
-				hash[i.decode()]=pickle.loads(res[i])
-			return hash
+			return self.hash_store.get(name)
+		elif type(keys) is list:
+			res = self.hash_store.get(name, keys)
+			return [res[key] for key in keys]
 		else:
-			if type(keys) is list:
-				res = self.hashdb.hmget(name, keys)
-				for i in range(len(res)):
-					res[i]=pickle.loads(res[i])
-				return res
-			else:
-				return pickle.loads(self.hashdb.hget(name, keys))
+			return self.hash_store.get_one(name, keys)
+
+	def iter_hash(self, name, match = None):
+		"""
+		Iterate over (key, value) of a hash in Redis with HSCAN,
+		without pulling the whole hash at once.
+		"""
+		return self.hash_store.scan(name, match)
 
+	def expire_hash(self, name, ttl):
+		"""
+		Set the expiration time of a hash in seconds.
+		"""
+		return self.hash_store.expire(name, ttl)
 
 	def exists_hash(self,name):
 		"""
@@ -350,7 +644,8 @@ class RedisDatabase:
 		self.hashdb.flushdb()
 
 	def flushall(self):
-		self.datadb.flushall()
+		for db in self.data_nodes.values():
+			db.flushall()
 
 if __name__ == '__main__':
 	pass
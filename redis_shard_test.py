@@ -0,0 +1,90 @@
+"""
+Sharded feature cache test.
+Starts several local redis-server processes, spreads keys over them
+and checks routing, hash tags and remapping on node changes.
+"""
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import pickle
+import numpy as np
+import redis_database, shard_ring
+
+PORTS = [6391, 6392, 6393, 6394]
+
+def start_servers(ports = PORTS):
+	workdir = tempfile.mkdtemp()
+	procs = []
+	for port in ports:
+		procs.append(subprocess.Popen(['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no', '--dir', workdir],
+			stdout = subprocess.DEVNULL))
+	time.sleep(0.5)
+	return procs, workdir
+
+def stop_servers(procs, workdir):
+	for proc in procs:
+		proc.terminate()
+		proc.wait()
+	shutil.rmtree(workdir)
+
+def RingRemapTest(key_num = 100000):
+	"""
+	Adding or removing one of N nodes should only move about 1/N of the keys
+	"""
+	keys = ['Changgung:scan%d:aal:BOLD.net:0' % i for i in range(key_num)]
+	ring = shard_ring.HashRing(['node%d' % i for i in range(4)])
+	before = [ring.get_node(key) for key in keys]
+	counts = dict((node, before.count(node)) for node in ring.nodes)
+	print('Key distribution over 4 nodes:', counts)
+	ring.add_node('node4')
+	after = [ring.get_node(key) for key in keys]
+	moved = sum(1 for a, b in zip(before, after) if a != b)
+	print('Adding a 5th node moved %1.3f of the keys' % (moved / key_num))
+	assert moved / key_num < 0.3
+	assert all(b == 'node4' for a, b in zip(before, after) if a != b)
+	ring.remove_node('node4')
+	assert [ring.get_node(key) for key in keys] == before
+
+def HashTagTest():
+	"""
+	All slices of one dynamic feature map to the same node
+	"""
+	rdb = redis_database.RedisDatabase(nodes = [('localhost', port) for port in PORTS])
+	key_all = rdb.generate_dynamic_key('Changgung', 'scan0', 'brodmann_lrce', 'BOLD.net', 22, 1, {})
+	nodes = set(rdb.ring.get_node(key_all + ':' + str(i)) for i in range(200))
+	assert len(nodes) == 1
+
+def ShardedFetchTest(scan_num = 1000):
+	"""
+	Store static values on all nodes and read them back in one batched fan-out
+	"""
+	rdb = redis_database.RedisDatabase(nodes = [('localhost', port) for port in PORTS])
+	scans = ['scan%d' % i for i in range(scan_num)]
+	for scan in scans:
+		doc = dict(scan = scan, comment = {}, value = pickle.dumps(np.random.rand(90, 90)))
+		key = rdb.generate_static_key('Changgung', scan, 'aal', 'BOLD.net', {})
+		rdb.data_node(key).set(key, doc['value'])
+	print('Keys per node:', dict((name, db.dbsize()) for name, db in rdb.data_nodes.items()))
+	start = time.time()
+	for scan in scans:
+		key = rdb.generate_static_key('Changgung', scan, 'aal', 'BOLD.net', {})
+		assert rdb.data_node(key).get(key) is not None
+	single = time.time() - start
+	start = time.time()
+	keys = [rdb.generate_static_key('Changgung', scan, 'aal', 'BOLD.net', {}) for scan in scans]
+	res = rdb.fan_out(keys, lambda db, node_keys: db.mget(node_keys))
+	batched = time.time() - start
+	assert all(x is not None for x in res)
+	print('Fetch %d static values one by one: %1.2fs, fanned out: %1.2fs' % (scan_num, single, batched))
+	rdb.flushall()
+
+if __name__ == '__main__':
+	RingRemapTest()
+	procs, workdir = start_servers()
+	try:
+		HashTagTest()
+		ShardedFetchTest()
+	finally:
+		stop_servers(procs, workdir)
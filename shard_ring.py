@@ -0,0 +1,76 @@
+# coding=utf-8
+"""
+Consistent hashing of Redis keys over several nodes.
+
+Each node is placed on the ring at many virtual points, so adding or
+removing one node only remaps about 1/N of the keys. As in Redis
+Cluster, when a key contains a {hash tag} only the tag is hashed, which
+keeps all slices of one dynamic feature on the same node.
+"""
+import bisect
+import hashlib
+
+def hash_tag(key):
+	"""
+	Return the part of key that decides its node.
+	"""
+	start = key.find('{')
+	if start != -1:
+		end = key.find('}', start + 1)
+		if end > start + 1:
+			return key[start + 1:end]
+	return key
+
+def _hash(value):
+	return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+class HashRing:
+	"""
+	Consistent hash ring of node names.
+	"""
+
+	def __init__(self, nodes = (), replicas = 160):
+		self.replicas = replicas
+		self.points = []
+		self.owners = []
+		self.nodes = []
+		for node in nodes:
+			self.add_node(node)
+
+	def add_node(self, node):
+		if node in self.nodes:
+			raise Exception('Node %s is already in the ring' % node)
+		self.nodes.append(node)
+		for i in range(self.replicas):
+			point = _hash('%s#%d' % (node, i))
+			idx = bisect.bisect(self.points, point)
+			self.points.insert(idx, point)
+			self.owners.insert(idx, node)
+
+	def remove_node(self, node):
+		if node not in self.nodes:
+			raise Exception('Node %s is not in the ring' % node)
+		self.nodes.remove(node)
+		keep = [(p, o) for p, o in zip(self.points, self.owners) if o != node]
+		self.points = [p for p, o in keep]
+		self.owners = [o for p, o in keep]
+
+	def get_node(self, key):
+		"""
+		Return the node owning key.
+		"""
+		if not self.points:
+			raise Exception('No node in the ring')
+		idx = bisect.bisect(self.points, _hash(hash_tag(key)))
+		if idx == len(self.points):
+			idx = 0
+		return self.owners[idx]
+
+	def group_keys(self, keys):
+		"""
+		Return a dict of node -> list of (position, key) for a list of keys.
+		"""
+		groups = {}
+		for pos, key in enumerate(keys):
+			groups.setdefault(self.get_node(key), []).append((pos, key))
+		return groups
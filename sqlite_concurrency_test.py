@@ -0,0 +1,100 @@
+"""
+Concurrency stress test of SQLiteDB.
+Runs the metadata query methods from a growing number of threads against
+a synthetic database, checks every thread gets the single-threaded results
+and prints the throughput per thread count, with and without a concurrent writer.
+"""
+import os
+import time
+import random
+import tempfile
+import threading
+import mmdpdb
+import sqlite_plan_test
+
+THREAD_NUMS = [1, 2, 4, 8]
+OPS_PER_THREAD = 50
+
+def workload(db, ops, seed):
+	"""
+	Return [(op, result)] of ops random lookups
+	"""
+	rand = random.Random(seed)
+	ret = []
+	for i in range(ops):
+		op = rand.randrange(4)
+		if op == 0:
+			group = 'group%d' % rand.randint(1, 200)
+			ret.append((('group', group), [scan.filename for scan in db.getMRIScansInGroup(group, lightweight = True)]))
+		elif op == 1:
+			names = ['person%d' % rand.randint(1, 20000) for j in range(20)]
+			try:
+				ret.append((('names', tuple(names)), sorted(db.personname_to_id(names).items())))
+			except mmdpdb.MissingRecordException as e:
+				ret.append((('names', tuple(names)), sorted(e.missing.items())))
+		elif op == 2:
+			group = 'group%d' % rand.randint(1, 200)
+			gender = rand.choice('FM')
+			ret.append((('cohort', group, gender), db.cohort().in_group(group).gender(gender).age(50, 70).modalities(hasBOLD = True).count()))
+		else:
+			name = 'person%d' % rand.randint(1, 20000)
+			ret.append((('person', name), sorted(scan.filename for scan in db.get_all_mriscans_of_person(name))))
+	db.remove_session()
+	return ret
+
+def run_threads(db, thread_num, ops = OPS_PER_THREAD, writer = False):
+	"""
+	Return (elapsed seconds, results per thread, errors)
+	"""
+	results = [None] * thread_num
+	errors = []
+	stop = threading.Event()
+	def reader(i):
+		try:
+			results[i] = workload(db, ops, i)
+		except Exception as e:
+			errors.append(e)
+	def write():
+		scans = [scan.filename for scan in db.getMRIScansInGroup('group1', lightweight = True)]
+		count = 0
+		try:
+			while not stop.is_set():
+				name = 'stress_group_%d_%d' % (thread_num, count)
+				db.newGroupByScans_forMRI(name, scans[:50])
+				db.deleteGroupByName(name)
+				count += 1
+		except Exception as e:
+			errors.append(e)
+		finally:
+			db.remove_session()
+	threads = [threading.Thread(target = reader, args = (i,)) for i in range(thread_num)]
+	writer_thread = threading.Thread(target = write) if writer else None
+	if writer_thread:
+		writer_thread.start()
+	start = time.time()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = time.time() - start
+	stop.set()
+	if writer_thread:
+		writer_thread.join()
+	return elapsed, results, errors
+
+def ConcurrencyTest(path, snapshot = False, writer = False):
+	db = mmdpdb.SQLiteDB(path, snapshot = snapshot)
+	expected = [workload(db, OPS_PER_THREAD, i) for i in range(max(THREAD_NUMS))]
+	print('snapshot=%s writer=%s' % (snapshot, writer))
+	for thread_num in THREAD_NUMS:
+		elapsed, results, errors = run_threads(db, thread_num, writer = writer)
+		assert not errors, errors
+		assert results == expected[:thread_num]
+		print('%3d threads: %8.1f ops/s' % (thread_num, thread_num * OPS_PER_THREAD / elapsed))
+
+if __name__ == '__main__':
+	path = os.path.join(tempfile.mkdtemp(), 'synthetic.db')
+	sqlite_plan_test.build_database(path)
+	ConcurrencyTest(path)
+	ConcurrencyTest(path, writer = True)
+	ConcurrencyTest(path, snapshot = True)
@@ -0,0 +1,168 @@
+"""
+Query-plan regression test of the SQLite metadata store.
+Builds a synthetic 100k-scan database, applies the alembic migrations,
+runs every SQLiteDB query method, and checks with EXPLAIN QUERY PLAN
+that none of the statements they issue scans a whole table.
+"""
+import os
+import time
+import random
+import datetime
+import tempfile
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import event
+import mmdpdb
+from mmdps.dms import tables
+
+SCAN_NUM = 100000
+PERSON_NUM = 20000
+GROUP_NUM = 200
+GROUP_SIZE = 500
+
+def build_database(path, scan_num = SCAN_NUM, person_num = PERSON_NUM):
+	"""
+	Create the schema, stamp it at the last pre-index revision and upgrade to head.
+	"""
+	db = mmdpdb.SQLiteDB(path)
+	db.init()
+	config = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alembic.ini'))
+	config.set_main_option('script_location', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alembic'))
+	config.set_main_option('sqlalchemy.url', 'sqlite:///' + path)
+	command.stamp(config, '38611286ecd3')
+	command.upgrade(config, 'head')
+
+	random.seed(0)
+	conn = db.engine.raw_connection()
+	cur = conn.cursor()
+	cur.executemany('INSERT INTO mrimachines (id, institution, manufacturer, modelname) VALUES (?, ?, ?, ?)',
+		[(i, 'inst%d' % (i % 5), 'GE', 'model%d' % i) for i in range(1, 51)])
+	cur.executemany('INSERT INTO eegmachines (id, devicename, devicemode) VALUES (?, ?, ?)',
+		[(i, 'device%d' % i, '1000Hz64') for i in range(1, 21)])
+	cur.executemany('INSERT INTO people (id, name, name_chinese, eegid, patientid, gender, birth) VALUES (?, ?, ?, ?, ?, ?, ?)',
+		[(i, 'person%d' % i, 'p%d' % i, 'E%d' % i, 'P%d' % i, random.choice('FM'),
+		  datetime.datetime(1940, 1, 1) + datetime.timedelta(days = random.randint(0, 20000))) for i in range(1, person_num + 1)])
+	scans = []
+	for i in range(1, scan_num + 1):
+		person = random.randint(1, person_num)
+		date = datetime.datetime(2015, 1, 1) + datetime.timedelta(days = random.randint(0, 2500))
+		scans.append((i, 'person%d_%s' % (person, date.strftime('%Y%m%d')) + ('' if i % 7 else '_%d' % i), person, random.randint(1, 50), date,
+			random.random() < 0.9, random.random() < 0.5, random.random() < 0.8, random.random() < 0.7))
+	# person/date collisions are made unique by the suffix above
+	seen = set()
+	scans = [scan for scan in scans if not (scan[1] in seen or seen.add(scan[1]))]
+	cur.executemany('INSERT INTO mriscans (id, filename, person_id, mrimachine_id, date, hasT1, hasT2, hasBOLD, hasDWI) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', scans)
+	cur.executemany('INSERT INTO eegscans (id, examid, person_id, eegmachine_id, date, samplerate) VALUES (?, ?, ?, ?, ?, ?)',
+		[(i, 'E%08d' % i, random.randint(1, person_num), random.randint(1, 20), datetime.datetime(2020, 1, 1), 1000) for i in range(1, scan_num // 10 + 1)])
+	cur.executemany('INSERT INTO groups (id, name) VALUES (?, ?)', [(i, 'group%d' % i) for i in range(1, GROUP_NUM + 1)] + [(GROUP_NUM + 1, 'Changgung HC')])
+	scan_ids = [scan[0] for scan in scans]
+	for group in range(1, GROUP_NUM + 2):
+		members = random.sample(scan_ids, GROUP_SIZE)
+		cur.executemany('INSERT INTO association_group_mriscan (group_id, scan_id) VALUES (?, ?)', [(group, scan) for scan in members])
+		cur.executemany('INSERT INTO association_group_eegscan (group_id, scan_id) VALUES (?, ?)', [(group, random.randint(1, scan_num // 10)) for j in range(50)])
+		cur.executemany('INSERT INTO association_group_person (group_id, person_id) VALUES (?, ?)', [(group, random.randint(1, person_num)) for j in range(GROUP_SIZE)])
+	cur.executemany('INSERT INTO researchstudy (id, name, alias) VALUES (?, ?, ?)', [(i, 'study%d' % i, 'alias%d' % i) for i in range(1, 11)])
+	cur.executemany('INSERT INTO association_group_study (group_id, study_id) VALUES (?, ?)', [(g, g % 10 + 1) for g in range(1, GROUP_NUM + 1)])
+	conn.commit()
+	conn.close()
+	return scans
+
+def capture_statements(db, func):
+	"""
+	Run func and return its result and the (statement, parameters) it issued.
+	"""
+	statements = []
+	def record(conn, cursor, statement, parameters, context, executemany):
+		if not executemany and statement.lstrip().upper().startswith('SELECT'):
+			statements.append((statement, parameters))
+	event.listen(db.engine, 'before_cursor_execute', record)
+	try:
+		result = func()
+	finally:
+		event.remove(db.engine, 'before_cursor_execute', record)
+	return result, statements
+
+def full_scans(db, statement, parameters):
+	"""
+	Return the EXPLAIN QUERY PLAN lines of statement scanning a table without index.
+	"""
+	conn = db.engine.raw_connection()
+	try:
+		plan = conn.cursor().execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+	finally:
+		conn.close()
+	return [row[-1] for row in plan if row[-1].startswith('SCAN ') and 'INDEX' not in row[-1]]
+
+def QueryPlanTest(path):
+	db = mmdpdb.SQLiteDB(path)
+	scans = db.session.query(tables.MRIScan.filename).limit(3).all()
+	filenames = [name for (name,) in scans]
+	person = filenames[0].split('_')[0]
+	examid = db.session.query(tables.EEGScan.examid).first()[0]
+	cases = [
+		('get_group', lambda: [(s.person.name, s.machine.modelname) for s in db.get_group('group1').mriscans]),
+		('get_group lightweight', lambda: db.get_group('group1', lightweight = True)),
+		('getMRIScansInGroup', lambda: db.getMRIScansInGroup('group2')),
+		('getEEGScansInGroup', lambda: db.getEEGScansInGroup('group3')),
+		('getNamesInGroup', lambda: db.getNamesInGroup('group4')),
+		('getResearchStudy', lambda: db.getResearchStudy('alias1')),
+		('getResearchStudy lightweight', lambda: db.getResearchStudy('alias2', lightweight = True)),
+		('getHealthyGroup', lambda: db.getHealthyGroup()),
+		('personname_to_id', lambda: db.personname_to_id([person])),
+		('get_all_mriscans_of_person', lambda: list(db.get_all_mriscans_of_person(person))),
+		('scan exists', lambda: db.session.query(tables.MRIScan).filter_by(filename = filenames[1]).one()),
+		('exam exists', lambda: db.session.query(tables.EEGScan).filter(tables.EEGScan.examid == examid).one()),
+		('eeg machine', lambda: db.session.query(tables.EEGMachine).filter(tables.EEGMachine.devicename == 'device3').one()),
+		('eeg person', lambda: db.session.query(tables.Person).filter(tables.Person.name_chinese == 'p3', tables.Person.eegid == 'E3').one()),
+	]
+	failures = []
+	for name, func in cases:
+		db.session.expire_all()
+		start = time.time()
+		result, statements = capture_statements(db, func)
+		elapsed = time.time() - start
+		bad = []
+		for statement, parameters in statements:
+			bad += full_scans(db, statement, parameters)
+		print('%-32s %3d statements %8.2fms %s' % (name, len(statements), elapsed * 1000, 'FULL SCAN: ' + '; '.join(bad) if bad else 'ok'))
+		if bad:
+			failures.append((name, bad))
+	assert not failures, failures
+
+def NthScanTest(path):
+	"""
+	nth_mriscans and CohortQuery.nth_scan against Python indexing of the sorted scans,
+	for positive scanNum and for 0 (the latest) and negative ones counted back from it
+	"""
+	db = mmdpdb.SQLiteDB(path)
+	by_person = {}
+	for scan_id, filename, person_id in db.session.query(tables.MRIScan.id, tables.MRIScan.filename, tables.MRIScan.person_id):
+		by_person.setdefault(person_id, []).append((filename, scan_id))
+	person_ids = sorted(by_person)
+	for scanNum in [1, 2, 0, -1]:
+		index = scanNum - 1
+		expected = dict((person_id, [sorted(scans)[index][1]]) for person_id, scans in by_person.items()
+			if -len(scans) <= index < len(scans))
+		assert db.nth_mriscans(person_ids, scanNum) == expected, scanNum
+		cohort = set(db.cohort('mri').nth_scan(scanNum).scans())
+		assert cohort == set(sorted(by_person[person_id])[index][0] for person_id in expected), scanNum
+		# accumulated: all scans up to and including the scanNum-th
+		expected = {}
+		for person_id, scans in by_person.items():
+			ids = [scan_id for filename, scan_id in sorted(scans)]
+			ids = ids[:scanNum] if scanNum > 0 else ids[:len(ids) + scanNum]
+			if ids:
+				expected[person_id] = ids
+		assert db.nth_mriscans(person_ids, scanNum, accumulateScan = True) == expected, scanNum
+	person_id = max(by_person, key = lambda person_id: len(by_person[person_id]))
+	name = db.session.query(tables.Person.name).filter_by(id = person_id).one()[0]
+	db.newGroupByNames_forMRI('latest', [name], 0)
+	assert [scan.filename for scan in db.getMRIScansInGroup('latest')] == [max(by_person[person_id])[0]]
+
+if __name__ == '__main__':
+	path = os.path.join(tempfile.mkdtemp(), 'synthetic.db')
+	start = time.time()
+	build_database(path)
+	print('Synthetic %d-scan database built in %1.2fs' % (SCAN_NUM, time.time() - start))
+	QueryPlanTest(path)
+	NthScanTest(path)